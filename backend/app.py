@@ -6,20 +6,44 @@ Supports multi-user OAuth authentication
 
 import os
 import json
+import mimetypes
+import re
 import secrets
+import time
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
 from functools import wraps
 
 # Allow OAuth over HTTP for local development (disable in production)
 os.environ['OAUTHLIB_INSECURE_TRANSPORT'] = '1'
-from flask import Flask, request, jsonify, send_file, redirect, make_response
+from flask import Flask, Response, request, jsonify, send_file, redirect, make_response, stream_with_context
 from flask_cors import CORS
 from dotenv import load_dotenv
 import anthropic
-from gmail_service import GmailService
+from attachment_bundle import BUNDLE_MAX_FILES, stream_bundle
+from attachment_cache import AttachmentCache
+from gmail_pool import GmailClientPool
+from gmail_scheduler import GmailAPIError, gmail_scheduler
+from gmail_service import AGGREGATE_MAX_MESSAGES
+from mailbox_index import MAILBOX_INDEX_ENABLED, MailboxIndexes
+from message_cache import MessageCache
+from metrics import count_error, observe_chat, observe_claude_call, render as render_metrics, timed_tool
+from result_governor import ResultGovernor
+from tracing import (
+    TRACE_HEADER,
+    bind,
+    finish_trace,
+    requested_format,
+    span,
+    start_trace,
+    trace_fields,
+    traced
+)
 from auth import (
     create_oauth_flow,
     complete_oauth_flow,
-    get_user_credentials,
+    get_session,
+    get_session_stats,
     get_user_email_from_session,
     invalidate_session,
     verify_state
@@ -37,16 +61,80 @@ app.secret_key = os.environ.get('FLASK_SECRET_KEY', secrets.token_hex(32))
 CORS(app,
      supports_credentials=True,
      origins=['http://localhost:8000', 'http://127.0.0.1:8000'],
-     allow_headers=['Content-Type'],
+     allow_headers=['Content-Type', 'Range', TRACE_HEADER],
+     expose_headers=['Content-Disposition', 'Content-Length', 'Content-Range', 'Accept-Ranges'],
      methods=['GET', 'POST', 'OPTIONS'])
 
 # Initialize Anthropic client
 anthropic_client = anthropic.Anthropic(api_key=os.environ.get("ANTHROPIC_API_KEY"))
 
+# Parsed Gmail messages never change, so raw payloads are cached per user
+message_cache = MessageCache()
+
+# Optional local full-text index that answers common searches without the Gmail API
+mailbox_indexes = MailboxIndexes() if MAILBOX_INDEX_ENABLED else None
+
+# Downloaded attachments, stored on disk by content hash and shared by all workers
+attachment_cache = AttachmentCache()
+
+# Built Gmail clients, reused across requests from the same session
+gmail_clients = GmailClientPool(message_cache=message_cache, mailbox_indexes=mailbox_indexes)
+
+# Tool calls from one Claude turn run concurrently on this shared, bounded pool
+TOOL_MAX_WORKERS = int(os.environ.get('TOOL_MAX_WORKERS', '8'))
+tool_executor = ThreadPoolExecutor(max_workers=TOOL_MAX_WORKERS, thread_name_prefix='tool')
+
+# Seconds a tool call may run before it is reported back to Claude as failed
+TOOL_TIMEOUT_SECONDS = float(os.environ.get('TOOL_TIMEOUT_SECONDS', '30'))
+TOOL_TIMEOUTS = {
+    "search_emails": 60,
+    "aggregate_emails": 120,
+}
+
+# Seconds a tool call may wait for a free tool thread before it is reported as failed
+# (its own timeout only starts once it runs)
+TOOL_QUEUE_TIMEOUT_SECONDS = float(os.environ.get('TOOL_QUEUE_TIMEOUT_SECONDS', '30'))
+
 # OAuth redirect URI
 OAUTH_REDIRECT_URI = 'http://localhost:5001/auth/callback'
 FRONTEND_URL = 'http://localhost:8000'
 
+# Claude model and output limit used for every turn of the agentic loop
+CLAUDE_MODEL = "claude-sonnet-4-5-20250929"
+CLAUDE_MAX_TOKENS = 4096
+
+# Static instructions; together with TOOLS this forms the cached prompt prefix
+SYSTEM_PROMPT = """You are a Gmail assistant. You answer the user's questions about their own \
+mailbox by calling the Gmail tools provided, then replying in clear, concise prose.
+
+Guidelines:
+- Use Gmail search syntax with search_emails (from:, to:, subject:, has:attachment, after:, \
+before:, newer_than:, older_than:, label:, is:unread). Combine criteria with spaces.
+- Prefer one well-targeted search over many broad ones, and keep max_results as small as the \
+question allows.
+- For listings such as "what did X send me", call search_emails with include_body set to false \
+and fetch individual bodies with get_email_content only when needed.
+- Only fetch full message content when the search results do not already answer the question.
+- To read several emails, call get_emails once with all their IDs rather than get_email_content \
+for each.
+- For counting questions ("who emails me most", "how many invoices since January"), call \
+aggregate_emails instead of searching and counting results yourself.
+- To read or summarize a conversation, call get_thread with the threadId from the search results \
+instead of calling get_email_content for each message.
+- When the user asks about attachments or wants to download files, always call list_attachments \
+for the relevant messages; the interface shows download buttons for the attachments it returns.
+- Quote exact values (numbers, dates, amounts, names) from the emails rather than paraphrasing them.
+- If nothing matches, say so and suggest a broader search instead of guessing.
+- If a tool fails with a retryable error (rate_limited, server_error, network_error), tell the user \
+Gmail is busy and the answer may be incomplete; never report it as "no emails found"."""
+
+# Most results one search_emails call returns; a search that timed out keeps paging
+# in its tool thread, so this also bounds the quota it can spend after nobody waits for it
+SEARCH_MAX_RESULTS = 100
+
+# Most sender, domain or label groups one aggregate_emails call returns
+AGGREGATE_MAX_TOP = 100
+
 # Define tools for Claude to use
 TOOLS = [
     {
@@ -61,8 +149,15 @@ TOOLS = [
                 },
                 "max_results": {
                     "type": "integer",
-                    "description": "Maximum number of results to return (default: 10)",
-                    "default": 10
+                    "description": f"Maximum number of results to return (default: 10, max: {SEARCH_MAX_RESULTS})",
+                    "default": 10,
+                    "minimum": 1,
+                    "maximum": SEARCH_MAX_RESULTS
+                },
+                "include_body": {
+                    "type": "boolean",
+                    "description": "Include each email's body (truncated) and attachment info. Set to false to get only subject, sender, recipients, date and snippet, which is much cheaper; use get_email_content afterwards for the bodies you need (default: true)",
+                    "default": True
                 }
             },
             "required": ["query"]
@@ -82,6 +177,70 @@ TOOLS = [
             "required": ["message_id"]
         }
     },
+    {
+        "name": "get_emails",
+        "description": "Get the content of several emails in one call. Returns subject, sender, date, body and attachment count for each message, with bodies shortened to share a size budget. Use this instead of calling get_email_content repeatedly.",
+        "input_schema": {
+            "type": "object",
+            "properties": {
+                "message_ids": {
+                    "type": "array",
+                    "items": {"type": "string"},
+                    "maxItems": 50,
+                    "description": "Gmail message IDs (up to 50)"
+                }
+            },
+            "required": ["message_ids"]
+        }
+    },
+    {
+        "name": "aggregate_emails",
+        "description": "Count all emails matching a Gmail search query, optionally grouped by sender, sender domain, label, day or week. Scans every match (up to max_messages) on the server and returns only the counts, so it is accurate beyond search_emails' max_results. Use it for questions like 'who emailed me most this month' or 'how many invoices since January'. Day and week buckets are in UTC.",
+        "input_schema": {
+            "type": "object",
+            "properties": {
+                "query": {
+                    "type": "string",
+                    "description": "Gmail search query, e.g. 'newer_than:30d' or 'subject:invoice after:2024/01/01' (empty for all mail)"
+                },
+                "group_by": {
+                    "type": "string",
+                    "enum": ["sender", "domain", "label", "day", "week", "none"],
+                    "description": "How to group the counts; 'none' returns only the total (default: sender)",
+                    "default": "sender"
+                },
+                "max_messages": {
+                    "type": "integer",
+                    "description": f"Maximum number of messages to scan (default: 2000, max: {AGGREGATE_MAX_MESSAGES})",
+                    "default": 2000,
+                    "minimum": 1,
+                    "maximum": AGGREGATE_MAX_MESSAGES
+                },
+                "top": {
+                    "type": "integer",
+                    "description": f"Number of largest sender, domain or label groups to return (default: 20, max: {AGGREGATE_MAX_TOP})",
+                    "default": 20,
+                    "minimum": 1,
+                    "maximum": AGGREGATE_MAX_TOP
+                }
+            },
+            "required": ["query"]
+        }
+    },
+    {
+        "name": "get_thread",
+        "description": "Get a whole email conversation (thread) in one call, oldest message first, with text repeated from earlier messages removed. Use this instead of calling get_email_content for each message when reading or summarizing a conversation. Thread IDs are returned by search_emails as threadId.",
+        "input_schema": {
+            "type": "object",
+            "properties": {
+                "thread_id": {
+                    "type": "string",
+                    "description": "Gmail thread ID"
+                }
+            },
+            "required": ["thread_id"]
+        }
+    },
     {
         "name": "list_attachments",
         "description": "List all attachments in a specific email. Returns attachment metadata including filename, size, type, and attachment IDs needed for downloading. ALWAYS use this tool when users ask about attachments or want to download files. The frontend will automatically show download buttons for the attachments.",
@@ -112,15 +271,17 @@ def require_auth(f):
         if not session_id:
             return jsonify({"error": "Not authenticated", "code": "AUTH_REQUIRED"}), 401
 
-        credentials = get_user_credentials(session_id)
-        if not credentials:
+        # One lookup per request: credentials and email come from the same session
+        session = get_session(session_id)
+        if not session:
             response = make_response(jsonify({"error": "Session expired", "code": "SESSION_EXPIRED"}), 401)
             response.set_cookie('session_id', '', expires=0)
             return response
 
         # Store credentials in request context for use by endpoint
-        request.gmail_credentials = credentials
-        request.user_email = get_user_email_from_session(session_id)
+        request.session_id = session_id
+        request.gmail_credentials = session['credentials']
+        request.user_email = session['email']
 
         return f(*args, **kwargs)
     return decorated_function
@@ -128,23 +289,76 @@ def require_auth(f):
 
 def get_gmail_service():
     """Get GmailService for the current authenticated user"""
-    return GmailService.from_credentials(request.gmail_credentials)
+    return gmail_clients.get(request.session_id, request.gmail_credentials, request.user_email)
+
+
+class ToolInputError(ValueError):
+    """A tool was called with arguments it can't use"""
+
+    def to_dict(self):
+        """Typed error result, shaped like GmailAPIError.to_dict"""
+        return {'error': str(self), 'kind': 'invalid_input', 'retryable': False}
 
 
+def int_input(tool_input, name, default, low, high):
+    """
+    Read an integer tool argument, clamped to [low, high]
+
+    Raises:
+        ToolInputError: If the value is not a whole number
+    """
+    value = tool_input.get(name, default)
+    if isinstance(value, bool):
+        raise ToolInputError(f"{name} must be an integer")
+    try:
+        number = int(value)
+    except (TypeError, ValueError):
+        raise ToolInputError(f"{name} must be an integer")
+    if number != value and str(number) != str(value).strip():
+        # 2.5 or "2.5": don't guess what was meant
+        raise ToolInputError(f"{name} must be an integer")
+    return min(max(number, low), high)
+
+
+@timed_tool
+@traced('tool:{tool_name}')
 def execute_tool(gmail_service, tool_name, tool_input):
     """Execute a Gmail tool and return results"""
 
     if tool_name == "search_emails":
         query = tool_input["query"]
-        max_results = tool_input.get("max_results", 10)
-        results = gmail_service.search_emails(query, max_results)
-        return results
+        max_results = int_input(tool_input, "max_results", 10, 1, SEARCH_MAX_RESULTS)
+        include_body = tool_input.get("include_body", True)
+        errors = {}
+        results = gmail_service.search_emails(query, max_results, include_body, errors)
+        # Matches that could not be read are listed with a typed error, as in get_emails
+        return results + [dict({'id': message_id}, **error.to_dict()) for message_id, error in errors.items()]
 
     elif tool_name == "get_email_content":
         message_id = tool_input["message_id"]
         content = gmail_service.get_email_content(message_id)
         return content
 
+    elif tool_name == "get_emails":
+        message_ids = tool_input.get("message_ids")
+        if not isinstance(message_ids, list) or not all(isinstance(message_id, str) for message_id in message_ids):
+            raise ToolInputError("message_ids must be a list of message ID strings")
+        emails = gmail_service.get_emails(message_ids)
+        return emails
+
+    elif tool_name == "aggregate_emails":
+        query = tool_input.get("query", "")
+        group_by = tool_input.get("group_by", "sender")
+        max_messages = int_input(tool_input, "max_messages", 2000, 1, AGGREGATE_MAX_MESSAGES)
+        top = int_input(tool_input, "top", 20, 1, AGGREGATE_MAX_TOP)
+        aggregate = gmail_service.aggregate_emails(query, group_by, max_messages, top)
+        return aggregate
+
+    elif tool_name == "get_thread":
+        thread_id = tool_input["thread_id"]
+        thread = gmail_service.get_thread(thread_id)
+        return thread
+
     elif tool_name == "list_attachments":
         message_id = tool_input["message_id"]
         attachments = gmail_service.list_attachments(message_id)
@@ -154,6 +368,326 @@ def execute_tool(gmail_service, tool_name, tool_input):
         return {"error": f"Unknown tool: {tool_name}"}
 
 
+def run_pooled_tool(running_since, index, gmail_service, tool_name, tool_input):
+    """Tool-thread entry point: note when the call really starts, then run it"""
+    running_since[index] = time.monotonic()
+    return execute_tool(gmail_service, tool_name, tool_input)
+
+
+def iter_tools(gmail_service, tool_blocks):
+    """
+    Execute the tool_use blocks of one Claude turn concurrently
+
+    A tool's timeout counts from when a tool thread picks it up, not from
+    when it was queued behind other requests' tools. A call still queued
+    after TOOL_QUEUE_TIMEOUT_SECONDS is cancelled; a running call that times
+    out can't be stopped, so it finishes in the background (each Gmail
+    request is bounded by GMAIL_HTTP_TIMEOUT_SECONDS).
+
+    Args:
+        gmail_service: GmailService for the current user
+        tool_blocks: tool_use content blocks from Claude's response
+
+    Yields:
+        (index, block, result, error, elapsed) tuples as tools finish, where
+        error is a message string if the tool failed or timed out, else None
+    """
+    started = time.monotonic()
+
+    # Key: block index -> Value: when a tool thread started it (written by that thread)
+    running_since = {}
+
+    def deadline(index, block):
+        if index in running_since:
+            return running_since[index] + TOOL_TIMEOUTS.get(block.name, TOOL_TIMEOUT_SECONDS)
+        return started + TOOL_QUEUE_TIMEOUT_SECONDS
+
+    # Key: future -> Value: (index, block)
+    pending = {}
+    for index, block in enumerate(tool_blocks):
+        # bind() carries the request's trace into the tool thread
+        future = tool_executor.submit(
+            bind(run_pooled_tool), running_since, index, gmail_service, block.name, block.input
+        )
+        pending[future] = (index, block)
+
+    while pending:
+        next_deadline = min(deadline(index, block) for index, block in pending.values())
+        done, _ = wait(pending, timeout=max(0, next_deadline - time.monotonic()), return_when=FIRST_COMPLETED)
+
+        for future in done:
+            index, block = pending.pop(future)
+            elapsed = time.monotonic() - started
+            try:
+                yield index, block, future.result(), None, elapsed
+            except (GmailAPIError, ToolInputError) as e:
+                # Typed, so Claude can tell "rate limited" from "no emails found"
+                yield index, block, None, json.dumps(dict(e.to_dict(), tool=block.name)), elapsed
+            except Exception as e:
+                yield index, block, None, f"{block.name} failed: {e}", elapsed
+
+        now = time.monotonic()
+        for future, (index, block) in list(pending.items()):
+            if deadline(index, block) > now:
+                continue
+            if index in running_since:
+                # Running: report the timeout and let it finish on its own
+                del pending[future]
+                count_error('tool', 'timeout')
+                timeout = TOOL_TIMEOUTS.get(block.name, TOOL_TIMEOUT_SECONDS)
+                yield index, block, None, f"{block.name} timed out after {timeout:g}s", now - started
+            elif future.cancel():
+                # Never started: every tool thread was busy the whole time
+                del pending[future]
+                count_error('tool', 'queue_timeout')
+                yield index, block, None, (
+                    f"{block.name} could not start within {TOOL_QUEUE_TIMEOUT_SECONDS:g}s (server busy)"
+                ), now - started
+            # else it started just now; its own deadline applies from the next pass
+
+
+def claude_request(messages):
+    """
+    Build the messages.create / messages.stream arguments for one loop iteration
+
+    Tools are rendered before the system prompt, so the breakpoint on the
+    system prompt caches both. A second breakpoint on the newest message lets
+    the next iteration read the whole conversation so far from the cache.
+
+    Args:
+        messages: Conversation so far
+
+    Returns:
+        Dict of keyword arguments
+    """
+    return {
+        "model": CLAUDE_MODEL,
+        "max_tokens": CLAUDE_MAX_TOKENS,
+        "system": [{"type": "text", "text": SYSTEM_PROMPT, "cache_control": {"type": "ephemeral"}}],
+        "tools": TOOLS,
+        "messages": with_cache_breakpoint(messages)
+    }
+
+
+def with_cache_breakpoint(messages):
+    """Copy of messages with a cache_control marker on the last content block"""
+    last = messages[-1]
+    content = last["content"]
+    if isinstance(content, str):
+        content = [{"type": "text", "text": content}]
+    else:
+        content = list(content)
+
+    # Only the request copy is marked, so earlier breakpoints don't pile up
+    # past the API limit of four
+    content[-1] = dict(content[-1], cache_control={"type": "ephemeral"})
+    return messages[:-1] + [{"role": last["role"], "content": content}]
+
+
+# Token counters reported per request
+USAGE_FIELDS = ("input_tokens", "output_tokens", "cache_creation_input_tokens", "cache_read_input_tokens")
+
+
+def new_usage():
+    """Empty token counters for one chat request"""
+    return dict.fromkeys(USAGE_FIELDS, 0)
+
+
+def add_usage(totals, usage):
+    """Add one response.usage to the request totals"""
+    for field in USAGE_FIELDS:
+        totals[field] += getattr(usage, field, None) or 0
+
+
+def usage_attrs(usage):
+    """One response.usage as span attributes"""
+    return {field: getattr(usage, field, None) or 0 for field in USAGE_FIELDS}
+
+
+def log_usage(totals, iterations):
+    """Print the token usage of a finished chat request"""
+    print(
+        f"Token usage over {iterations} Claude call(s): "
+        f"input={totals['input_tokens']} "
+        f"cache_read={totals['cache_read_input_tokens']} "
+        f"cache_write={totals['cache_creation_input_tokens']} "
+        f"output={totals['output_tokens']}"
+    )
+
+
+def run_tools(gmail_service, tool_blocks):
+    """
+    Execute the tool_use blocks of one Claude turn concurrently
+
+    Args:
+        gmail_service: GmailService for the current user
+        tool_blocks: tool_use content blocks from Claude's response
+
+    Returns:
+        List of (block, result, error) tuples in block order
+    """
+    outcomes = sorted(iter_tools(gmail_service, tool_blocks), key=lambda outcome: outcome[0])
+    return [(block, result, error) for _, block, result, error, _ in outcomes]
+
+
+def tool_result_block(block, result, error):
+    """Build the tool_result content block sent back to Claude"""
+    if error:
+        # Report the failure to Claude instead of failing the request
+        print(f"Tool error: {error}")
+        return {
+            "type": "tool_result",
+            "tool_use_id": block.id,
+            "content": error,
+            "is_error": True
+        }
+
+    return {
+        "type": "tool_result",
+        "tool_use_id": block.id,
+        "content": json.dumps(result)
+    }
+
+
+def collect_attachments(block, result):
+    """
+    Get the attachments found by a list_attachments call, in the shape the frontend expects
+
+    Returns:
+        List of attachment dicts (empty for any other tool)
+    """
+    if block.name != "list_attachments" or not isinstance(result, list):
+        return []
+
+    return [
+        {
+            "filename": att["filename"],
+            "message_id": block.input["message_id"],
+            "attachment_id": att["attachmentId"],
+            "mimeType": att["mimeType"],
+            "size": att["size"]
+        }
+        for att in result
+    ]
+
+
+def sse_event(event, data):
+    """Format one server-sent event"""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+def parse_byte_range(header, size):
+    """
+    Parse a single-range Range header ("bytes=100-", "bytes=100-199" or "bytes=-500")
+
+    Args:
+        header: Range header value (may be None)
+        size: File size in bytes (None if unknown)
+
+    Returns:
+        (start, end) with end exclusive, or None to send the whole file (no
+        header, unknown size, several ranges or a malformed header)
+
+    Raises:
+        ValueError: If the range starts past the end of the file (answer 416)
+    """
+    if not header or size is None:
+        return None
+    match = re.fullmatch(r'\s*bytes\s*=\s*(\d*)\s*-\s*(\d*)\s*', header)
+    if not match or match.groups() == ('', ''):
+        return None
+
+    first, last = match.groups()
+    if first:
+        start = int(first)
+        if last and int(last) < start:
+            return None
+        end = min(int(last) + 1, size) if last else size
+    else:
+        # Suffix range: the last N bytes
+        start = max(size - int(last), 0)
+        end = size
+
+    if start >= end:
+        raise ValueError(f"Range {header!r} not satisfiable for {size} bytes")
+    return start, end
+
+
+def gmail_error_response(error):
+    """JSON error response for a Gmail failure, with its HTTP status and Retry-After"""
+    response = jsonify(error.to_dict())
+    response.status_code = error.http_status
+    if error.retry_after is not None:
+        response.headers['Retry-After'] = str(int(error.retry_after + 0.999))
+    return response
+
+
+def parse_bundle_request(data):
+    """
+    Validate a ZIP bundle request body
+
+    Args:
+        data: {"attachments": [{"message_id", "attachment_id", "filename"}, ...], "filename": optional}
+
+    Returns:
+        (entries, archive filename)
+
+    Raises:
+        ValueError: With a message for the client if the request is invalid
+    """
+    entries = data.get('attachments') if isinstance(data, dict) else None
+    if not isinstance(entries, list) or not entries:
+        raise ValueError("Missing required parameters")
+    if len(entries) > BUNDLE_MAX_FILES:
+        raise ValueError(f"At most {BUNDLE_MAX_FILES} attachments per bundle")
+
+    keys = ('message_id', 'attachment_id', 'filename')
+    for entry in entries:
+        if not isinstance(entry, dict) or not all(isinstance(entry.get(key), str) and entry[key] for key in keys):
+            raise ValueError("Each attachment needs message_id, attachment_id and filename")
+
+    filename = data.get('filename') or 'attachments.zip'
+    if not isinstance(filename, str):
+        raise ValueError("filename must be a string")
+    if not filename.lower().endswith('.zip'):
+        filename += '.zip'
+    return [{key: entry[key] for key in keys} for entry in entries], filename
+
+
+def attachment_headers(filename, size, byte_range):
+    """
+    Status and headers for a streamed attachment download
+
+    Args:
+        filename: Download filename
+        size: Decoded size in bytes (None if unknown)
+        byte_range: (start, end) from parse_byte_range, or None for the whole file
+
+    Returns:
+        (status, headers dict)
+    """
+    try:
+        filename.encode('ascii')
+        # Quotes and backslashes would break out of the quoted-string
+        disposition = 'attachment; filename="{}"'.format(filename.replace('\\', '').replace('"', ''))
+    except UnicodeEncodeError:
+        disposition = f"attachment; filename*=UTF-8''{urllib.parse.quote(filename, safe='')}"
+
+    headers = {
+        'Content-Type': mimetypes.guess_type(filename)[0] or 'application/octet-stream',
+        'Content-Disposition': disposition,
+        'Accept-Ranges': 'bytes' if size is not None else 'none'
+    }
+    if byte_range is not None:
+        start, end = byte_range
+        headers['Content-Range'] = f"bytes {start}-{end - 1}/{size}"
+        headers['Content-Length'] = str(end - start)
+        return 206, headers
+    if size is not None:
+        headers['Content-Length'] = str(size)
+    return 200, headers
+
+
 # ============== Auth Endpoints ==============
 
 @app.route('/auth/login', methods=['GET', 'OPTIONS'])
@@ -260,6 +794,7 @@ def auth_logout():
 
     if session_id:
         invalidate_session(session_id)
+        gmail_clients.discard(session_id)
 
     response = make_response(jsonify({"success": True}))
     response.set_cookie('session_id', '', expires=0)
@@ -279,11 +814,17 @@ def chat():
     if request.method == 'OPTIONS':
         return '', 200
 
+    started = time.monotonic()
+    outcome = 'error'
+    iterations = 0
+    trace = start_trace('chat', requested_format(request.headers.get(TRACE_HEADER)))
+
     try:
         data = request.json
         user_message = data.get('message', '')
 
         if not user_message:
+            outcome = 'invalid'
             return jsonify({"error": "No message provided"}), 400
 
         # Get Gmail service for current user
@@ -295,53 +836,49 @@ def chat():
         # Track all attachments found during the conversation
         all_attachments = []
 
+        # Token usage across all loop iterations
+        usage = new_usage()
+
+        # Keeps tool results within the context budget as the conversation grows
+        governor = ResultGovernor(reserve_tokens=CLAUDE_MAX_TOKENS)
+
         # Agentic loop: Keep calling Claude until it returns a final response
         while True:
-            response = anthropic_client.messages.create(
-                model="claude-sonnet-4-5-20250929",
-                max_tokens=4096,
-                tools=TOOLS,
-                messages=messages
-            )
+            call_started = time.monotonic()
+            with span('claude', iteration=iterations + 1) as claude_span:
+                response = anthropic_client.messages.create(**claude_request(messages))
+                claude_span.set(stop_reason=response.stop_reason, **usage_attrs(response.usage))
+            observe_claude_call('chat', time.monotonic() - call_started, response.usage)
+            add_usage(usage, response.usage)
+            governor.observe(response.usage)
+            iterations += 1
 
             # Check if Claude wants to use tools
             if response.stop_reason == "tool_use":
                 # Extract tool use blocks
-                tool_results = []
+                tool_blocks = [block for block in response.content if block.type == "tool_use"]
 
-                for block in response.content:
-                    if block.type == "tool_use":
-                        tool_name = block.name
-                        tool_input = block.input
-
-                        print(f"Claude is using tool: {tool_name}")
-                        print(f"Tool input: {json.dumps(tool_input, indent=2)}")
-
-                        # Execute the tool
-                        result = execute_tool(gmail_service, tool_name, tool_input)
-
-                        # If listing attachments, collect them for the frontend
-                        if tool_name == "list_attachments" and isinstance(result, list):
-                            for att in result:
-                                all_attachments.append({
-                                    "filename": att["filename"],
-                                    "message_id": tool_input["message_id"],
-                                    "attachment_id": att["attachmentId"],
-                                    "mimeType": att["mimeType"],
-                                    "size": att["size"]
-                                })
-
-                        tool_results.append({
-                            "type": "tool_result",
-                            "tool_use_id": block.id,
-                            "content": json.dumps(result)
-                        })
+                for block in tool_blocks:
+                    print(f"Claude is using tool: {block.name}")
+                    print(f"Tool input: {json.dumps(block.input, indent=2)}")
+
+                # Execute the tools concurrently, results come back in block order
+                outcomes = run_tools(gmail_service, tool_blocks)
+
+                # If listing attachments, collect them for the frontend
+                for block, result, error in outcomes:
+                    all_attachments.extend(collect_attachments(block, result))
+
+                tool_results = [tool_result_block(*outcome) for outcome in governor.fit(outcomes)]
 
                 # Add assistant's response and tool results to conversation
                 messages.append({"role": "assistant", "content": response.content})
                 messages.append({"role": "user", "content": tool_results})
 
             elif response.stop_reason == "end_turn":
+                log_usage(usage, iterations)
+                outcome = 'ok'
+
                 # Claude has finished - extract final text response
                 final_response = ""
 
@@ -351,31 +888,156 @@ def chat():
 
                 return jsonify({
                     "response": final_response,
-                    "attachments": all_attachments
+                    "attachments": all_attachments,
+                    **trace_fields(trace)
                 })
 
             else:
                 # Unexpected stop reason
+                log_usage(usage, iterations)
+                outcome = 'unexpected_stop'
                 return jsonify({
-                    "error": f"Unexpected stop reason: {response.stop_reason}"
+                    "error": f"Unexpected stop reason: {response.stop_reason}",
+                    **trace_fields(trace)
                 }), 500
 
     except Exception as e:
         print(f"Error in chat endpoint: {str(e)}")
-        return jsonify({"error": str(e)}), 500
+        count_error('claude' if isinstance(e, anthropic.APIError) else 'chat', e)
+        return jsonify({"error": str(e), **trace_fields(trace)}), 500
+
+    finally:
+        observe_chat('chat', outcome, time.monotonic() - started, iterations)
+        finish_trace(trace)
 
 
-@app.route('/api/download-attachment', methods=['POST', 'OPTIONS'])
+@app.route('/api/chat/stream', methods=['POST', 'OPTIONS'])
+@require_auth
+def chat_stream():
+    """
+    Streaming chat endpoint
+    Same agentic loop as /api/chat, but pushes server-sent events as it goes:
+    text deltas, tool start/finish with timings, attachments and a final done event
+    """
+    if request.method == 'OPTIONS':
+        return '', 200
+
+    data = request.json or {}
+    user_message = data.get('message', '')
+
+    if not user_message:
+        return jsonify({"error": "No message provided"}), 400
+
+    # Get Gmail service for current user (needs the request context)
+    gmail_service = get_gmail_service()
+    trace_format = requested_format(request.headers.get(TRACE_HEADER))
+
+    def generate():
+        # Started here so the trace lives in the context the generator runs in
+        trace = start_trace('chat_stream', trace_format)
+        messages = [{"role": "user", "content": user_message}]
+        started = time.monotonic()
+        usage = new_usage()
+        iterations = 0
+        governor = ResultGovernor(reserve_tokens=CLAUDE_MAX_TOKENS)
+
+        # Stays 'cancelled' if the client disconnects mid-stream
+        outcome = 'cancelled'
+
+        try:
+            while True:
+                call_started = time.monotonic()
+                with span('claude', iteration=iterations + 1) as claude_span:
+                    with anthropic_client.messages.stream(**claude_request(messages)) as stream:
+                        for text in stream.text_stream:
+                            yield sse_event("text", {"text": text})
+                        response = stream.get_final_message()
+                    claude_span.set(stop_reason=response.stop_reason, **usage_attrs(response.usage))
+                observe_claude_call('chat_stream', time.monotonic() - call_started, response.usage)
+                add_usage(usage, response.usage)
+                governor.observe(response.usage)
+                iterations += 1
+
+                if response.stop_reason == "tool_use":
+                    tool_blocks = [block for block in response.content if block.type == "tool_use"]
+
+                    for block in tool_blocks:
+                        print(f"Claude is using tool: {block.name}")
+                        yield sse_event("tool_started", {"id": block.id, "name": block.name, "input": block.input})
+
+                    # Report each tool as soon as it finishes, but reply to Claude in block order
+                    outcomes = []
+                    for index, block, result, error, elapsed in iter_tools(gmail_service, tool_blocks):
+                        yield sse_event("tool_finished", {
+                            "id": block.id,
+                            "name": block.name,
+                            "duration_ms": round(elapsed * 1000),
+                            "error": error
+                        })
+                        attachments = collect_attachments(block, result)
+                        if attachments:
+                            yield sse_event("attachments", {"attachments": attachments})
+                        outcomes.append((index, block, result, error))
+
+                    outcomes = [outcome[1:] for outcome in sorted(outcomes, key=lambda o: o[0])]
+                    tool_results = [tool_result_block(*outcome) for outcome in governor.fit(outcomes)]
+                    messages.append({"role": "assistant", "content": response.content})
+                    messages.append({"role": "user", "content": tool_results})
+
+                elif response.stop_reason == "end_turn":
+                    log_usage(usage, iterations)
+                    outcome = 'ok'
+                    if trace_format:
+                        yield sse_event("trace", trace.export())
+                    yield sse_event("done", {"duration_ms": round((time.monotonic() - started) * 1000)})
+                    return
+
+                else:
+                    log_usage(usage, iterations)
+                    outcome = 'unexpected_stop'
+                    yield sse_event("error", {
+                        "error": f"Unexpected stop reason: {response.stop_reason}",
+                        **trace_fields(trace)
+                    })
+                    return
+
+        except Exception as e:
+            print(f"Error in chat stream: {str(e)}")
+            outcome = 'error'
+            count_error('claude' if isinstance(e, anthropic.APIError) else 'chat', e)
+            yield sse_event("error", {"error": str(e), **trace_fields(trace)})
+
+        finally:
+            observe_chat('chat_stream', outcome, time.monotonic() - started, iterations)
+            finish_trace(trace)
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype='text/event-stream',
+        headers={
+            'Cache-Control': 'no-cache',
+            # Tell nginx not to buffer the stream
+            'X-Accel-Buffering': 'no'
+        }
+    )
+
+
+@app.route('/api/download-attachment', methods=['GET', 'POST', 'OPTIONS'])
 @require_auth
 def download_attachment():
     """
     Download an attachment from Gmail
+
+    Cached attachments are sent from disk (sendfile under gunicorn); others
+    are streamed from Gmail as they are decoded and cached on the way.
+    Content-Length and Range are supported so interrupted downloads can
+    resume. Parameters come from the JSON body (POST) or the query string (GET).
     """
     if request.method == 'OPTIONS':
         return '', 200
 
     try:
-        data = request.json
+        data = request.json if request.method == 'POST' else request.args
         message_id = data.get('message_id')
         attachment_id = data.get('attachment_id')
         filename = data.get('filename')
@@ -383,22 +1045,99 @@ def download_attachment():
         if not all([message_id, attachment_id, filename]):
             return jsonify({"error": "Missing required parameters"}), 400
 
+        cached_path = attachment_cache.get(request.user_email, message_id, attachment_id)
+        if cached_path:
+            try:
+                return send_file(cached_path, as_attachment=True, download_name=filename, conditional=True)
+            except FileNotFoundError:
+                # Evicted since the lookup; fetch it again
+                pass
+
         # Get Gmail service for current user
         gmail_service = get_gmail_service()
 
-        # Download attachment
-        file_path = gmail_service.download_attachment(message_id, attachment_id, filename)
+        stream = gmail_service.open_attachment(message_id, attachment_id)
+
+        try:
+            byte_range = parse_byte_range(request.headers.get('Range'), stream.size)
+        except ValueError:
+            stream.close()
+            return Response(status=416, headers={'Content-Range': f"bytes */{stream.size}"})
 
-        if file_path and os.path.exists(file_path):
-            return send_file(file_path, as_attachment=True, download_name=filename)
+        status, headers = attachment_headers(filename, stream.size, byte_range)
+        if byte_range is None:
+            chunks = attachment_cache.store(
+                request.user_email, message_id, attachment_id, stream.iter_bytes(), stream.size
+            )
         else:
-            return jsonify({"error": "Failed to download attachment"}), 500
+            # Only whole files are cached
+            chunks = stream.iter_bytes(*byte_range)
+        response = Response(chunks, status=status, headers=headers)
+        response.call_on_close(stream.close)
+        return response
+
+    except GmailAPIError as e:
+        return gmail_error_response(e)
 
     except Exception as e:
         print(f"Error downloading attachment: {str(e)}")
         return jsonify({"error": str(e)}), 500
 
 
+@app.route('/api/download-attachments', methods=['POST', 'OPTIONS'])
+@require_auth
+def download_attachments():
+    """
+    Download several attachments as one ZIP archive, streamed as each file arrives
+    """
+    if request.method == 'OPTIONS':
+        return '', 200
+
+    try:
+        entries, filename = parse_bundle_request(request.get_json(silent=True))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    try:
+        gmail_service = get_gmail_service()
+        chunks = stream_bundle(gmail_service, attachment_cache, request.user_email, entries)
+
+        # The archive size isn't known up front, so no Content-Length or Range
+        _, headers = attachment_headers(filename, None, None)
+        return Response(chunks, headers=headers)
+
+    except Exception as e:
+        print(f"Error building attachment bundle: {str(e)}")
+        return jsonify({"error": str(e)}), 500
+
+
+@app.route('/api/stats', methods=['GET', 'OPTIONS'])
+@require_auth
+def stats():
+    """Cache, client pool and session table counters for this worker process"""
+    if request.method == 'OPTIONS':
+        return '', 200
+    return jsonify({
+        "message_cache": message_cache.stats(),
+        "attachment_cache": attachment_cache.stats(),
+        "gmail_scheduler": gmail_scheduler.stats(),
+        "gmail_clients": len(gmail_clients),
+        "sessions": get_session_stats(),
+        "mailbox_index": mailbox_indexes.get(request.user_email).stats() if mailbox_indexes else None
+    })
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """
+    Prometheus scrape endpoint, summed over all gunicorn workers
+
+    Not proxied by nginx; scrape it on the loopback address.
+    """
+    body, content_type = render_metrics()
+    return Response(body, content_type=content_type)
+
+
 @app.route('/api/health', methods=['GET', 'OPTIONS'])
 def health():
     """Health check endpoint"""
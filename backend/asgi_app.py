@@ -0,0 +1,646 @@
+"""
+ASGI Backend for Gmail Chat Application
+Async serving mode with the same routes as app.py, for running under uvicorn:
+
+    uvicorn asgi_app:app --host 127.0.0.1 --port 5001
+
+Claude calls use anthropic.AsyncAnthropic, and the blocking Gmail and auth
+calls run on a bounded thread pool, so one process can keep hundreds of
+chats in flight while they wait on I/O.
+"""
+
+import os
+import json
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial, wraps
+
+import anthropic
+from starlette.applications import Starlette
+from starlette.middleware import Middleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.background import BackgroundTask
+from starlette.responses import FileResponse, JSONResponse, RedirectResponse, Response, StreamingResponse
+from starlette.routing import Route
+
+from app import (
+    TOOL_TIMEOUTS,
+    TOOL_TIMEOUT_SECONDS,
+    TOOL_QUEUE_TIMEOUT_SECONDS,
+    OAUTH_REDIRECT_URI,
+    FRONTEND_URL,
+    CLAUDE_MAX_TOKENS,
+    message_cache,
+    attachment_cache,
+    mailbox_indexes,
+    gmail_clients,
+    ToolInputError,
+    execute_tool,
+    claude_request,
+    new_usage,
+    add_usage,
+    log_usage,
+    usage_attrs,
+    tool_result_block,
+    collect_attachments,
+    sse_event,
+    parse_byte_range,
+    parse_bundle_request,
+    attachment_headers
+)
+from gmail_scheduler import GmailAPIError, gmail_scheduler
+from metrics import count_error, observe_chat, observe_claude_call, render as render_metrics
+from attachment_bundle import stream_bundle
+from result_governor import ResultGovernor
+from tracing import TRACE_HEADER, bind, finish_trace, requested_format, span, start_trace, trace_fields
+from auth import (
+    create_oauth_flow,
+    complete_oauth_flow,
+    get_session,
+    get_session_stats,
+    get_user_email_from_session,
+    invalidate_session,
+    verify_state
+)
+
+# Gmail and OAuth client libraries are blocking, so they run on this pool
+GMAIL_THREADS = int(os.environ.get('ASGI_GMAIL_THREADS', '64'))
+gmail_executor = ThreadPoolExecutor(max_workers=GMAIL_THREADS, thread_name_prefix='gmail')
+
+# Async Anthropic client, shares connections across all in-flight chats
+async_anthropic_client = anthropic.AsyncAnthropic(api_key=os.environ.get("ANTHROPIC_API_KEY"))
+
+
+async def run_blocking(fn, *args, **kwargs):
+    """Run a blocking call on the Gmail thread pool without blocking the event loop"""
+    loop = asyncio.get_running_loop()
+    # run_in_executor doesn't carry contextvars over, so the request's trace is bound explicitly
+    return await loop.run_in_executor(gmail_executor, partial(bind(fn), *args, **kwargs))
+
+
+def require_auth(endpoint):
+    """Decorator to require authentication for endpoints"""
+    @wraps(endpoint)
+    async def decorated_endpoint(request):
+        # Allow OPTIONS requests through for CORS preflight
+        if request.method == 'OPTIONS':
+            return await endpoint(request)
+
+        session_id = request.cookies.get('session_id')
+
+        if not session_id:
+            return JSONResponse({"error": "Not authenticated", "code": "AUTH_REQUIRED"}, status_code=401)
+
+        # One lookup per request: credentials and email come from the same session
+        session = await run_blocking(get_session, session_id)
+        if not session:
+            response = JSONResponse({"error": "Session expired", "code": "SESSION_EXPIRED"}, status_code=401)
+            response.delete_cookie('session_id')
+            return response
+
+        # Store credentials in request state for use by endpoint
+        request.state.session_id = session_id
+        request.state.gmail_credentials = session['credentials']
+        request.state.user_email = session['email']
+
+        return await endpoint(request)
+    return decorated_endpoint
+
+
+async def get_gmail_service(request):
+    """Get GmailService for the current authenticated user"""
+    return await run_blocking(
+        gmail_clients.get,
+        request.state.session_id,
+        request.state.gmail_credentials,
+        request.state.user_email
+    )
+
+
+async def read_json(request):
+    """
+    Parse the request body as a JSON object
+
+    Raises:
+        ValueError: If the body is not valid JSON or not an object
+    """
+    try:
+        data = await request.json()
+    except ValueError:
+        raise ValueError("Request body is not valid JSON")
+    if not isinstance(data, dict):
+        raise ValueError("Request body must be a JSON object")
+    return data
+
+
+async def run_tool(gmail_service, block):
+    """
+    Execute one tool_use block with its timeout
+
+    As in the Flask app, the timeout counts from when a Gmail thread picks
+    the call up; a call that can't start within TOOL_QUEUE_TIMEOUT_SECONDS
+    is cancelled, and a running one that times out finishes in the background.
+
+    Returns:
+        (block, result, error, elapsed) tuple, error is None on success
+    """
+    started = time.monotonic()
+    timeout = TOOL_TIMEOUTS.get(block.name, TOOL_TIMEOUT_SECONDS)
+    loop = asyncio.get_running_loop()
+    running = asyncio.Event()
+
+    def call():
+        loop.call_soon_threadsafe(running.set)
+        return execute_tool(gmail_service, block.name, block.input)
+
+    task = asyncio.ensure_future(run_blocking(call))
+    # A timed-out call's outcome is never awaited; retrieve it so asyncio doesn't log it
+    task.add_done_callback(lambda done: done.cancelled() or done.exception())
+    try:
+        waiter = asyncio.ensure_future(running.wait())
+        await asyncio.wait({task, waiter}, timeout=TOOL_QUEUE_TIMEOUT_SECONDS, return_when=asyncio.FIRST_COMPLETED)
+        waiter.cancel()
+        if not running.is_set() and not task.done():
+            # Not started yet, so this also cancels the executor job
+            task.cancel()
+            count_error('tool', 'queue_timeout')
+            return block, None, (
+                f"{block.name} could not start within {TOOL_QUEUE_TIMEOUT_SECONDS:g}s (server busy)"
+            ), time.monotonic() - started
+
+        # shield: a running thread can't be stopped, so don't cancel its future on timeout
+        result = await asyncio.wait_for(asyncio.shield(task), timeout)
+        return block, result, None, time.monotonic() - started
+    except asyncio.TimeoutError:
+        count_error('tool', 'timeout')
+        return block, None, f"{block.name} timed out after {timeout:g}s", time.monotonic() - started
+    except (GmailAPIError, ToolInputError) as e:
+        # Typed, so Claude can tell "rate limited" from "no emails found"
+        return block, None, json.dumps(dict(e.to_dict(), tool=block.name)), time.monotonic() - started
+    except Exception as e:
+        return block, None, f"{block.name} failed: {e}", time.monotonic() - started
+
+
+# ============== Auth Endpoints ==============
+
+async def auth_login(request):
+    """Initiate OAuth flow - returns authorization URL"""
+    if request.method == 'OPTIONS':
+        return Response(status_code=200)
+
+    try:
+        auth_url, state = await run_blocking(create_oauth_flow, OAUTH_REDIRECT_URI)
+        return JSONResponse({
+            "auth_url": auth_url,
+            "state": state
+        })
+    except FileNotFoundError as e:
+        return JSONResponse({"error": str(e)}, status_code=500)
+    except Exception as e:
+        print(f"Error initiating OAuth: {e}")
+        return JSONResponse({"error": "Failed to initiate login"}, status_code=500)
+
+
+async def auth_callback(request):
+    """Handle OAuth callback from Google"""
+    try:
+        # Get the full callback URL - fix for HTTP vs HTTPS mismatch
+        authorization_response = str(request.url)
+        if authorization_response.startswith('https://localhost'):
+            authorization_response = authorization_response.replace('https://', 'http://', 1)
+
+        # Verify state parameter
+        state = request.query_params.get('state')
+        if not await run_blocking(verify_state, state):
+            print("State verification failed")
+            return RedirectResponse(f"{FRONTEND_URL}/login.html?error=invalid_state", status_code=302)
+
+        # Check for errors from Google
+        error = request.query_params.get('error')
+        if error:
+            print(f"Google returned error: {error}")
+            return RedirectResponse(f"{FRONTEND_URL}/login.html?error={error}", status_code=302)
+
+        # Complete the OAuth flow
+        session_id, user_email = await run_blocking(complete_oauth_flow, authorization_response, OAUTH_REDIRECT_URI)
+
+        # Create response with redirect to frontend and set session cookie
+        response = RedirectResponse(f"{FRONTEND_URL}/index.html", status_code=302)
+        response.set_cookie(
+            'session_id',
+            session_id,
+            httponly=True,
+            secure=False,  # Set to True in production with HTTPS
+            samesite='lax',
+            max_age=86400 * 7  # 7 days
+        )
+
+        print(f"User logged in: {user_email}")
+        return response
+
+    except Exception as e:
+        import traceback
+        print(f"OAuth callback error: {e}")
+        print(traceback.format_exc())
+        return RedirectResponse(f"{FRONTEND_URL}/login.html?error=auth_failed", status_code=302)
+
+
+async def auth_user(request):
+    """Get current user info"""
+    if request.method == 'OPTIONS':
+        return Response(status_code=200)
+
+    session_id = request.cookies.get('session_id')
+
+    if not session_id:
+        return JSONResponse({"authenticated": False})
+
+    email = await run_blocking(get_user_email_from_session, session_id)
+
+    if not email:
+        response = JSONResponse({"authenticated": False})
+        response.delete_cookie('session_id')
+        return response
+
+    return JSONResponse({
+        "authenticated": True,
+        "email": email
+    })
+
+
+async def auth_logout(request):
+    """Logout - invalidate session"""
+    if request.method == 'OPTIONS':
+        return Response(status_code=200)
+
+    session_id = request.cookies.get('session_id')
+
+    if session_id:
+        await run_blocking(invalidate_session, session_id)
+        gmail_clients.discard(session_id)
+
+    response = JSONResponse({"success": True})
+    response.delete_cookie('session_id')
+
+    return response
+
+
+# ============== API Endpoints ==============
+
+@require_auth
+async def chat(request):
+    """
+    Main chat endpoint
+    Accepts user queries and returns Claude's response with Gmail data
+    """
+    if request.method == 'OPTIONS':
+        return Response(status_code=200)
+
+    started = time.monotonic()
+    outcome = 'error'
+    iterations = 0
+    trace = start_trace('chat', requested_format(request.headers.get(TRACE_HEADER)))
+
+    try:
+        try:
+            data = await read_json(request)
+        except ValueError as e:
+            outcome = 'invalid'
+            return JSONResponse({"error": str(e)}, status_code=400)
+        user_message = data.get('message', '')
+
+        if not user_message:
+            outcome = 'invalid'
+            return JSONResponse({"error": "No message provided"}, status_code=400)
+
+        gmail_service = await get_gmail_service(request)
+
+        messages = [{"role": "user", "content": user_message}]
+        all_attachments = []
+        usage = new_usage()
+        governor = ResultGovernor(reserve_tokens=CLAUDE_MAX_TOKENS)
+
+        # Agentic loop: Keep calling Claude until it returns a final response
+        while True:
+            call_started = time.monotonic()
+            with span('claude', iteration=iterations + 1) as claude_span:
+                response = await async_anthropic_client.messages.create(**claude_request(messages))
+                claude_span.set(stop_reason=response.stop_reason, **usage_attrs(response.usage))
+            observe_claude_call('chat', time.monotonic() - call_started, response.usage)
+            add_usage(usage, response.usage)
+            governor.observe(response.usage)
+            iterations += 1
+
+            if response.stop_reason == "tool_use":
+                tool_blocks = [block for block in response.content if block.type == "tool_use"]
+
+                for block in tool_blocks:
+                    print(f"Claude is using tool: {block.name}")
+
+                # gather keeps block order
+                outcomes = await asyncio.gather(*(run_tool(gmail_service, block) for block in tool_blocks))
+                outcomes = [(block, result, error) for block, result, error, _ in outcomes]
+                for block, result, error in outcomes:
+                    all_attachments.extend(collect_attachments(block, result))
+
+                tool_results = [tool_result_block(*outcome) for outcome in governor.fit(outcomes)]
+
+                messages.append({"role": "assistant", "content": response.content})
+                messages.append({"role": "user", "content": tool_results})
+
+            elif response.stop_reason == "end_turn":
+                log_usage(usage, iterations)
+                outcome = 'ok'
+                final_response = ""
+
+                for block in response.content:
+                    if hasattr(block, "text"):
+                        final_response += block.text
+
+                return JSONResponse({
+                    "response": final_response,
+                    "attachments": all_attachments,
+                    **trace_fields(trace)
+                })
+
+            else:
+                log_usage(usage, iterations)
+                outcome = 'unexpected_stop'
+                return JSONResponse({
+                    "error": f"Unexpected stop reason: {response.stop_reason}",
+                    **trace_fields(trace)
+                }, status_code=500)
+
+    except Exception as e:
+        print(f"Error in chat endpoint: {str(e)}")
+        count_error('claude' if isinstance(e, anthropic.APIError) else 'chat', e)
+        return JSONResponse({"error": str(e), **trace_fields(trace)}, status_code=500)
+
+    finally:
+        observe_chat('chat', outcome, time.monotonic() - started, iterations)
+        finish_trace(trace)
+
+
+@require_auth
+async def chat_stream(request):
+    """
+    Streaming chat endpoint
+    Same server-sent events as the Flask /api/chat/stream endpoint
+    """
+    if request.method == 'OPTIONS':
+        return Response(status_code=200)
+
+    try:
+        data = await read_json(request)
+    except ValueError as e:
+        return JSONResponse({"error": str(e)}, status_code=400)
+    user_message = data.get('message', '')
+
+    if not user_message:
+        return JSONResponse({"error": "No message provided"}, status_code=400)
+
+    gmail_service = await get_gmail_service(request)
+    trace_format = requested_format(request.headers.get(TRACE_HEADER))
+
+    async def generate():
+        # Started here so the trace lives in the context the generator runs in
+        trace = start_trace('chat_stream', trace_format)
+        messages = [{"role": "user", "content": user_message}]
+        started = time.monotonic()
+        usage = new_usage()
+        iterations = 0
+        governor = ResultGovernor(reserve_tokens=CLAUDE_MAX_TOKENS)
+
+        # Stays 'cancelled' if the client disconnects mid-stream
+        outcome = 'cancelled'
+
+        try:
+            while True:
+                call_started = time.monotonic()
+                with span('claude', iteration=iterations + 1) as claude_span:
+                    async with async_anthropic_client.messages.stream(**claude_request(messages)) as stream:
+                        async for text in stream.text_stream:
+                            yield sse_event("text", {"text": text})
+                        response = await stream.get_final_message()
+                    claude_span.set(stop_reason=response.stop_reason, **usage_attrs(response.usage))
+                observe_claude_call('chat_stream', time.monotonic() - call_started, response.usage)
+                add_usage(usage, response.usage)
+                governor.observe(response.usage)
+                iterations += 1
+
+                if response.stop_reason == "tool_use":
+                    tool_blocks = [block for block in response.content if block.type == "tool_use"]
+
+                    for block in tool_blocks:
+                        print(f"Claude is using tool: {block.name}")
+                        yield sse_event("tool_started", {"id": block.id, "name": block.name, "input": block.input})
+
+                    # Report each tool as soon as it finishes, but reply to Claude in block order
+                    results = {}
+                    for next_done in asyncio.as_completed([run_tool(gmail_service, block) for block in tool_blocks]):
+                        block, result, error, elapsed = await next_done
+                        yield sse_event("tool_finished", {
+                            "id": block.id,
+                            "name": block.name,
+                            "duration_ms": round(elapsed * 1000),
+                            "error": error
+                        })
+                        attachments = collect_attachments(block, result)
+                        if attachments:
+                            yield sse_event("attachments", {"attachments": attachments})
+                        results[block.id] = (block, result, error)
+
+                    outcomes = governor.fit([results[block.id] for block in tool_blocks])
+                    messages.append({"role": "assistant", "content": response.content})
+                    messages.append({"role": "user", "content": [tool_result_block(*outcome) for outcome in outcomes]})
+
+                elif response.stop_reason == "end_turn":
+                    log_usage(usage, iterations)
+                    outcome = 'ok'
+                    if trace_format:
+                        yield sse_event("trace", trace.export())
+                    yield sse_event("done", {"duration_ms": round((time.monotonic() - started) * 1000)})
+                    return
+
+                else:
+                    log_usage(usage, iterations)
+                    outcome = 'unexpected_stop'
+                    yield sse_event("error", {
+                        "error": f"Unexpected stop reason: {response.stop_reason}",
+                        **trace_fields(trace)
+                    })
+                    return
+
+        except Exception as e:
+            print(f"Error in chat stream: {str(e)}")
+            outcome = 'error'
+            count_error('claude' if isinstance(e, anthropic.APIError) else 'chat', e)
+            yield sse_event("error", {"error": str(e), **trace_fields(trace)})
+
+        finally:
+            observe_chat('chat_stream', outcome, time.monotonic() - started, iterations)
+            finish_trace(trace)
+
+    return StreamingResponse(
+        generate(),
+        media_type='text/event-stream',
+        headers={
+            'Cache-Control': 'no-cache',
+            'X-Accel-Buffering': 'no'
+        }
+    )
+
+
+@require_auth
+async def download_attachment(request):
+    """
+    Download an attachment, from the disk cache or streamed from Gmail, with
+    Content-Length and Range support
+    """
+    if request.method == 'OPTIONS':
+        return Response(status_code=200)
+
+    try:
+        if request.method == 'POST':
+            try:
+                data = await read_json(request)
+            except ValueError as e:
+                return JSONResponse({"error": str(e)}, status_code=400)
+        else:
+            data = request.query_params
+        message_id = data.get('message_id')
+        attachment_id = data.get('attachment_id')
+        filename = data.get('filename')
+
+        if not all([message_id, attachment_id, filename]):
+            return JSONResponse({"error": "Missing required parameters"}, status_code=400)
+
+        user_email = request.state.user_email
+        cached_path = await run_blocking(attachment_cache.get, user_email, message_id, attachment_id)
+        if cached_path:
+            try:
+                stat_result = await run_blocking(os.stat, cached_path)
+                return FileResponse(cached_path, filename=filename, stat_result=stat_result)
+            except FileNotFoundError:
+                # Evicted since the lookup; fetch it again
+                pass
+
+        gmail_service = await get_gmail_service(request)
+
+        stream = await run_blocking(gmail_service.open_attachment, message_id, attachment_id)
+
+        try:
+            byte_range = parse_byte_range(request.headers.get('range'), stream.size)
+        except ValueError:
+            stream.close()
+            return Response(status_code=416, headers={'Content-Range': f"bytes */{stream.size}"})
+
+        status, headers = attachment_headers(filename, stream.size, byte_range)
+        media_type = headers.pop('Content-Type')
+        if byte_range is None:
+            chunks = attachment_cache.store(user_email, message_id, attachment_id, stream.iter_bytes(), stream.size)
+        else:
+            # Only whole files are cached
+            chunks = stream.iter_bytes(*byte_range)
+        # A sync iterator: Starlette reads it on its thread pool, one chunk at a time
+        return StreamingResponse(
+            chunks,
+            status_code=status,
+            headers=headers,
+            media_type=media_type,
+            background=BackgroundTask(stream.close)
+        )
+
+    except GmailAPIError as e:
+        headers = {'Retry-After': str(int(e.retry_after + 0.999))} if e.retry_after is not None else None
+        return JSONResponse(e.to_dict(), status_code=e.http_status, headers=headers)
+
+    except Exception as e:
+        print(f"Error downloading attachment: {str(e)}")
+        return JSONResponse({"error": str(e)}, status_code=500)
+
+
+@require_auth
+async def download_attachments(request):
+    """
+    Download several attachments as one ZIP archive, streamed as each file arrives
+    """
+    if request.method == 'OPTIONS':
+        return Response(status_code=200)
+
+    try:
+        entries, filename = parse_bundle_request(await read_json(request))
+    except ValueError as e:
+        return JSONResponse({"error": str(e)}, status_code=400)
+
+    try:
+        gmail_service = await get_gmail_service(request)
+        chunks = stream_bundle(gmail_service, attachment_cache, request.state.user_email, entries)
+
+        _, headers = attachment_headers(filename, None, None)
+        media_type = headers.pop('Content-Type')
+        return StreamingResponse(chunks, headers=headers, media_type=media_type)
+
+    except Exception as e:
+        print(f"Error building attachment bundle: {str(e)}")
+        return JSONResponse({"error": str(e)}, status_code=500)
+
+
+@require_auth
+async def stats(request):
+    """Cache, client pool and session table counters for this worker process"""
+    if request.method == 'OPTIONS':
+        return Response(status_code=200)
+    return JSONResponse({
+        "message_cache": message_cache.stats(),
+        "attachment_cache": await run_blocking(attachment_cache.stats),
+        "gmail_scheduler": gmail_scheduler.stats(),
+        "gmail_clients": len(gmail_clients),
+        "sessions": await run_blocking(get_session_stats),
+        "mailbox_index": await run_blocking(
+            mailbox_indexes.get(request.state.user_email).stats
+        ) if mailbox_indexes else None
+    })
+
+
+async def metrics(request):
+    """Prometheus scrape endpoint (not proxied by nginx)"""
+    # Reads every worker's sample files
+    body, content_type = await run_blocking(render_metrics)
+    return Response(body, media_type=content_type)
+
+
+async def health(request):
+    """Health check endpoint"""
+    if request.method == 'OPTIONS':
+        return Response(status_code=200)
+    return JSONResponse({"status": "ok", "service": "gmail-chat-backend"})
+
+
+app = Starlette(
+    routes=[
+        Route('/auth/login', auth_login, methods=['GET', 'OPTIONS']),
+        Route('/auth/callback', auth_callback, methods=['GET']),
+        Route('/auth/user', auth_user, methods=['GET', 'OPTIONS']),
+        Route('/auth/logout', auth_logout, methods=['POST', 'OPTIONS']),
+        Route('/api/chat', chat, methods=['POST', 'OPTIONS']),
+        Route('/api/chat/stream', chat_stream, methods=['POST', 'OPTIONS']),
+        Route('/api/download-attachment', download_attachment, methods=['GET', 'POST', 'OPTIONS']),
+        Route('/api/download-attachments', download_attachments, methods=['POST', 'OPTIONS']),
+        Route('/api/stats', stats, methods=['GET', 'OPTIONS']),
+        Route('/api/health', health, methods=['GET', 'OPTIONS']),
+        Route('/metrics', metrics, methods=['GET']),
+    ],
+    middleware=[
+        # Same CORS policy as the Flask app, with credentials for session cookies
+        Middleware(
+            CORSMiddleware,
+            allow_origins=['http://localhost:8000', 'http://127.0.0.1:8000'],
+            allow_credentials=True,
+            allow_headers=['Content-Type', 'Range', TRACE_HEADER],
+            expose_headers=['Content-Disposition', 'Content-Length', 'Content-Range', 'Accept-Ranges'],
+            allow_methods=['GET', 'POST', 'OPTIONS']
+        )
+    ]
+)
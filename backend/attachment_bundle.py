@@ -0,0 +1,201 @@
+"""
+Attachment Bundle Module
+Streams several attachments as one ZIP archive. Attachments are fetched
+concurrently, a few at a time, and each is written to the archive as soon
+as it arrives; the archive itself is never held in memory or on disk
+"""
+
+import os
+import shutil
+import tempfile
+import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+# Most attachments in one bundle
+BUNDLE_MAX_FILES = int(os.environ.get('BUNDLE_MAX_FILES', '50'))
+
+# Attachments fetched at once per bundle (fetched but unwritten ones count too)
+BUNDLE_CONCURRENCY = int(os.environ.get('BUNDLE_CONCURRENCY', '4'))
+
+# Threads shared by all bundles in this process
+BUNDLE_THREADS = int(os.environ.get('BUNDLE_THREADS', '16'))
+
+# A fetched attachment stays in memory up to this size, then spills to a temp file
+SPOOL_MAX_BYTES = 4 * 1024 * 1024
+
+# Bytes copied into the archive per step
+COPY_CHUNK_SIZE = 256 * 1024
+
+# Already compressed formats are stored as-is; deflating them only costs CPU
+STORED_EXTENSIONS = {
+    '.7z', '.avi', '.bz2', '.docx', '.gif', '.gz', '.heic', '.jpeg', '.jpg', '.m4a', '.mov', '.mp3',
+    '.mp4', '.pdf', '.png', '.pptx', '.rar', '.webp', '.xlsx', '.xz', '.zip'
+}
+
+bundle_executor = ThreadPoolExecutor(max_workers=BUNDLE_THREADS, thread_name_prefix='bundle')
+
+
+class _ChunkSink:
+    """Write-only, unseekable file object that collects what zipfile writes"""
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        """Return and forget everything written so far"""
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def stream_bundle(gmail_service, attachment_cache, user, entries, concurrency=BUNDLE_CONCURRENCY):
+    """
+    Stream a ZIP archive of attachments
+
+    Members appear in the order their fetches finish. Attachments that fail
+    are left out and listed in an errors.txt member at the end.
+
+    Args:
+        gmail_service: GmailService for the user
+        attachment_cache: AttachmentCache (cached files are read from disk)
+        user: User email, the attachment cache key
+        entries: Dicts with message_id, attachment_id and filename
+        concurrency: Attachments fetched at once
+
+    Yields:
+        Chunks of the ZIP archive
+    """
+    sink = _ChunkSink()
+    names = set()
+    failures = []
+    queue = list(entries)
+    pending = {}
+
+    try:
+        with zipfile.ZipFile(sink, 'w') as archive:
+            while queue or pending:
+                # Start fetches until `concurrency` are fetched-or-fetching
+                while queue and len(pending) < concurrency:
+                    entry = queue.pop(0)
+                    future = bundle_executor.submit(_fetch, gmail_service, attachment_cache, user, entry)
+                    pending[future] = entry
+
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    entry = pending.pop(future)
+                    try:
+                        f = future.result()
+                    except Exception as error:
+                        print(f"Bundle: failed to fetch {entry['filename']}: {error}")
+                        failures.append(f"{entry['filename']}: {error}")
+                        continue
+
+                    with f:
+                        name = _member_name(entry['filename'], names)
+                        compression = (zipfile.ZIP_STORED if os.path.splitext(name)[1].lower() in STORED_EXTENSIONS
+                                       else zipfile.ZIP_DEFLATED)
+                        info = zipfile.ZipInfo(name, date_time=_now())
+                        info.compress_type = compression
+                        with archive.open(info, 'w') as member:
+                            while True:
+                                data = f.read(COPY_CHUNK_SIZE)
+                                if not data:
+                                    break
+                                member.write(data)
+                                chunk = sink.drain()
+                                if chunk:
+                                    yield chunk
+                    chunk = sink.drain()
+                    if chunk:
+                        yield chunk
+
+            if failures:
+                archive.writestr(
+                    _member_name('errors.txt', names),
+                    "These attachments could not be downloaded:\n" + "\n".join(failures) + "\n"
+                )
+
+        yield sink.drain()
+
+    finally:
+        # Client went away (or an error): don't leave fetches running or files open
+        for future in pending:
+            if not future.cancel():
+                future.add_done_callback(_discard)
+
+
+def _fetch(gmail_service, attachment_cache, user, entry):
+    """
+    Get one attachment as a readable file, from the cache or from Gmail
+
+    Returns:
+        Binary file object positioned at the start
+    """
+    path = attachment_cache.get(user, entry['message_id'], entry['attachment_id'])
+    if path:
+        try:
+            return open(path, 'rb')
+        except FileNotFoundError:
+            # Evicted since the lookup
+            pass
+
+    stream = gmail_service.open_attachment(entry['message_id'], entry['attachment_id'])
+
+    # Cached on the way, like a single download
+    chunks = attachment_cache.store(
+        user, entry['message_id'], entry['attachment_id'], stream.iter_bytes(), stream.size
+    )
+    spool = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_BYTES)
+    try:
+        shutil.copyfileobj(_IterReader(chunks), spool, COPY_CHUNK_SIZE)
+    except BaseException:
+        chunks.close()
+        stream.close()
+        spool.close()
+        raise
+    spool.seek(0)
+    return spool
+
+
+class _IterReader:
+    """Minimal read() over an iterator of byte chunks, for shutil.copyfileobj"""
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+
+    def read(self, size=-1):
+        return next(self._chunks, b'')
+
+
+def _member_name(filename, used):
+    """A safe, unique archive member name: no directories, duplicates numbered"""
+    name = os.path.basename(filename.replace('\\', '/')).strip() or 'attachment'
+    if name in ('.', '..'):
+        name = 'attachment'
+    stem, ext = os.path.splitext(name)
+    candidate = name
+    number = 2
+    while candidate.lower() in used:
+        candidate = f"{stem} ({number}){ext}"
+        number += 1
+    used.add(candidate.lower())
+    return candidate
+
+
+def _now():
+    """ZIP timestamp (local time, as zipfile expects)"""
+    return time.localtime()[:6]
+
+
+def _discard(future):
+    """Done callback: close the file of a fetch nobody will write"""
+    if not future.cancelled() and future.exception() is None:
+        future.result().close()
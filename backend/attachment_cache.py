@@ -0,0 +1,277 @@
+"""
+Attachment Cache Module
+Disk cache of decoded attachments shared by all gunicorn workers on the box.
+Files are stored once per content hash, an SQLite index maps
+(user, message_id, attachment_id) to them, and the least recently used
+files are evicted when the total size goes over the cap
+"""
+
+import os
+import hashlib
+import sqlite3
+import tempfile
+import threading
+import time
+
+from metrics import observe_cache
+from sqlite_db import bytes_over_cap, sqlite_connection
+
+# Directory holding the index and the content-addressed files
+ATTACHMENT_CACHE_DIR = os.environ.get(
+    'ATTACHMENT_CACHE_DIR',
+    os.path.join(os.path.dirname(__file__), 'cache', 'attachments')
+)
+
+# Total size cap for cached files (0 disables the cache)
+ATTACHMENT_CACHE_MAX_BYTES = int(os.environ.get('ATTACHMENT_CACHE_MB', '1024')) * 1024 * 1024
+
+# Attachments bigger than this share of the cap are streamed without caching
+MAX_FILE_FRACTION = 0.25
+
+# Files read this recently are never evicted, since a worker may still be sending them
+EVICTION_GRACE_SECONDS = 60
+
+# Partial files left by a crashed worker are removed after this long
+STALE_TEMP_SECONDS = 3600
+
+
+class AttachmentCache:
+    def __init__(self, cache_dir=ATTACHMENT_CACHE_DIR, max_bytes=ATTACHMENT_CACHE_MAX_BYTES):
+        """
+        Initialize the attachment cache
+
+        Args:
+            cache_dir: Directory for the index and cached files
+            max_bytes: Total size cap (0 disables the cache)
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.db_path = os.path.join(cache_dir, 'index.db')
+        self._tmp_dir = os.path.join(cache_dir, 'tmp')
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+        self._counters = {
+            'hits': 0,
+            'misses': 0,
+            'stores': 0,
+            'evictions': 0,
+        }
+
+        if not self.max_bytes:
+            return
+
+        os.makedirs(self._tmp_dir, exist_ok=True)
+        db = self._db()
+        db.execute("""
+            CREATE TABLE IF NOT EXISTS blobs (
+                digest TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                accessed REAL NOT NULL
+            )
+        """)
+        db.execute("CREATE INDEX IF NOT EXISTS blobs_accessed ON blobs (accessed)")
+        db.execute("""
+            CREATE TABLE IF NOT EXISTS attachments (
+                user TEXT NOT NULL,
+                message_id TEXT NOT NULL,
+                attachment_id TEXT NOT NULL,
+                digest TEXT NOT NULL,
+                PRIMARY KEY (user, message_id, attachment_id)
+            )
+        """)
+        db.execute("CREATE INDEX IF NOT EXISTS attachments_digest ON attachments (digest)")
+        self._remove_stale_temp_files()
+
+    def get(self, user, message_id, attachment_id):
+        """
+        Look up a cached attachment
+
+        Args:
+            user: User the attachment belongs to (e.g. email address)
+            message_id: Gmail message ID
+            attachment_id: Gmail attachment ID
+
+        Returns:
+            Path of the cached file, or None on a miss
+        """
+        if not self.max_bytes:
+            return None
+
+        try:
+            db = self._db()
+            row = db.execute(
+                "SELECT digest FROM attachments WHERE user = ? AND message_id = ? AND attachment_id = ?",
+                (user, message_id, attachment_id)
+            ).fetchone()
+            path = self._blob_path(row[0]) if row else None
+            if path is not None and not os.path.exists(path):
+                # Evicted by another worker after this mapping was written
+                db.execute("DELETE FROM attachments WHERE digest = ?", (row[0],))
+                db.execute("DELETE FROM blobs WHERE digest = ?", (row[0],))
+                path = None
+            if path is not None:
+                db.execute("UPDATE blobs SET accessed = ? WHERE digest = ?", (time.time(), row[0]))
+        except sqlite3.Error as error:
+            # The cache must never break a download
+            print(f"Attachment cache read error: {error}")
+            path = None
+
+        with self._lock:
+            self._counters['hits' if path else 'misses'] += 1
+        observe_cache('attachment', 'hit' if path else 'miss')
+        return path
+
+    def store(self, user, message_id, attachment_id, chunks, size=None):
+        """
+        Pass an attachment's chunks through while writing them to the cache
+
+        The file is added only if the iteration runs to the end (and matches
+        `size` when given); a download the client abandons leaves nothing behind.
+
+        Args:
+            user: User the attachment belongs to
+            message_id: Gmail message ID
+            attachment_id: Gmail attachment ID
+            chunks: Iterable of decoded byte chunks
+            size: Expected size in bytes, if known
+
+        Yields:
+            The same chunks
+        """
+        limit = int(self.max_bytes * MAX_FILE_FRACTION)
+        if not self.max_bytes or (size is not None and size > limit):
+            yield from chunks
+            return
+
+        fd, temp_path = tempfile.mkstemp(dir=self._tmp_dir)
+        f = os.fdopen(fd, 'wb')
+        digest = hashlib.sha256()
+        written = 0
+        complete = False
+        try:
+            for chunk in chunks:
+                if f is not None:
+                    f.write(chunk)
+                    digest.update(chunk)
+                    written += len(chunk)
+                    if written > limit:
+                        # Bigger than it claimed (or than we knew); stop caching, keep sending
+                        f.close()
+                        f = None
+                yield chunk
+            complete = f is not None and (size is None or written == size)
+        finally:
+            if f is not None:
+                f.close()
+            if complete:
+                self._add(user, message_id, attachment_id, temp_path, digest.hexdigest(), written)
+            else:
+                self._remove(temp_path)
+
+    def stats(self):
+        """
+        Get hit/miss counters and the cache's current size
+
+        Returns:
+            Dict of counters
+        """
+        with self._lock:
+            stats = dict(self._counters)
+
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_rate'] = round(stats['hits'] / lookups, 3) if lookups else 0.0
+        if self.max_bytes:
+            try:
+                stats['files'], stats['bytes'] = self._db().execute(
+                    "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM blobs"
+                ).fetchone()
+            except sqlite3.Error as error:
+                print(f"Attachment cache read error: {error}")
+        return stats
+
+    def _add(self, user, message_id, attachment_id, temp_path, digest, size):
+        """Move a finished file into place, index it and evict down to the cap"""
+        path = self._blob_path(digest)
+        evicted = []
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # Atomic; if another worker stored the same content, the files are identical
+            os.replace(temp_path, path)
+
+            db = self._db()
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                now = time.time()
+                db.execute(
+                    "INSERT INTO blobs (digest, size, accessed) VALUES (?, ?, ?) "
+                    "ON CONFLICT(digest) DO UPDATE SET accessed = excluded.accessed",
+                    (digest, size, now)
+                )
+                db.execute(
+                    "INSERT OR REPLACE INTO attachments (user, message_id, attachment_id, digest) VALUES (?, ?, ?, ?)",
+                    (user, message_id, attachment_id, digest)
+                )
+                evicted = self._evict(db, now)
+                db.execute("COMMIT")
+            except BaseException:
+                db.execute("ROLLBACK")
+                raise
+        except (OSError, sqlite3.Error) as error:
+            print(f"Attachment cache write error: {error}")
+            self._remove(temp_path)
+            return
+
+        # Unlink after the commit; readers that already opened a file keep reading it
+        for victim in evicted:
+            self._remove(self._blob_path(victim))
+        with self._lock:
+            self._counters['stores'] += 1
+            self._counters['evictions'] += len(evicted)
+
+    def _evict(self, db, now):
+        """Drop least recently used files until under the cap (inside the caller's transaction)"""
+        total = db.execute("SELECT COALESCE(SUM(size), 0) FROM blobs").fetchone()[0]
+        excess = bytes_over_cap(total, self.max_bytes)
+        if not excess:
+            return []
+
+        victims = []
+        for digest, size in db.execute(
+            "SELECT digest, size FROM blobs WHERE accessed < ? ORDER BY accessed",
+            (now - EVICTION_GRACE_SECONDS,)
+        ):
+            victims.append(digest)
+            excess -= size
+            if excess <= 0:
+                break
+
+        db.executemany("DELETE FROM attachments WHERE digest = ?", [(digest,) for digest in victims])
+        db.executemany("DELETE FROM blobs WHERE digest = ?", [(digest,) for digest in victims])
+        return victims
+
+    def _remove_stale_temp_files(self):
+        """Delete partial files left behind by workers that died mid-download"""
+        cutoff = time.time() - STALE_TEMP_SECONDS
+        for name in os.listdir(self._tmp_dir):
+            path = os.path.join(self._tmp_dir, name)
+            try:
+                if os.path.getmtime(path) < cutoff:
+                    os.remove(path)
+            except OSError:
+                pass
+
+    def _blob_path(self, digest):
+        """Content-addressed location, fanned out over 256 subdirectories"""
+        return os.path.join(self.cache_dir, 'blobs', digest[:2], digest)
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def _db(self):
+        """Per-thread SQLite connection"""
+        return sqlite_connection(self.db_path, self._local)
@@ -6,9 +6,14 @@ Handles Google OAuth web flow and session management for multi-user access
 import os
 import json
 import secrets
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
 from google_auth_oauthlib.flow import Flow
 from google.oauth2.credentials import Credentials
 from google.auth.transport.requests import Request
+from session_store import create_session_store
 
 # OAuth scopes - includes email for user identification
 SCOPES = [
@@ -18,13 +23,22 @@ SCOPES = [
     'openid'
 ]
 
-# In-memory storage for sessions and user tokens
-# Key: session_id -> Value: {'email': str, 'credentials': Credentials}
-_sessions = {}
+# Storage for sessions ({'email': str, 'credentials': Credentials}) and
+# pending OAuth states (to prevent CSRF), shared by all workers by default
+_store = create_session_store()
 
-# Pending OAuth states (to prevent CSRF)
-# Key: state -> Value: True
-_pending_states = {}
+# Tokens this close to expiry are refreshed in the background, so requests
+# never wait on a refresh unless the token has already expired
+REFRESH_AHEAD_SECONDS = int(os.environ.get('TOKEN_REFRESH_AHEAD_SECONDS', '600'))
+
+# One refresh at a time per session; an entry lives only while some thread is using it
+# Key: session_id -> Value: [threading.Lock, number of threads using it]
+_refresh_locks = {}
+_refresh_locks_guard = threading.Lock()
+_refresh_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='token-refresh')
+
+# How often expired sessions and OAuth states are purged
+SESSION_SWEEP_SECONDS = int(os.environ.get('SESSION_SWEEP_SECONDS', '300'))
 
 
 def _load_client_config(redirect_uri):
@@ -95,7 +109,7 @@ def create_oauth_flow(redirect_uri):
     )
 
     # Store state to verify callback
-    _pending_states[state] = True
+    _store.add_state(state)
 
     return authorization_url, state
 
@@ -170,10 +184,7 @@ def create_session(email, credentials):
     """
     session_id = secrets.token_urlsafe(32)
 
-    _sessions[session_id] = {
-        'email': email,
-        'credentials': credentials
-    }
+    _store.save_session(session_id, email, credentials)
 
     print(f"Created session for user: {email}")
     return session_id
@@ -189,40 +200,106 @@ def get_session(session_id):
     Returns:
         Session dict with 'email' and 'credentials', or None if not found
     """
-    session = _sessions.get(session_id)
+    session = _store.get_session(session_id)
 
     if not session:
         return None
 
-    # Check if credentials need refresh
     credentials = session['credentials']
-    if credentials.expired and credentials.refresh_token:
-        try:
-            credentials.refresh(Request())
-            session['credentials'] = credentials
-        except Exception as e:
-            print(f"Error refreshing credentials: {e}")
-            # Remove invalid session
-            invalidate_session(session_id)
+    if not credentials.refresh_token:
+        return session
+
+    # Expired tokens must be refreshed before use; only one request per
+    # session does the refresh, the others wait for its result
+    if credentials.expired:
+        if not _refresh_session(session_id, session, blocking=True):
             return None
+    elif _seconds_to_expiry(credentials) < REFRESH_AHEAD_SECONDS:
+        _refresh_executor.submit(_refresh_session, session_id, session, False)
 
     return session
 
 
-def get_user_credentials(session_id):
+def _seconds_to_expiry(credentials):
+    """Seconds until the access token expires (infinite if unknown)"""
+    if credentials.expiry is None:
+        return float('inf')
+    # google-auth keeps expiry as a naive UTC datetime
+    now = datetime.now(timezone.utc).replace(tzinfo=None)
+    return (credentials.expiry - now).total_seconds()
+
+
+def _checkout_refresh_lock(session_id):
+    """Get the lock that serializes refreshes for a session; pair with _return_refresh_lock"""
+    with _refresh_locks_guard:
+        entry = _refresh_locks.get(session_id)
+        if entry is None:
+            entry = _refresh_locks[session_id] = [threading.Lock(), 0]
+        entry[1] += 1
+        return entry[0]
+
+
+def _return_refresh_lock(session_id):
+    """Drop the session's lock once no thread is holding or waiting on it"""
+    with _refresh_locks_guard:
+        entry = _refresh_locks[session_id]
+        entry[1] -= 1
+        if not entry[1]:
+            del _refresh_locks[session_id]
+
+
+def _refresh_session(session_id, session, blocking):
     """
-    Get OAuth credentials for a session
+    Refresh a session's credentials unless another thread or worker already did
 
     Args:
-        session_id: The session ID from cookie
+        session_id: The session ID
+        session: Session dict from the store; its credentials are replaced
+            with the stored (possibly just refreshed) ones
+        blocking: Wait for an in-flight refresh (request path) or skip if one is
+            running (background path)
 
     Returns:
-        Google Credentials object or None
+        True if the session has usable credentials afterwards
     """
-    session = get_session(session_id)
-    if session:
-        return session['credentials']
-    return None
+    lock = _checkout_refresh_lock(session_id)
+    try:
+        if not lock.acquire(blocking=blocking):
+            return True
+        try:
+            return _refresh_locked(session_id, session, blocking)
+        finally:
+            lock.release()
+    finally:
+        _return_refresh_lock(session_id)
+
+
+def _refresh_locked(session_id, session, blocking):
+    """Body of _refresh_session, run while holding the session's refresh lock"""
+    # Another request (or worker) may have refreshed since `session` was read:
+    # start from the stored token, not from this request's possibly cached copy
+    stored = _store.reload_session(session_id)
+    if stored is None:
+        return False
+    credentials = session['credentials'] = stored['credentials']
+
+    if blocking and not credentials.expired:
+        return True
+    if not blocking and _seconds_to_expiry(credentials) >= REFRESH_AHEAD_SECONDS:
+        return True
+
+    try:
+        credentials.refresh(Request())
+        _store.save_session(session_id, session['email'], credentials)
+        return True
+    except Exception as e:
+        print(f"Error refreshing credentials: {e}")
+        if blocking:
+            # Remove invalid session
+            invalidate_session(session_id)
+            return False
+        # A failed early refresh is retried inline once the token expires
+        return True
 
 
 def get_user_email_from_session(session_id):
@@ -248,12 +325,42 @@ def invalidate_session(session_id):
     Args:
         session_id: The session ID to remove
     """
-    if session_id in _sessions:
-        email = _sessions[session_id].get('email', 'unknown')
-        del _sessions[session_id]
+    email = _store.delete_session(session_id)
+    if email:
         print(f"Invalidated session for user: {email}")
 
 
+def sweep_sessions():
+    """Purge expired sessions and OAuth states"""
+    _store.sweep()
+
+
+def get_session_stats():
+    """
+    Gauges for the session tables
+
+    Returns:
+        Dict with current table sizes and eviction/expiry counts
+    """
+    stats = _store.stats()
+    with _refresh_locks_guard:
+        stats['refresh_locks'] = len(_refresh_locks)
+    return stats
+
+
+def _sweep_forever():
+    """Background loop for the session sweeper thread"""
+    while True:
+        time.sleep(SESSION_SWEEP_SECONDS)
+        try:
+            sweep_sessions()
+        except Exception as e:
+            print(f"Session sweep failed: {e}")
+
+
+threading.Thread(target=_sweep_forever, name='session-sweeper', daemon=True).start()
+
+
 def verify_state(state):
     """
     Verify OAuth state to prevent CSRF
@@ -264,7 +371,6 @@ def verify_state(state):
     Returns:
         True if valid, False otherwise
     """
-    if state in _pending_states:
-        del _pending_states[state]
-        return True
-    return False
+    if not state:
+        return False
+    return _store.pop_state(state)
@@ -0,0 +1,627 @@
+"""
+Gmail Service Benchmarks
+Runs GmailService against a local fake Gmail endpoint (no credentials needed)
+
+Usage:
+    python benchmark.py [--results 50] [--latency-ms 40] [--attachment-mb 50] [--index-size 1000]
+"""
+
+import argparse
+import base64
+import json
+import re
+import tempfile
+import threading
+import time
+import tracemalloc
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import httplib2
+from googleapiclient.discovery import build
+
+from gmail_scheduler import GmailScheduler
+from gmail_service import GmailService
+from html_text import compression_ratio, html_to_text, strip_quoted_text
+from mailbox_index import MailboxIndex
+
+GMAIL_ROOT = 'https://gmail.googleapis.com/'
+
+# Fake mailbox: m00000 is the newest message, one message per hour before it
+MAILBOX_SIZE = 2000
+NEWEST_INTERNAL_DATE = 1704103200000
+
+
+def print_section(title):
+    """Print a formatted section header"""
+    print("\n" + "=" * 60)
+    print(f"  {title}")
+    print("=" * 60)
+
+
+def _b64(text):
+    return base64.urlsafe_b64encode(text.encode('utf-8')).decode('ascii')
+
+
+def fake_message(message_id, body_size=3000):
+    """Build a Gmail API style message with a text part and an attachment"""
+    body = ("Lorem ipsum dolor sit amet, consectetur adipiscing elit. " * (body_size // 56 + 1))[:body_size]
+    number = int(message_id[1:]) if message_id[1:].isdigit() else 0
+    return {
+        'id': message_id,
+        'threadId': f"t-{message_id}",
+        'labelIds': ['INBOX'],
+        'internalDate': str(NEWEST_INTERNAL_DATE - number * 3600 * 1000),
+        'snippet': body[:100],
+        'payload': {
+            'mimeType': 'multipart/mixed',
+            'headers': [
+                {'name': 'Subject', 'value': f"Report {message_id}"},
+                {'name': 'From', 'value': 'Carol <carol@example.com>' if number % 10 == 0 else 'Alice <alice@example.com>'},
+                {'name': 'To', 'value': 'bob@example.com'},
+                {'name': 'Date', 'value': 'Mon, 1 Jan 2024 10:00:00 +0000'},
+            ],
+            'parts': [
+                {'mimeType': 'text/plain', 'filename': '', 'body': {'size': len(body), 'data': _b64(body)}},
+                {'mimeType': 'application/pdf', 'filename': f"{message_id}.pdf",
+                 'body': {'size': 1024, 'attachmentId': f"att-{message_id}"}},
+            ]
+        }
+    }
+
+
+# Attachment content: this block repeated (a multiple of 3 bytes, so its base64 repeats too)
+ATTACHMENT_BLOCK = bytes((i * 131 + i // 256) % 256 for i in range(3 * 4096))
+
+
+def fake_attachment(size):
+    """The bytes of a fake attachment of the given size"""
+    return (ATTACHMENT_BLOCK * (size // len(ATTACHMENT_BLOCK) + 1))[:size]
+
+
+def attachment_size(attachment_id):
+    """'blob-<bytes>' attachments have that size, the ones in fake_message 1 KB"""
+    return int(attachment_id[5:]) if attachment_id.startswith('blob-') else 1024
+
+
+def large_multipart_message(message_id, body_size=200_000, attachment_count=20, header_count=60):
+    """
+    Build a big nested message: mixed -> [related -> [alternative -> [plain, html], images], files]
+
+    The body and most attachments sit below the top level, where the
+    original parser did not look.
+    """
+    text = ("Quarterly numbers attached. " * (body_size // 28 + 1))[:body_size]
+    html = "<html><body><p>" + text.replace(". ", ".</p><p>") + "</p></body></html>"
+
+    def attachment(n, mime_type='application/pdf'):
+        return {'mimeType': mime_type, 'filename': f"file-{n}.pdf", 'headers': [],
+                'body': {'size': 50_000, 'attachmentId': f"att-{message_id}-{n}"}}
+
+    headers = [{'name': f"X-Header-{n}", 'value': f"value {n}"} for n in range(header_count)]
+    headers += [
+        {'name': 'Subject', 'value': f"Big report {message_id}"},
+        {'name': 'From', 'value': 'Alice <alice@example.com>'},
+        {'name': 'To', 'value': 'bob@example.com'},
+        {'name': 'Date', 'value': 'Mon, 1 Jan 2024 10:00:00 +0000'},
+    ]
+    return {
+        'id': message_id,
+        'threadId': f"t-{message_id}",
+        'snippet': text[:100],
+        'payload': {
+            'mimeType': 'multipart/mixed',
+            'headers': headers,
+            'body': {'size': 0},
+            'parts': [
+                {'mimeType': 'multipart/related', 'filename': '', 'headers': [], 'body': {'size': 0}, 'parts': [
+                    {'mimeType': 'multipart/alternative', 'filename': '', 'headers': [], 'body': {'size': 0}, 'parts': [
+                        {'mimeType': 'text/plain', 'filename': '', 'body': {'size': len(text), 'data': _b64(text)},
+                         'headers': [{'name': 'Content-Type', 'value': 'text/plain; charset="UTF-8"'}]},
+                        {'mimeType': 'text/html', 'filename': '', 'body': {'size': len(html), 'data': _b64(html)},
+                         'headers': [{'name': 'Content-Type', 'value': 'text/html; charset="UTF-8"'}]},
+                    ]},
+                    *[attachment(n, 'image/png') for n in range(attachment_count // 2)],
+                ]},
+                *[attachment(n) for n in range(attachment_count // 2, attachment_count)],
+            ]
+        }
+    }
+
+
+def newsletter_html(items=12):
+    """Marketing-style HTML: inline styles, layout tables, tracking links, hidden preheader"""
+    style = 'font-family:Helvetica,Arial,sans-serif;font-size:14px;line-height:20px;color:#333333;padding:0 24px'
+    rows = ''.join(
+        f'<tr><td style="{style}"><a href="https://click.example.com/track?u=8f3a9c&amp;id={n}&amp;utm_source=email'
+        f'&amp;utm_medium=newsletter" style="color:#1a73e8;text-decoration:none">Story {n}: prices drop on '
+        f'item {n}</a><br>Read why item {n} is now cheaper than ever.</td></tr>'
+        for n in range(items)
+    )
+    return (
+        '<!DOCTYPE html><html><head><meta charset="utf-8"><style>@media only screen and (max-width:600px)'
+        '{.c{width:100%!important}} td{mso-line-height-rule:exactly}</style></head><body style="margin:0">'
+        '<div style="display:none;max-height:0;overflow:hidden">This week\'s deals' + '&zwnj;&nbsp;' * 90 + '</div>'
+        f'<table role="presentation" width="100%" cellpadding="0" cellspacing="0" class="c">{rows}</table>'
+        '<img src="https://open.example.com/pixel.gif?u=8f3a9c" width="1" height="1" alt=""></body></html>'
+    )
+
+
+def reply_chain_html(depth=6):
+    """Gmail-style reply with nested quoted history and a signature"""
+    quoted = ''
+    for n in range(depth):
+        quoted = (
+            f'<div class="gmail_quote"><div dir="ltr" class="gmail_attr">On Mon, Jan {n + 1}, 2024 at 9:00 AM '
+            f'Person {n} &lt;p{n}@example.com&gt; wrote:<br></div><blockquote class="gmail_quote" '
+            f'style="margin:0 0 0 .8ex;border-left:1px #ccc solid;padding-left:1ex"><div dir="ltr">'
+            f'Message {n} with the earlier details of the contract discussion.{quoted}</div></blockquote></div>'
+        )
+    return (
+        '<div dir="ltr">Sounds good, let\'s sign on Friday.<br><br>'
+        '<div class="gmail_signature"><div>Alice Smith | Head of Legal | +1 555 0100</div></div></div><br>' + quoted
+    )
+
+
+def plain_reply():
+    """Plain text reply with '>' quoting and a signature"""
+    quoted = '\n'.join(f"> line {n} of the previous message" for n in range(40))
+    return (f"Approved, go ahead.\n\nOn Tue, Jan 2, 2024 at 10:00 AM Bob <bob@example.com> wrote:\n"
+            f"{quoted}\n\n-- \nAlice Smith\nHead of Legal\nSent from my iPhone")
+
+
+def legacy_parse_message(message):
+    """The original parser: four header scans, top-level parts only, whole-body decode"""
+    headers = message['payload']['headers']
+    subject = next((h['value'] for h in headers if h['name'].lower() == 'subject'), 'No Subject')
+    sender = next((h['value'] for h in headers if h['name'].lower() == 'from'), 'Unknown')
+    date = next((h['value'] for h in headers if h['name'].lower() == 'date'), 'Unknown')
+    to = next((h['value'] for h in headers if h['name'].lower() == 'to'), 'Unknown')
+
+    payload = message['payload']
+    body = ""
+    if 'body' in payload and payload['body'].get('data'):
+        body = base64.urlsafe_b64decode(payload['body']['data']).decode('utf-8')
+    elif 'parts' in payload:
+        for part in payload['parts']:
+            if part['mimeType'] == 'text/plain':
+                if 'data' in part['body']:
+                    body = base64.urlsafe_b64decode(part['body']['data']).decode('utf-8')
+                    break
+            elif part['mimeType'] == 'text/html' and not body:
+                if 'data' in part['body']:
+                    body = base64.urlsafe_b64decode(part['body']['data']).decode('utf-8')
+
+    attachment_count = sum(
+        1 for part in payload.get('parts', [])
+        if part.get('filename') and part.get('body', {}).get('attachmentId')
+    )
+    return {
+        'id': message['id'], 'subject': subject, 'from': sender, 'to': to, 'date': date,
+        'body': body[:2000] + '...' if len(body) > 2000 else body,
+        'attachmentCount': attachment_count
+    }
+
+
+class FakeGmailHandler(BaseHTTPRequestHandler):
+    """Minimal Gmail REST + batch endpoint with a fixed per-request latency"""
+
+    latency = 0.04
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    # Response body bytes sent, for comparing payload sizes
+    bytes_sent = 0
+
+    # Key: busy-<n>-... message ID -> Value: rate-limit responses sent for it
+    busy_counts = {}
+
+    def log_message(self, format, *args):
+        pass
+
+    def handle(self):
+        try:
+            super().handle()
+        except (BrokenPipeError, ConnectionResetError):
+            # The client stopped reading, e.g. a byte range that ended early
+            pass
+
+    def _send(self, status, body, content_type='application/json'):
+        data = body.encode('utf-8')
+        FakeGmailHandler.bytes_sent += len(data)
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _route(self, method, path):
+        """Return (status, json_body) for a single Gmail API call"""
+        parsed = urllib.parse.urlparse(path)
+        params = urllib.parse.parse_qs(parsed.query)
+        parts = parsed.path.strip('/').split('/')
+
+        if method == 'GET' and parts == ['gmail', 'v1', 'users', 'me', 'profile']:
+            return 200, {'emailAddress': 'me@example.com', 'historyId': '1000'}
+
+        if method == 'GET' and parts == ['gmail', 'v1', 'users', 'me', 'labels']:
+            return 200, {'labels': [{'id': 'INBOX', 'name': 'INBOX'}]}
+
+        # No changes since the crawl
+        if method == 'GET' and parts == ['gmail', 'v1', 'users', 'me', 'history']:
+            return 200, {'historyId': '1000'}
+
+        # gmail/v1/users/me/threads/<id>: four replies that all repeat the same text
+        if method == 'GET' and parts[:5] == ['gmail', 'v1', 'users', 'me', 'threads'] and len(parts) == 6:
+            messages = [dict(fake_message(f"m{n:05d}"), threadId=parts[5]) for n in range(4)]
+            return 200, {'id': parts[5], 'messages': messages}
+
+        # gmail/v1/users/me/messages[/<id>]
+        if method == 'GET' and parts[:5] == ['gmail', 'v1', 'users', 'me', 'messages']:
+            if len(parts) == 5:
+                start = int(params.get('pageToken', ['0'])[0])
+                end = min(start + int(params.get('maxResults', ['100'])[0]), MAILBOX_SIZE)
+                messages = [{'id': f"m{i:05d}", 'threadId': f"t-m{i:05d}"} for i in range(start, end)]
+                response = {'messages': messages, 'resultSizeEstimate': MAILBOX_SIZE}
+                if end < MAILBOX_SIZE:
+                    response['nextPageToken'] = str(end)
+                return 200, response
+            message_id = parts[5]
+            if message_id.startswith('missing'):
+                return 404, {'error': {'code': 404, 'message': 'Requested entity was not found.'}}
+            # busy-<n>-...: rate limited the first n times it is asked for
+            if message_id.startswith('busy-'):
+                sent = FakeGmailHandler.busy_counts.get(message_id, 0)
+                if sent < int(message_id.split('-')[1]):
+                    FakeGmailHandler.busy_counts[message_id] = sent + 1
+                    return 429, {'error': {'code': 429, 'message': 'User-rate limit exceeded.', 'errors': [
+                        {'reason': 'userRateLimitExceeded', 'message': 'User-rate limit exceeded.'}
+                    ]}}
+            message = fake_message(message_id)
+            if params.get('format') == ['metadata']:
+                wanted = {name.lower() for name in params.get('metadataHeaders', [])}
+                headers = [h for h in message['payload']['headers'] if h['name'].lower() in wanted]
+                message = {'id': message['id'], 'threadId': message['threadId'],
+                           'snippet': message['snippet'], 'payload': {'headers': headers}}
+            return 200, message
+
+        return 404, {'error': {'code': 404, 'message': f"Unknown path {parsed.path}"}}
+
+    def _send_attachment(self, size):
+        """Stream {"size": ..., "data": "<base64url>"} without building it in memory"""
+        blocks, tail = divmod(size, len(ATTACHMENT_BLOCK))
+        encoded_block = base64.urlsafe_b64encode(ATTACHMENT_BLOCK)
+        encoded_tail = base64.urlsafe_b64encode(ATTACHMENT_BLOCK[:tail])
+        head = f'{{\n  "size": {size},\n  "data": "'.encode('ascii')
+        length = len(head) + blocks * len(encoded_block) + len(encoded_tail) + 4
+
+        FakeGmailHandler.bytes_sent += length
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(length))
+        self.end_headers()
+        self.wfile.write(head)
+        for _ in range(blocks):
+            self.wfile.write(encoded_block)
+        self.wfile.write(encoded_tail + b'"\n}\n')
+
+    def do_GET(self):
+        time.sleep(self.latency)
+        parts = urllib.parse.urlparse(self.path).path.strip('/').split('/')
+        if parts[:5] == ['gmail', 'v1', 'users', 'me', 'messages'] and len(parts) == 8 and parts[6] == 'attachments':
+            self._send_attachment(attachment_size(parts[7]))
+            return
+        status, body = self._route('GET', self.path)
+        self._send(status, json.dumps(body))
+
+    def do_POST(self):
+        time.sleep(self.latency)
+        length = int(self.headers.get('Content-Length', 0))
+        raw = self.rfile.read(length).decode('utf-8')
+
+        if not self.path.startswith('/batch'):
+            self._send(404, json.dumps({'error': {'code': 404}}))
+            return
+
+        boundary = re.search(r'boundary="?([^";]+)"?', self.headers['Content-Type']).group(1)
+        out_boundary = 'batch_fake_gmail'
+        chunks = []
+        for part in raw.split(f"--{boundary}"):
+            content_id = re.search(r'Content-ID: <([^>]+)>', part)
+            request_line = re.search(r'^(GET|POST) (\S+) HTTP/1\.1', part, re.MULTILINE)
+            if not content_id or not request_line:
+                continue
+            status, body = self._route(request_line.group(1), request_line.group(2))
+            chunks.append(
+                f"--{out_boundary}\r\n"
+                "Content-Type: application/http\r\n"
+                f"Content-ID: <response-{content_id.group(1)}>\r\n\r\n"
+                f"HTTP/1.1 {status} {'OK' if status == 200 else 'Not Found'}\r\n"
+                "Content-Type: application/json; charset=UTF-8\r\n\r\n"
+                f"{json.dumps(body)}\r\n"
+            )
+        chunks.append(f"--{out_boundary}--\r\n")
+        self._send(200, ''.join(chunks), f"multipart/mixed; boundary={out_boundary}")
+
+
+class LocalHttp(httplib2.Http):
+    """httplib2 transport that sends Gmail API traffic to the local fake server"""
+
+    def __init__(self, base_url, **kwargs):
+        super().__init__(**kwargs)
+        self.base_url = base_url
+
+    def request(self, uri, *args, **kwargs):
+        if uri.startswith(GMAIL_ROOT):
+            uri = self.base_url + uri[len(GMAIL_ROOT):]
+        return super().request(uri, *args, **kwargs)
+
+
+def start_fake_gmail(latency):
+    """Start the fake Gmail server on a free port, returns (server, base_url)"""
+    FakeGmailHandler.latency = latency
+    server = ThreadingHTTPServer(('127.0.0.1', 0), FakeGmailHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}/"
+
+
+def fake_gmail_service(base_url, scheduler=None):
+    """GmailService wired to the fake endpoint"""
+    service = build('gmail', 'v1', http=LocalHttp(base_url), static_discovery=True)
+    # The fake endpoint has no quota, so don't pace calls to it
+    return GmailService(service=service, api_root=base_url, scheduler=scheduler or GmailScheduler(rate=0))
+
+
+def sequential_search(gmail, query, max_results):
+    """The pre-batching search: one messages().get round trip per hit"""
+    results = gmail.service.users().messages().list(userId='me', q=query, maxResults=max_results).execute()
+    return [
+        gmail._parse_message(gmail.service.users().messages().get(
+            userId='me', id=message['id'], format='full'
+        ).execute())
+        for message in results.get('messages', [])
+    ]
+
+
+def timed(fn, *args, repeat=3):
+    """Best wall time over `repeat` runs, returns (seconds, result)"""
+    best, result = None, None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn(*args)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def bench_search(gmail, max_results):
+    """Compare sequential and batched search_emails"""
+    print_section(f"search_emails: {max_results} results")
+
+    seq_time, seq_results = timed(sequential_search, gmail, 'label:inbox', max_results)
+    batch_time, batch_results = timed(gmail.search_emails, 'label:inbox', max_results)
+
+    same_order = [m['id'] for m in seq_results] == [m['id'] for m in batch_results]
+    print(f"  sequential: {seq_time * 1000:8.1f} ms")
+    print(f"  batched:    {batch_time * 1000:8.1f} ms")
+    print(f"  speedup:    {seq_time / batch_time:8.1f}x")
+    print(f"  same results in same order: {same_order}")
+
+
+def bench_batch_errors(gmail):
+    """A missing ID in a batch should only drop that message"""
+    print_section("Batch with a bad message ID")
+
+    ids = ['m00001', 'missing-1', 'm00002']
+    results = gmail._batch_get(ids, format='full')
+    print(f"  requested: {ids}")
+    print(f"  returned:  {[m['id'] if m else None for m in results]}")
+
+
+def bench_scheduler(base_url):
+    """Quota pacing and retries of rate-limited calls"""
+    print_section("Gmail scheduler: pacing and rate-limit retries")
+
+    # 100 gets = 500 units against 250/s with a 250 unit burst: ~1s of pacing
+    scheduler = GmailScheduler()
+    gmail = fake_gmail_service(base_url, scheduler)
+    ids = [f"m{n:05d}" for n in range(100)]
+    elapsed, results = timed(lambda: gmail._batch_get(ids, format='minimal'), repeat=1)
+    print(f"  100 gets at {scheduler.rate:g} units/s:  {elapsed * 1000:7.1f} ms  "
+          f"({sum(1 for m in results if m)} fetched, waited {scheduler.stats()['wait_seconds']}s)")
+
+    scheduler = GmailScheduler(rate=0)
+    gmail = fake_gmail_service(base_url, scheduler)
+    FakeGmailHandler.busy_counts.clear()
+    ids = ['m00001', 'busy-2-a', 'm00002', 'busy-1-b', 'missing-1']
+    errors = {}
+    elapsed, results = timed(lambda: gmail._batch_get(ids, errors, format='minimal'), repeat=1)
+    print(f"  batch with rate-limited IDs:  {elapsed * 1000:7.1f} ms")
+    print(f"  returned:  {[m['id'] if m else None for m in results]}")
+    print(f"  errors:    {dict((key, error.kind) for key, error in errors.items())}")
+    stats = scheduler.stats()
+    print(f"  retries {stats['retries']}, throttled {stats['throttled']}, failures {stats['failures']}")
+
+
+def bench_metadata_search(gmail, max_results):
+    """Compare bytes and result size of full and metadata-only searches"""
+    print_section(f"search_emails include_body=False: {max_results} results")
+
+    rows = []
+    for include_body in (True, False):
+        FakeGmailHandler.bytes_sent = 0
+        elapsed, results = timed(gmail.search_emails, 'from:alice', max_results, include_body, repeat=1)
+        result_chars = len(json.dumps(results))
+        rows.append((include_body, elapsed, FakeGmailHandler.bytes_sent, result_chars))
+
+    for include_body, elapsed, bytes_sent, result_chars in rows:
+        label = 'full' if include_body else 'metadata'
+        print(f"  {label:9s} {elapsed * 1000:8.1f} ms  {bytes_sent:9,d} bytes fetched  "
+              f"{result_chars:8,d} result chars (~{result_chars // 4:,d} tokens)")
+    print(f"  bytes fetched:  {rows[0][2] / rows[1][2]:6.1f}x smaller")
+    print(f"  result size:    {rows[0][3] / rows[1][3]:6.1f}x smaller")
+
+
+def bench_parse(gmail, iterations=200):
+    """Micro-benchmark _parse_message on large nested multipart payloads"""
+    for body_size in (20_000, 200_000, 2_000_000):
+        message = large_multipart_message('big', body_size=body_size)
+        print_section(f"_parse_message: nested multipart, {body_size:,d} char body")
+
+        # Flat copy: the legacy parser only handles bodies at the top level
+        flat = json.loads(json.dumps(message))
+        alternative = flat['payload']['parts'][0]['parts'][0]
+        flat['payload']['parts'] = alternative['parts'] + flat['payload']['parts'][1:]
+
+        runs = max(5, iterations * 20_000 // body_size)
+        legacy_time = timed(lambda: [legacy_parse_message(flat) for _ in range(runs)])[0] / runs
+        new_time = timed(lambda: [gmail._parse_message(flat) for _ in range(runs)])[0] / runs
+        nested = gmail._parse_message(message)
+        legacy_nested = legacy_parse_message(message)
+
+        print(f"  legacy (flat copy): {legacy_time * 1e6:10.1f} us/message")
+        print(f"  single pass:        {new_time * 1e6:10.1f} us/message ({legacy_time / new_time:.1f}x)")
+        print(f"  nested body found:  legacy {bool(legacy_nested['body'])}, new {bool(nested['body'])}")
+        print(f"  attachments found:  legacy {legacy_nested['attachmentCount']}, new {nested['attachmentCount']}")
+
+
+def bench_html_text():
+    """Per-message compression of body text before truncation"""
+    print_section("Body text extraction: per-message compression")
+
+    samples = [
+        ('newsletter', newsletter_html(), html_to_text),
+        ('reply chain', reply_chain_html(), html_to_text),
+        ('plain reply', plain_reply(), strip_quoted_text),
+        ('200 KB report', large_multipart_message('big', body_size=200_000)['payload']['parts'][0]['parts'][0]
+            ['parts'][1]['body']['data'], None),
+    ]
+    for name, source, extract in samples:
+        if extract is None:
+            source = base64.urlsafe_b64decode(source).decode('utf-8')
+            extract = html_to_text
+        elapsed, text = timed(extract, source)
+        print(f"  {name:14s} {len(source):9,d} -> {len(text):7,d} chars  "
+              f"{compression_ratio(source, text):6.1f}x  {elapsed * 1000:7.2f} ms")
+        print(f"  {'':14s} first 2000 chars now: {text[:60]!r}...")
+
+
+def bench_aggregate(gmail):
+    """Count and group a whole (fake) mailbox without loading bodies"""
+    print_section(f"aggregate_emails over {MAILBOX_SIZE:,d} messages")
+
+    for group_by in ('none', 'sender', 'week'):
+        elapsed, result = timed(gmail.aggregate_emails, '', group_by, MAILBOX_SIZE, 5, repeat=1)
+        groups = [(group['key'], group['count']) for group in result.get('groups', [])][:3]
+        print(f"  {group_by:6s} {elapsed * 1000:8.1f} ms  total={result['totalMessages']:,d}  "
+              f"result {len(json.dumps(result)):,d} chars  {groups}")
+
+
+def bench_iter_search(gmail):
+    """Stream a whole (fake) mailbox through iter_search, and stop one early"""
+    print_section(f"iter_search over {MAILBOX_SIZE:,d} messages")
+
+    for stop_after in (25, MAILBOX_SIZE):
+        FakeGmailHandler.bytes_sent = 0
+        tracemalloc.start()
+        start = time.perf_counter()
+        seen = 0
+        for _ in gmail.iter_search('', include_body=False):
+            seen += 1
+            if seen == stop_after:
+                break
+        elapsed = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        print(f"  stop after {stop_after:5,d}: {elapsed * 1000:8.1f} ms  {FakeGmailHandler.bytes_sent:11,d} bytes fetched  "
+              f"peak {peak / 1024:8,.0f} KiB")
+
+
+def legacy_download(gmail, message_id, attachment_id):
+    """The pre-streaming download: whole JSON response, then one full decode"""
+    attachment = gmail.service.users().messages().attachments().get(
+        userId='me', messageId=message_id, id=attachment_id
+    ).execute()
+    return base64.urlsafe_b64decode(attachment['data'].encode('UTF-8'))
+
+
+def bench_attachment(gmail, size):
+    """Peak memory of buffered vs streamed downloads, and byte-range correctness"""
+    print_section(f"Attachment download: {size / 2**20:,.0f} MiB")
+
+    attachment_id = f"blob-{size}"
+    for name, download in (
+        ('buffered', lambda: len(legacy_download(gmail, 'm00001', attachment_id))),
+        ('streamed', lambda: sum(map(len, gmail.open_attachment('m00001', attachment_id).iter_bytes()))),
+    ):
+        tracemalloc.start()
+        start = time.perf_counter()
+        received = download()
+        elapsed = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        print(f"  {name}: {elapsed * 1000:8.1f} ms  {received:13,d} bytes  peak {peak / 2**20:8.1f} MiB")
+
+    expected = fake_attachment(1_000_003)
+    ranges = [(0, None), (1, 2), (2, 1_000_003), (999_999, None), (12_287, 12_290), (500_000, 700_001)]
+    correct = all(
+        b''.join(gmail.open_attachment('m00001', 'blob-1000003', chunk_size=4099).iter_bytes(start, end))
+        == expected[start:end]
+        for start, end in ranges
+    )
+    print(f"  byte ranges match the file: {correct}")
+
+
+def bench_index(gmail, max_results, crawl_size):
+    """Compare API search with answers from the local mailbox index"""
+    print_section(f"Mailbox index: {crawl_size} messages crawled, {max_results} results")
+
+    with tempfile.TemporaryDirectory() as index_dir:
+        index = MailboxIndex('bench@example.com', f"{index_dir}/bench.db")
+
+        start = time.perf_counter()
+        index.build(gmail, max_messages=crawl_size, batch_pause=0)
+        print(f"  initial crawl:      {(time.perf_counter() - start) * 1000:8.1f} ms")
+
+        for query in ('from:carol', 'subject:"Report m000" has:attachment', 'lorem ipsum after:2023/12/01'):
+            api_time, _ = timed(gmail.search_emails, query, max_results)
+            index_time, results = timed(index.search, gmail, query, max_results)
+            answered = 'miss' if results is None else f"{len(results)} hits"
+            print(f"  {query!r}")
+            print(f"    api:   {api_time * 1000:8.1f} ms")
+            print(f"    index: {index_time * 1000:8.1f} ms ({answered})")
+
+        unsupported = index.search(gmail, 'is:unread label:work', max_results)
+        print(f"  unsupported operators fall back to the API: {unsupported is None}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--results', type=int, default=50, help='Search result count (default: 50)')
+    parser.add_argument('--latency-ms', type=float, default=40, help='Simulated round trip per HTTP request')
+    parser.add_argument('--attachment-mb', type=int, default=50, help='Size of the downloaded test attachment')
+    parser.add_argument('--index-size', type=int, default=1000, help='Messages crawled into the mailbox index')
+    args = parser.parse_args()
+
+    server, base_url = start_fake_gmail(args.latency_ms / 1000)
+    print(f"Fake Gmail endpoint: {base_url} ({args.latency_ms:.0f} ms per request)")
+
+    try:
+        gmail = fake_gmail_service(base_url)
+        for count in sorted({10, args.results}):
+            bench_search(gmail, count)
+        bench_metadata_search(gmail, args.results)
+        bench_batch_errors(gmail)
+        bench_scheduler(base_url)
+        bench_parse(gmail)
+        bench_html_text()
+        bench_aggregate(gmail)
+        bench_iter_search(gmail)
+        bench_attachment(gmail, args.attachment_mb * 2**20)
+        bench_index(gmail, args.results, args.index_size)
+    finally:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+"""
+Gmail Client Pool
+Keeps built Gmail API clients per session so requests skip discovery and reuse connections
+"""
+
+import os
+import threading
+import time
+from collections import OrderedDict
+from gmail_service import GmailService
+
+# Maximum number of built clients kept in memory (least recently used go first)
+POOL_MAX_SIZE = int(os.environ.get('GMAIL_POOL_MAX_SIZE', '200'))
+
+# Clients not used for this many seconds are dropped
+POOL_IDLE_SECONDS = int(os.environ.get('GMAIL_POOL_IDLE_SECONDS', '1800'))
+
+
+class GmailClientPool:
+    def __init__(self, max_size=POOL_MAX_SIZE, idle_seconds=POOL_IDLE_SECONDS, message_cache=None,
+                 mailbox_indexes=None):
+        """
+        Initialize the client pool
+
+        Args:
+            max_size: Maximum number of clients to keep
+            idle_seconds: Idle time after which a client is evicted
+            message_cache: Optional MessageCache handed to every client
+            mailbox_indexes: Optional MailboxIndexes; each client gets its user's index
+        """
+        self.max_size = max_size
+        self.idle_seconds = idle_seconds
+        self.message_cache = message_cache
+        self.mailbox_indexes = mailbox_indexes
+
+        # Key: session_id -> Value: (GmailService, last_used), oldest first
+        self._clients = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, credentials, user=None):
+        """
+        Get the Gmail client for a session, building it on first use
+
+        Args:
+            key: Session ID (or any per-user key)
+            credentials: Current Google OAuth credentials for that session
+            user: User email, used to key cached messages
+
+        Returns:
+            GmailService instance
+        """
+        now = time.monotonic()
+
+        with self._lock:
+            self._evict_idle(now)
+            entry = self._clients.pop(key, None)
+            if entry is not None:
+                self._clients[key] = (entry[0], now)
+
+        if entry is None:
+            # Build outside the lock, discovery parsing is the slow part
+            mailbox_index = None
+            if self.mailbox_indexes is not None and user:
+                mailbox_index = self.mailbox_indexes.get(user)
+            gmail_service = GmailService.from_credentials(
+                credentials, user=user, message_cache=self.message_cache, mailbox_index=mailbox_index
+            )
+            with self._lock:
+                self._clients[key] = (gmail_service, now)
+                while len(self._clients) > self.max_size:
+                    self._clients.popitem(last=False)
+            return gmail_service
+
+        gmail_service = entry[0]
+        if gmail_service.credentials is not credentials:
+            gmail_service.update_credentials(credentials)
+        return gmail_service
+
+    def discard(self, key):
+        """
+        Drop the client for a session (e.g. on logout)
+
+        Args:
+            key: Session ID used with get()
+        """
+        with self._lock:
+            self._clients.pop(key, None)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._clients)
+
+    def _evict_idle(self, now):
+        """Remove clients idle for longer than idle_seconds (caller holds the lock)"""
+        while self._clients:
+            key, (_, last_used) = next(iter(self._clients.items()))
+            if now - last_used < self.idle_seconds:
+                break
+            del self._clients[key]
@@ -0,0 +1,461 @@
+"""
+Gmail Scheduler Module
+Paces Gmail API calls per user with a token bucket measured in Gmail quota
+units, retries rate-limited and failed calls with jittered exponential
+backoff, and turns what still fails into typed GmailAPIError exceptions
+"""
+
+import os
+import random
+import socket
+import threading
+import time
+from collections import OrderedDict
+from email.utils import parsedate_to_datetime
+
+import httplib2
+import requests
+from googleapiclient.errors import HttpError
+
+from metrics import GMAIL_CALL_SECONDS, GMAIL_RETRIES, count_error
+from tracing import span
+
+# Quota units per call (https://developers.google.com/gmail/api/reference/quota)
+QUOTA_UNITS = {
+    'messages.list': 5,
+    'messages.get': 5,
+    'messages.attachments.get': 5,
+    'threads.get': 10,
+    'history.list': 2,
+    'labels.list': 1,
+    'getProfile': 1,
+}
+
+# Gmail allows 250 units per user per second (15,000 per minute); this is per
+# process, so divide it by the number of workers serving the same users (0 disables pacing)
+USER_UNITS_PER_SECOND = float(os.environ.get('GMAIL_USER_UNITS_PER_SECOND', '250'))
+
+# Units a user may spend at once after being idle
+USER_BURST_UNITS = float(os.environ.get('GMAIL_USER_BURST_UNITS', '250'))
+
+# After a rate-limit response the user's rate is cut to this share, then recovers
+THROTTLE_FACTOR = 0.5
+MIN_UNITS_PER_SECOND = 10
+
+# Each successful call gives back this share of the configured rate
+RECOVERY_SHARE = 0.02
+
+# Retries after the first attempt, and the backoff bounds in seconds
+MAX_RETRIES = int(os.environ.get('GMAIL_MAX_RETRIES', '4'))
+BACKOFF_BASE_SECONDS = 0.5
+BACKOFF_MAX_SECONDS = 16
+
+# Never sleep longer than this for a Retry-After; fail instead
+MAX_RETRY_AFTER_SECONDS = 30
+
+# A user's bucket unused for this long is dropped (it would have refilled and recovered by then anyway)
+BUCKET_IDLE_SECONDS = 600
+
+# Reasons Gmail gives for 403s that are really rate limits
+RATE_LIMIT_REASONS = {'rateLimitExceeded', 'userRateLimitExceeded'}
+QUOTA_REASONS = {'quotaExceeded', 'dailyLimitExceeded'}
+
+# Transport failures worth retrying
+NETWORK_ERRORS = (
+    socket.timeout, TimeoutError, ConnectionError, httplib2.HttpLib2Error,
+    requests.ConnectionError, requests.Timeout
+)
+
+
+class GmailAPIError(Exception):
+    """A Gmail call that failed for good, with what kind of failure it was"""
+
+    # kind -> HTTP status used when the error reaches a client directly
+    HTTP_STATUS = {
+        'rate_limited': 429,
+        'quota_exceeded': 429,
+        'not_found': 404,
+        'permission_denied': 403,
+        'unauthenticated': 401,
+        'invalid_request': 400,
+    }
+
+    def __init__(self, kind, message, status=None, retryable=False, retry_after=None):
+        """
+        Args:
+            kind: rate_limited, quota_exceeded, not_found, permission_denied,
+                unauthenticated, invalid_request, server_error or network_error
+            message: Human readable description
+            status: HTTP status from Gmail, if there was a response
+            retryable: True if trying again later may succeed
+            retry_after: Seconds Gmail asked us to wait, if it said
+        """
+        super().__init__(message)
+        self.kind = kind
+        self.message = message
+        self.status = status
+        self.retryable = retryable
+        self.retry_after = retry_after
+
+    @property
+    def http_status(self):
+        return self.HTTP_STATUS.get(self.kind, 502)
+
+    def to_dict(self):
+        """Typed error result for the tool layer and API responses"""
+        result = {'error': self.message, 'kind': self.kind, 'retryable': self.retryable}
+        if self.retry_after is not None:
+            result['retryAfter'] = round(self.retry_after, 1)
+        return result
+
+
+def classify_status(status, reasons=(), retry_after=None, message=None):
+    """
+    Build a GmailAPIError from an HTTP status and Gmail's error reasons
+
+    Args:
+        status: HTTP status code
+        reasons: Reason strings from the error body (e.g. 'rateLimitExceeded')
+        retry_after: Parsed Retry-After in seconds, if any
+        message: Error text (defaults to the status)
+    """
+    message = message or f"Gmail returned HTTP {status}"
+    reasons = set(reasons)
+    if reasons & QUOTA_REASONS:
+        return GmailAPIError('quota_exceeded', message, status, False, retry_after)
+    if status == 429 or reasons & RATE_LIMIT_REASONS:
+        return GmailAPIError('rate_limited', message, status, True, retry_after)
+    if status >= 500:
+        return GmailAPIError('server_error', message, status, True, retry_after)
+    kind = {401: 'unauthenticated', 403: 'permission_denied', 404: 'not_found'}.get(status, 'invalid_request')
+    return GmailAPIError(kind, message, status, False, retry_after)
+
+
+def classify_exception(error):
+    """
+    Turn a googleapiclient/transport exception into a GmailAPIError
+
+    Returns:
+        GmailAPIError, or None if the exception isn't a Gmail failure (re-raise it)
+    """
+    if isinstance(error, GmailAPIError):
+        return error
+    if isinstance(error, HttpError):
+        details = getattr(error, 'error_details', None)
+        reasons = [detail.get('reason') for detail in details if isinstance(detail, dict)] if isinstance(details, list) else []
+        return classify_status(
+            error.resp.status,
+            reasons,
+            parse_retry_after(error.resp.get('retry-after')),
+            getattr(error, 'reason', None) or str(error)
+        )
+    if isinstance(error, NETWORK_ERRORS):
+        return GmailAPIError('network_error', f"Could not reach Gmail: {error}", retryable=True)
+    return None
+
+
+def parse_retry_after(value):
+    """Retry-After header (seconds or HTTP date) -> seconds, or None"""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def backoff_delay(attempt, retry_after=None):
+    """Full-jitter exponential backoff, never shorter than Retry-After"""
+    delay = random.uniform(0, min(BACKOFF_MAX_SECONDS, BACKOFF_BASE_SECONDS * 2 ** attempt))
+    if retry_after is not None:
+        delay = max(delay, retry_after)
+    return delay
+
+
+class TokenBucket:
+    def __init__(self, rate=USER_UNITS_PER_SECOND, burst=USER_BURST_UNITS):
+        """
+        Quota-unit bucket for one user
+
+        Callers reserve units and sleep off any debt, so waiting callers are
+        served in order and nobody spins.
+
+        Args:
+            rate: Units added per second (0 for no pacing)
+            burst: Most units that can accumulate
+        """
+        self.max_rate = rate
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def reserve(self, units):
+        """
+        Take units from the bucket
+
+        Returns:
+            Seconds the caller must wait before sending
+        """
+        with self._lock:
+            now = time.monotonic()
+            if not self.max_rate:
+                return max(0.0, self.paused_until - now)
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= units
+            debt = -self.tokens / self.rate if self.tokens < 0 else 0.0
+            return max(debt, self.paused_until - now)
+
+    def throttled(self, pause):
+        """Gmail pushed back: slow this user down and hold everyone for `pause` seconds"""
+        with self._lock:
+            if self.max_rate:
+                self.rate = max(MIN_UNITS_PER_SECOND, self.rate * THROTTLE_FACTOR)
+            self.paused_until = max(self.paused_until, time.monotonic() + pause)
+
+    def succeeded(self):
+        """Additive recovery toward the configured rate"""
+        if self.rate < self.max_rate:
+            with self._lock:
+                self.rate = min(self.max_rate, self.rate + self.max_rate * RECOVERY_SHARE)
+
+
+class GmailScheduler:
+    def __init__(self, rate=USER_UNITS_PER_SECOND, burst=USER_BURST_UNITS, max_retries=MAX_RETRIES,
+                 idle_seconds=BUCKET_IDLE_SECONDS):
+        """
+        Initialize the scheduler
+
+        Args:
+            rate: Quota units per second per user (0 for no pacing)
+            burst: Units a user may spend at once after being idle
+            max_retries: Retries after the first attempt
+            idle_seconds: Idle time after which a user's bucket is dropped
+        """
+        self.rate = rate
+        self.burst = burst
+        self.max_retries = max_retries
+        self.idle_seconds = idle_seconds
+
+        # Key: user -> Value: (TokenBucket, last_used), least recently used first
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+        self._counters = {
+            'calls': 0,
+            'retries': 0,
+            'throttled': 0,
+            'failures': 0,
+            'wait_seconds': 0.0,
+        }
+
+    def execute(self, user, method, request):
+        """
+        Run one googleapiclient request under the user's quota, with retries
+
+        Args:
+            user: Key of the quota bucket (user email)
+            method: Gmail method name, a key of QUOTA_UNITS
+            request: HttpRequest (re-executed on retry)
+
+        Returns:
+            The response
+
+        Raises:
+            GmailAPIError: If the call fails for good
+        """
+        return self.call(user, method, request.execute)
+
+    def call(self, user, method, fn, units=None):
+        """
+        Run any Gmail call under the user's quota, with retries
+
+        Args:
+            user: Key of the quota bucket
+            method: Gmail method name, a key of QUOTA_UNITS
+            fn: No-argument callable making the call; raises HttpError,
+                GmailAPIError or a transport error on failure
+            units: Quota units to charge (default: the method's cost)
+
+        Returns:
+            What fn returns
+
+        Raises:
+            GmailAPIError: If the call fails for good
+        """
+        bucket = self._bucket(user)
+        units = QUOTA_UNITS.get(method, 5) if units is None else units
+
+        for attempt in range(self.max_retries + 1):
+            self._wait(bucket.reserve(units))
+            started = time.monotonic()
+            try:
+                with span(f"gmail:{method}", attempt=attempt + 1):
+                    result = fn()
+            except Exception as error:
+                failure = classify_exception(error)
+                if failure is None:
+                    raise
+                if not self._retry(bucket, failure, attempt, method):
+                    self._count('failures')
+                    count_error('gmail', failure)
+                    raise failure from error
+                self._count('retries')
+                GMAIL_RETRIES.labels(method, failure.kind).inc()
+                continue
+            finally:
+                GMAIL_CALL_SECONDS.labels(method, 'false').observe(time.monotonic() - started)
+
+            bucket.succeeded()
+            self._count('calls')
+            return result
+
+    def execute_batch(self, user, method, service, keys, build):
+        """
+        Run one request per key as batched calls, retrying only the ones that failed
+
+        Args:
+            user: Key of the quota bucket
+            method: Gmail method name of every request in the batch
+            service: Gmail API resource (for new_batch_http_request)
+            keys: Request keys (unique strings, e.g. message IDs)
+            build: Callable key -> HttpRequest
+
+        Returns:
+            (responses, errors): dicts key -> response and key -> GmailAPIError
+        """
+        bucket = self._bucket(user)
+        responses = {}
+        errors = {}
+        todo = list(keys)
+
+        for attempt in range(self.max_retries + 1):
+            if not todo:
+                break
+            self._wait(bucket.reserve(QUOTA_UNITS.get(method, 5) * len(todo)))
+
+            failed = {}
+
+            def on_response(request_id, response, exception):
+                if exception is None:
+                    responses[request_id] = response
+                    return
+                failure = classify_exception(exception)
+                failed[request_id] = failure or GmailAPIError('server_error', str(exception))
+
+            batch = service.new_batch_http_request(callback=on_response)
+            for key in todo:
+                batch.add(build(key), request_id=key)
+            started = time.monotonic()
+            try:
+                with span(f"gmail:{method} batch", calls=len(todo), attempt=attempt + 1):
+                    batch.execute()
+            except Exception as error:
+                # The batch request itself failed: every call in it did
+                failure = classify_exception(error)
+                if failure is None:
+                    raise
+                failed = {key: failure for key in todo if key not in responses}
+            finally:
+                GMAIL_CALL_SECONDS.labels(method, 'true').observe(time.monotonic() - started)
+
+            retryable = [key for key in todo if key in failed and failed[key].retryable]
+            for key in todo:
+                if key in failed and not failed[key].retryable:
+                    errors[key] = failed[key]
+            if not retryable:
+                bucket.succeeded()
+                break
+
+            # Back off once for the whole group, honoring the longest Retry-After
+            worst = max((failed[key] for key in retryable), key=lambda failure: failure.retry_after or 0)
+            if not self._retry(bucket, worst, attempt, method):
+                for key in retryable:
+                    errors[key] = failed[key]
+                break
+            self._count('retries', len(retryable))
+            for key in retryable:
+                GMAIL_RETRIES.labels(method, failed[key].kind).inc()
+            todo = retryable
+
+        self._count('calls', len(responses))
+        if errors:
+            self._count('failures', len(errors))
+            for error in errors.values():
+                count_error('gmail', error)
+            print(f"Gmail {method}: {len(errors)} of {len(keys)} calls failed "
+                  f"({', '.join(sorted({error.kind for error in errors.values()}))})")
+        return responses, errors
+
+    def stats(self):
+        """
+        Get call/retry counters and each user's current rate
+
+        Returns:
+            Dict of counters
+        """
+        with self._lock:
+            self._evict_idle(time.monotonic())
+            stats = dict(self._counters)
+            stats['wait_seconds'] = round(stats['wait_seconds'], 2)
+            stats['users'] = len(self._buckets)
+            stats['throttled_users'] = sum(
+                1 for bucket, _ in self._buckets.values() if bucket.rate < bucket.max_rate
+            )
+        return stats
+
+    def _retry(self, bucket, failure, attempt, method):
+        """Sleep before another attempt; returns False if the failure is final"""
+        if not failure.retryable or attempt >= self.max_retries:
+            return False
+        if failure.retry_after is not None and failure.retry_after > MAX_RETRY_AFTER_SECONDS:
+            return False
+
+        delay = backoff_delay(attempt, failure.retry_after)
+        if failure.kind == 'rate_limited':
+            # Everyone calling for this user waits too, not just this thread
+            bucket.throttled(delay)
+            self._count('throttled')
+        print(f"Gmail {method}: {failure.kind} ({failure.status or '-'}), retry {attempt + 1} in {delay:.1f}s")
+        self._wait(delay)
+        return True
+
+    def _wait(self, seconds):
+        if seconds > 0:
+            with self._lock:
+                self._counters['wait_seconds'] += seconds
+            with span('gmail:wait', seconds=round(seconds, 3)):
+                time.sleep(seconds)
+
+    def _count(self, counter, n=1):
+        with self._lock:
+            self._counters[counter] += n
+
+    def _bucket(self, user):
+        key = user or ''
+        now = time.monotonic()
+        with self._lock:
+            self._evict_idle(now)
+            entry = self._buckets.pop(key, None)
+            bucket = entry[0] if entry is not None else TokenBucket(self.rate, self.burst)
+            self._buckets[key] = (bucket, now)
+            return bucket
+
+    def _evict_idle(self, now):
+        """Drop buckets unused for longer than idle_seconds (caller holds the lock)"""
+        while self._buckets:
+            key, (_, last_used) = next(iter(self._buckets.items()))
+            if now - last_used < self.idle_seconds:
+                break
+            del self._buckets[key]
+
+
+# Shared by every GmailService in the process, so one user's calls are paced together
+gmail_scheduler = GmailScheduler()
@@ -5,12 +5,28 @@ Handles Gmail API operations
 
 import os
 import base64
+import codecs
 import json
+import re
+import threading
+import urllib.parse
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+from email.utils import parseaddr
+from functools import partial
+import httplib2
+import google_auth_httplib2
+import requests
 from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
 from googleapiclient.discovery import build
-from googleapiclient.errors import HttpError
+from googleapiclient.http import HttpRequest
+from gmail_scheduler import GmailAPIError, classify_status, gmail_scheduler, parse_retry_after
+from html_text import html_to_text, strip_quoted_text
+from metrics import observe_cache
+from result_governor import fair_shares
+from tracing import traced
 
 # Gmail API scopes (kept for backwards compatibility with desktop flow)
 SCOPES = [
@@ -18,9 +34,80 @@ SCOPES = [
     'https://www.googleapis.com/auth/gmail.modify'
 ]
 
+# Gmail accepts up to 100 calls per batch request, but recommends staying
+# at 50 or fewer to avoid per-user concurrency rate limiting
+BATCH_SIZE = 50
+
+# Body characters returned per message (~500 tokens) to stay within Claude's context
+MAX_BODY_LENGTH = 2000
+
+# HTML is decoded this many times the needed text length up front, since markup
+# and quoted text are stripped before truncation
+HTML_DECODE_FACTOR = 10
+
+# get_emails: most messages per call, and body characters shared across all of them
+BULK_MAX_MESSAGES = BATCH_SIZE
+BULK_BODY_BUDGET = int(os.environ.get('GET_EMAILS_BODY_BUDGET', '16000'))
+
+# aggregate_emails: most messages scanned per call, and most day/week buckets returned
+AGGREGATE_MAX_MESSAGES = int(os.environ.get('AGGREGATE_MAX_MESSAGES', '5000'))
+AGGREGATE_MAX_BUCKETS = 120
+
+# The smallest response that still carries each grouping's key
+AGGREGATE_FETCH = {
+    'sender': {'format': 'metadata', 'metadataHeaders': ['From'], 'fields': 'id,payload/headers'},
+    'domain': {'format': 'metadata', 'metadataHeaders': ['From'], 'fields': 'id,payload/headers'},
+    'label': {'format': 'minimal', 'fields': 'id,labelIds'},
+    'day': {'format': 'minimal', 'fields': 'id,internalDate'},
+    'week': {'format': 'minimal', 'fields': 'id,internalDate'},
+}
+
+# Repeated paragraphs shorter than this are kept ("Thanks!", "Sounds good")
+THREAD_DEDUP_MIN_CHARS = 40
+
+# Gmail API root, for requests made outside the discovery client
+GMAIL_API_ROOT = 'https://gmail.googleapis.com/'
+
+# Base64 characters read from Gmail per step when streaming an attachment
+ATTACHMENT_CHUNK_SIZE = 256 * 1024
+
+# Seconds to wait for Gmail to connect and between streamed chunks
+ATTACHMENT_TIMEOUT_SECONDS = 60
+
+# Socket timeout for API calls, so a hung connection can't hold a tool thread forever
+GMAIL_HTTP_TIMEOUT_SECONDS = float(os.environ.get('GMAIL_HTTP_TIMEOUT_SECONDS', '30'))
+
+# Headers and response fields requested for metadata-only searches
+METADATA_HEADERS = ['Subject', 'From', 'To', 'Date']
+METADATA_FIELDS = 'id,threadId,snippet,payload/headers'
+
+# Keep-alive transports, one per thread and shared by every user's client (neither
+# httplib2.Http nor requests.Session is thread-safe), so open connections grow
+# with threads rather than with users x threads and nothing is left behind
+# when a pooled client is dropped
+_transports = threading.local()
+
+
+def _thread_http():
+    """The calling thread's httplib2 transport for discovery-client requests"""
+    http = getattr(_transports, 'http', None)
+    if http is None:
+        http = _transports.http = httplib2.Http(timeout=GMAIL_HTTP_TIMEOUT_SECONDS)
+    return http
+
+
+def _thread_session():
+    """The calling thread's requests session, used where httplib2 can't stream a response body"""
+    session = getattr(_transports, 'session', None)
+    if session is None:
+        session = _transports.session = requests.Session()
+    return session
+
 
 class GmailService:
-    def __init__(self, credentials=None, credentials_file='credentials.json', token_file='token.json'):
+    def __init__(self, credentials=None, credentials_file='credentials.json', token_file='token.json',
+                 service=None, user=None, message_cache=None, mailbox_index=None, api_root=GMAIL_API_ROOT,
+                 scheduler=gmail_scheduler):
         """
         Initialize Gmail service
 
@@ -28,31 +115,49 @@ class GmailService:
             credentials: Pre-authenticated Google credentials (for web OAuth flow)
             credentials_file: Path to credentials.json (for desktop flow, backwards compatible)
             token_file: Path to token.json (for desktop flow, backwards compatible)
+            service: Pre-built Gmail API resource (e.g. pointed at a fake endpoint for benchmarks)
+            user: User identifier (email) used to key cached messages
+            message_cache: Optional MessageCache shared across requests
+            mailbox_index: Optional MailboxIndex that answers searches locally
+            api_root: Gmail API root for streamed attachment downloads
+            scheduler: GmailScheduler pacing and retrying this user's calls
         """
         self.credentials_file = credentials_file
         self.token_file = token_file
-        self.service = None
+        self.credentials = credentials
+        self.service = service
+        self.user = user
+        self.message_cache = message_cache
+        self.mailbox_index = mailbox_index
+        self.api_root = api_root
+        self.scheduler = scheduler
+
+        if service is not None:
+            return
 
         if credentials:
             # Use provided credentials (web OAuth flow)
-            self.service = build('gmail', 'v1', credentials=credentials)
+            self.service = self._build_service(credentials)
             print("Gmail API initialized with provided credentials")
         else:
             # Backwards compatible: auto-authenticate with desktop flow
             self.authenticate()
 
     @classmethod
-    def from_credentials(cls, credentials):
+    def from_credentials(cls, credentials, user=None, message_cache=None, mailbox_index=None):
         """
         Create a GmailService instance from existing OAuth credentials
 
         Args:
             credentials: Google OAuth2 credentials object
+            user: User identifier (email) used to key cached messages
+            message_cache: Optional MessageCache shared across requests
+            mailbox_index: Optional MailboxIndex that answers searches locally
 
         Returns:
             GmailService instance
         """
-        return cls(credentials=credentials)
+        return cls(credentials=credentials, user=user, message_cache=message_cache, mailbox_index=mailbox_index)
 
     def authenticate(self):
         """Authenticate with Gmail API using OAuth 2.0 (desktop flow)"""
@@ -81,49 +186,135 @@ class GmailService:
             with open(self.token_file, 'w') as token:
                 token.write(creds.to_json())
 
-        self.service = build('gmail', 'v1', credentials=creds)
+        self.credentials = creds
+        self.service = self._build_service(creds)
         print("Gmail API authenticated successfully (desktop flow)")
 
-    def search_emails(self, query, max_results=10):
+    def update_credentials(self, credentials):
+        """
+        Swap in refreshed credentials without rebuilding the API client
+
+        Args:
+            credentials: Google OAuth2 credentials object
+        """
+        self.credentials = credentials
+
+    def _build_service(self, credentials):
+        """Build the Gmail API resource, routing requests through per-thread transports"""
+        return build('gmail', 'v1', credentials=credentials, requestBuilder=self._build_request)
+
+    def _build_request(self, http, *args, **kwargs):
+        """requestBuilder hook: ignore the shared transport and use this thread's one"""
+        return HttpRequest(self._http(), *args, **kwargs)
+
+    def _http(self):
+        """
+        Authorize the calling thread's shared transport with this client's credentials
+
+        The wrapper is cheap; the keep-alive connections live in the per-thread
+        httplib2.Http underneath it.
+        """
+        return google_auth_httplib2.AuthorizedHttp(self.credentials, http=_thread_http())
+
+    def _get(self, url, **kwargs):
+        """GET with the calling thread's requests session, authorized with this client's credentials"""
+        session = _thread_session()
+        headers = {}
+        # Without credentials the service was pre-built (e.g. a fake endpoint for benchmarks)
+        if self.credentials is not None:
+            self.credentials.before_request(Request(session), 'GET', url, headers)
+        return session.get(url, headers=headers, **kwargs)
+
+    def _execute(self, method, request):
+        """
+        Run a Gmail API request under this user's quota, retrying transient failures
+
+        Args:
+            method: Gmail method name (for quota costs, e.g. 'messages.list')
+            request: HttpRequest from the discovery client
+
+        Raises:
+            GmailAPIError: If the call fails for good
+        """
+        return self.scheduler.execute(self.user, method, request)
+
+    @traced()
+    def search_emails(self, query, max_results=10, include_body=True, errors=None):
         """
         Search emails using Gmail search syntax
 
         Args:
             query: Gmail search query (e.g., "from:example@gmail.com subject:important")
             max_results: Maximum number of results to return
+            include_body: If False, fetch only headers and snippet (format='metadata');
+                bodies can be loaded later with get_email_content
+            errors: Optional dict filled with message ID -> GmailAPIError for
+                matches that could not be fetched
 
         Returns:
-            List of email message objects with metadata
+            List of email message objects with metadata; if Gmail fails part-way,
+            the messages fetched before the failure
+
+        Raises:
+            GmailAPIError: If Gmail fails before any message was fetched (rate
+                limits are retried first); when every fetch failed, the most
+                common error kind is raised
         """
+        if self.mailbox_index is not None:
+            indexed = self.mailbox_index.search(self, query, max_results)
+            observe_cache('mailbox_index', 'miss' if indexed is None else 'hit')
+            if indexed is not None:
+                return indexed if include_body else [self._summarize(message) for message in indexed]
+
+        failed = {} if errors is None else errors
+        results = []
         try:
-            results = self.service.users().messages().list(
-                userId='me',
-                q=query,
-                maxResults=max_results
-            ).execute()
+            for message in self.iter_search(query, max_results, include_body, errors=failed):
+                results.append(message)
+        except GmailAPIError as error:
+            if not results:
+                raise
+            # A later page or batch failed: keep what was already fetched
+            print(f"Search '{query}' stopped after {len(results)} results: {error.kind} ({error})")
 
-            messages = results.get('messages', [])
+        if not results and failed:
+            # Matches exist but none could be read: that is an error, not "no emails found"
+            kind, _ = Counter(error.kind for error in failed.values()).most_common(1)[0]
+            raise next(error for error in failed.values() if error.kind == kind)
+        return results
 
-            if not messages:
-                return []
+    def iter_search(self, query, max_results=None, include_body=True, chunk_size=BATCH_SIZE, errors=None):
+        """
+        Iterate over search results, paging and fetching lazily
 
-            # Fetch full message details for each result
-            detailed_messages = []
-            for message in messages:
-                msg = self.service.users().messages().get(
-                    userId='me',
-                    id=message['id'],
-                    format='full'
-                ).execute()
+        Only one page of IDs and one chunk of messages are held at a time, so
+        memory stays flat however many results there are, and stopping early
+        skips the remaining fetches.
 
-                detailed_messages.append(self._parse_message(msg))
+        Args:
+            query: Gmail search query
+            max_results: Stop after this many messages (None for all matches)
+            include_body: If False, yield metadata-only summaries
+            chunk_size: Messages fetched per batch request
+            errors: Optional dict filled with message ID -> GmailAPIError for
+                matches that could not be fetched (they are not yielded)
 
-            return detailed_messages
+        Yields:
+            Parsed messages in search order
 
-        except HttpError as error:
-            print(f"An error occurred: {error}")
-            return []
+        Raises:
+            GmailAPIError: If a list or batch request fails
+        """
+        for page, _ in self._iter_message_ids(query, max_results):
+            for start in range(0, len(page), chunk_size):
+                chunk = page[start:start + chunk_size]
+                if include_body:
+                    messages, parse = self._get_full_messages(chunk, errors), self._parse_message
+                else:
+                    messages, parse = self._get_metadata_messages(chunk, errors), self._parse_metadata
+                yield from (parse(message) for message in messages if message is not None)
 
+    @traced()
     def get_email_content(self, message_id):
         """
         Get full content of a specific email
@@ -132,21 +323,259 @@ class GmailService:
             message_id: Gmail message ID
 
         Returns:
-            Parsed message object with full content
+            Parsed message object with full content (quoted replies and
+            signatures are kept, unlike in search and bulk results)
+
+        Raises:
+            GmailAPIError: If the message can't be fetched
         """
-        try:
-            message = self.service.users().messages().get(
+        return self._parse_message(self._get_full_message(message_id), strip_quotes=False)
+
+    @traced()
+    def get_emails(self, message_ids, body_budget=BULK_BODY_BUDGET):
+        """
+        Get several emails at once, from the cache or in batched requests
+
+        Bodies share one size budget: short ones are kept whole and the rest
+        split what is left.
+
+        Args:
+            message_ids: List of Gmail message IDs (at most BULK_MAX_MESSAGES are read)
+            body_budget: Total body characters across all returned emails
+
+        Returns:
+            List of compact message objects in the requested order; messages
+            that failed to load carry a typed error instead
+        """
+        message_ids = list(dict.fromkeys(message_ids))[:BULK_MAX_MESSAGES]
+
+        errors = {}
+        messages = self._get_full_messages(message_ids, errors)
+
+        parsed = [self._parse_message(message) if message is not None else None for message in messages]
+        shares = fair_shares([len(email['body']) if email else 0 for email in parsed], body_budget)
+
+        results = []
+        for message_id, email, share in zip(message_ids, parsed, shares):
+            if email is None:
+                error = errors.get(message_id)
+                results.append(dict({'id': message_id}, **(
+                    error.to_dict() if error else {'error': 'Message not found or could not be loaded'}
+                )))
+                continue
+            body = email['body']
+            results.append({
+                'id': email['id'],
+                'threadId': email['threadId'],
+                'subject': email['subject'],
+                'from': email['from'],
+                'date': email['date'],
+                'body': body[:share] + '...' if len(body) > share else body,
+                'attachmentCount': email['attachmentCount']
+            })
+
+        return results
+
+    @traced()
+    def aggregate_emails(self, query='', group_by='sender', max_messages=2000, top=20):
+        """
+        Count the messages matching a query, optionally grouped, without loading bodies
+
+        Pages through the matching message IDs and, page by page, fetches
+        only the field the grouping needs in batches.
+
+        Args:
+            query: Gmail search query ('' for all mail)
+            group_by: 'sender', 'domain', 'label', 'day', 'week' or 'none'
+            max_messages: Stop after this many messages (capped at AGGREGATE_MAX_MESSAGES)
+            top: Number of largest sender/domain/label groups to return
+
+        Returns:
+            Dict with the total and the groups, or an error dict for a bad group_by
+
+        Raises:
+            GmailAPIError: If listing fails (single failed messages are only counted)
+        """
+        if group_by != 'none' and group_by not in AGGREGATE_FETCH:
+            return {'error': f"Unknown group_by '{group_by}'"}
+
+        label_names = self._label_names() if group_by == 'label' else {}
+        counts = Counter()
+        names = {}
+        total = 0
+        failed = 0
+        more = False
+        limit = min(max_messages, AGGREGATE_MAX_MESSAGES)
+        for page, more in self._iter_message_ids(query, limit):
+            total += len(page)
+            if group_by == 'none':
+                continue
+            for start in range(0, len(page), BATCH_SIZE):
+                for message in self._batch_get(page[start:start + BATCH_SIZE], **AGGREGATE_FETCH[group_by]):
+                    if message is None:
+                        failed += 1
+                        continue
+                    counts.update(self._group_keys(message, group_by, label_names, names))
+
+        result = {
+            'query': query,
+            'groupBy': group_by,
+            'totalMessages': total,
+            # False when max_messages stopped the scan before the end of the results
+            'complete': not more
+        }
+        if group_by == 'none':
+            return result
+
+        if group_by in ('day', 'week'):
+            # Chronological, most recent buckets if there are too many
+            keys = sorted(counts)[-AGGREGATE_MAX_BUCKETS:]
+        else:
+            keys = [key for key, _ in counts.most_common(top)]
+
+        groups = []
+        for key in keys:
+            group = {'key': key, 'count': counts[key]}
+            if names.get(key):
+                group['name'] = names[key]
+            groups.append(group)
+
+        result['groups'] = groups
+        result['otherGroups'] = len(counts) - len(groups)
+        result['otherCount'] = sum(counts.values()) - sum(group['count'] for group in groups)
+        if failed:
+            result['failedMessages'] = failed
+        return result
+
+    def _iter_message_ids(self, query, limit=None, page_size=500):
+        """
+        Page through messages().list lazily
+
+        Args:
+            query: Gmail search query (None or '' for all mail)
+            limit: Stop after this many IDs (None for no limit)
+            page_size: IDs per list call (Gmail allows up to 500)
+
+        Yields:
+            (message_ids, more) per page, where `more` is True if further
+            matches exist beyond this page (including ones `limit` cut off)
+        """
+        seen = 0
+        page_token = None
+        while limit is None or seen < limit:
+            response = self._execute('messages.list', self.service.users().messages().list(
                 userId='me',
-                id=message_id,
-                format='full'
-            ).execute()
+                q=query or None,
+                maxResults=page_size if limit is None else min(page_size, limit - seen),
+                pageToken=page_token,
+                fields='messages/id,nextPageToken'
+            ))
+            message_ids = [message['id'] for message in response.get('messages', [])]
+            page_token = response.get('nextPageToken')
+            seen += len(message_ids)
+            yield message_ids, bool(page_token)
+            if not page_token:
+                return
 
-            return self._parse_message(message)
+    @traced()
+    def _label_names(self):
+        """Label ID -> display name (user labels have opaque IDs like Label_12)"""
+        response = self._execute('labels.list', self.service.users().labels().list(userId='me'))
+        return {label['id']: label.get('name', label['id']) for label in response.get('labels', [])}
 
-        except HttpError as error:
-            print(f"An error occurred: {error}")
-            return None
+    def _group_keys(self, message, group_by, label_names, names):
+        """Grouping keys for one message; sender display names are recorded in `names`"""
+        if group_by in ('sender', 'domain'):
+            name, address = parseaddr(self._header_dict(message.get('payload', {})).get('from', ''))
+            address = address.lower() or 'unknown'
+            if group_by == 'domain':
+                return [address.rsplit('@', 1)[-1]]
+            names.setdefault(address, name)
+            return [address]
+
+        if group_by == 'label':
+            return [label_names.get(label, label) for label in message.get('labelIds', [])]
+
+        # Day and week buckets are in UTC
+        day = datetime.fromtimestamp(int(message.get('internalDate', 0)) / 1000, timezone.utc).date()
+        if group_by == 'week':
+            day -= timedelta(days=day.weekday())
+        return [day.isoformat()]
+
+    @traced()
+    def get_thread(self, thread_id):
+        """
+        Get a whole conversation with one threads().get call
 
+        Messages come back oldest first. Paragraphs already seen in an earlier
+        message (quoted text that wasn't marked as a quote) are left out.
+
+        Args:
+            thread_id: Gmail thread ID
+
+        Returns:
+            Thread dict with its messages
+
+        Raises:
+            GmailAPIError: If the thread can't be fetched
+        """
+        thread = self._execute('threads.get', self.service.users().threads().get(
+            userId='me',
+            id=thread_id,
+            format='full'
+        ))
+
+        messages = sorted(thread.get('messages', []), key=lambda message: int(message.get('internalDate', 0)))
+
+        # Later get_email_content/list_attachments calls on these messages hit the cache
+        if self.message_cache is not None and self.user:
+            for message in messages:
+                self.message_cache.put(self.user, message['id'], message)
+
+        seen = set()
+        parsed_messages = []
+        for message in messages:
+            headers = self._header_dict(message['payload'])
+            text_part, html_part, attachments = self._walk_payload(message['payload'])
+
+            # Look past the truncation limit so repeated paragraphs are dropped before cutting
+            body = self._dedupe_paragraphs(self._body_text(text_part, html_part, MAX_BODY_LENGTH * 4), seen)
+
+            parsed_messages.append({
+                'id': message['id'],
+                'from': headers.get('from', 'Unknown'),
+                'to': headers.get('to', 'Unknown'),
+                'date': headers.get('date', 'Unknown'),
+                'body': body[:MAX_BODY_LENGTH] + '...' if len(body) > MAX_BODY_LENGTH else body,
+                'hasAttachments': bool(attachments),
+                'attachmentCount': len(attachments)
+            })
+
+        subject = 'No Subject'
+        if messages:
+            subject = self._header_dict(messages[0]['payload']).get('subject', subject)
+
+        return {
+            'threadId': thread.get('id', thread_id),
+            'subject': subject,
+            'messageCount': len(parsed_messages),
+            'messages': parsed_messages
+        }
+
+    @staticmethod
+    def _dedupe_paragraphs(text, seen):
+        """Drop paragraphs already in `seen` and record the new ones"""
+        kept = []
+        for paragraph in text.split('\n\n'):
+            key = ' '.join(paragraph.lower().split())
+            if len(key) >= THREAD_DEDUP_MIN_CHARS:
+                if key in seen:
+                    continue
+                seen.add(key)
+            kept.append(paragraph)
+        return '\n\n'.join(kept)
+
+    @traced()
     def list_attachments(self, message_id):
         """
         List all attachments in an email
@@ -156,123 +585,500 @@ class GmailService:
 
         Returns:
             List of attachment metadata
+
+        Raises:
+            GmailAPIError: If the message can't be fetched
         """
-        try:
-            message = self.service.users().messages().get(
-                userId='me',
-                id=message_id
-            ).execute()
+        message = self._get_full_message(message_id)
 
-            attachments = []
+        # Attachments may sit at any depth (e.g. inside multipart/mixed -> multipart/related)
+        _, _, attachments = self._walk_payload(message['payload'])
 
-            if 'parts' in message['payload']:
-                for part in message['payload']['parts']:
-                    if part.get('filename') and part.get('body', {}).get('attachmentId'):
-                        attachments.append({
-                            'filename': part['filename'],
-                            'mimeType': part['mimeType'],
-                            'size': part['body'].get('size', 0),
-                            'attachmentId': part['body']['attachmentId']
-                        })
+        return attachments
 
-            return attachments
+    @traced()
+    def open_attachment(self, message_id, attachment_id, chunk_size=ATTACHMENT_CHUNK_SIZE):
+        """
+        Start streaming an attachment from Gmail
+
+        Only the start of the response is read here; the decoded bytes are
+        produced by the returned stream's iter_bytes() as the body arrives.
 
-        except HttpError as error:
+        Args:
+            message_id: Gmail message ID
+            attachment_id: Attachment ID
+            chunk_size: Base64 characters read per step (bounds memory use)
+
+        Returns:
+            AttachmentStream
+
+        Raises:
+            GmailAPIError: If Gmail does not return the attachment
+        """
+        url = (f"{self.api_root}gmail/v1/users/me/messages/{urllib.parse.quote(message_id, safe='')}"
+               f"/attachments/{urllib.parse.quote(attachment_id, safe='')}")
+
+        def request():
+            response = self._get(
+                url,
+                params={'fields': 'size,data'},
+                stream=True,
+                timeout=ATTACHMENT_TIMEOUT_SECONDS
+            )
+            if response.status_code != 200:
+                try:
+                    error = response.json().get('error')
+                except (ValueError, AttributeError):
+                    error = None
+                if not isinstance(error, dict):
+                    error = {}
+                response.close()
+                raise classify_status(
+                    response.status_code,
+                    [detail.get('reason') for detail in error.get('errors', [])],
+                    parse_retry_after(response.headers.get('Retry-After')),
+                    error.get('message')
+                )
+            return response
+
+        response = self.scheduler.call(self.user, 'messages.attachments.get', request)
+        try:
+            stream = AttachmentStream(response, chunk_size)
+        except BaseException:
+            response.close()
+            raise
+        if stream.size is None:
+            stream.size = self.attachment_size(message_id, attachment_id)
+        return stream
+
+    @traced()
+    def attachment_size(self, message_id, attachment_id):
+        """
+        Decoded size of an attachment, from the (usually cached) full message
+
+        Returns:
+            Size in bytes, or None if the message has no part with that attachment ID
+        """
+        try:
+            message = self._get_full_message(message_id)
+        except GmailAPIError as error:
             print(f"An error occurred: {error}")
-            return []
+            return None
+
+        _, _, attachments = self._walk_payload(message['payload'])
+        for attachment in attachments:
+            if attachment['attachmentId'] == attachment_id:
+                return attachment['size']
+        return None
 
-    def download_attachment(self, message_id, attachment_id, filename):
+    @traced()
+    def _get_full_message(self, message_id):
         """
-        Download an attachment from an email
+        Get a raw message in 'full' format, from the cache when possible
 
         Args:
             message_id: Gmail message ID
-            attachment_id: Attachment ID
-            filename: Desired filename for the downloaded file
 
         Returns:
-            File path of downloaded attachment
+            Raw Gmail message dict
         """
-        try:
-            attachment = self.service.users().messages().attachments().get(
-                userId='me',
-                messageId=message_id,
-                id=attachment_id
-            ).execute()
+        if self.message_cache is not None and self.user:
+            message = self.message_cache.get(self.user, message_id)
+            if message is not None:
+                return message
 
-            file_data = base64.urlsafe_b64decode(attachment['data'].encode('UTF-8'))
+        message = self._execute('messages.get', self.service.users().messages().get(
+            userId='me',
+            id=message_id,
+            format='full'
+        ))
 
-            # Save to downloads folder
-            downloads_dir = os.path.join(os.path.dirname(__file__), 'downloads')
-            os.makedirs(downloads_dir, exist_ok=True)
+        if self.message_cache is not None and self.user:
+            self.message_cache.put(self.user, message_id, message)
+        return message
 
-            file_path = os.path.join(downloads_dir, filename)
+    @traced()
+    def _get_full_messages(self, message_ids, errors=None):
+        """
+        Get several raw messages in 'full' format, batch-fetching only cache misses
 
-            with open(file_path, 'wb') as f:
-                f.write(file_data)
+        Args:
+            message_ids: List of Gmail message IDs
+            errors: Optional dict filled with message ID -> GmailAPIError for failed fetches
 
-            return file_path
+        Returns:
+            List of raw messages in the same order, None for failed fetches
+        """
+        if self.message_cache is None or not self.user:
+            return self._batch_get(message_ids, errors, format='full')
 
-        except HttpError as error:
-            print(f"An error occurred: {error}")
-            return None
+        found = {}
+        for message_id in message_ids:
+            message = self.message_cache.get(self.user, message_id)
+            if message is not None:
+                found[message_id] = message
+
+        missing = [message_id for message_id in message_ids if message_id not in found]
+        if missing:
+            for message_id, message in zip(missing, self._batch_get(missing, errors, format='full')):
+                if message is not None:
+                    found[message_id] = message
+                    self.message_cache.put(self.user, message_id, message)
+
+        return [found.get(message_id) for message_id in message_ids]
+
+    @traced()
+    def _get_metadata_messages(self, message_ids, errors=None):
+        """
+        Get several messages with headers and snippet only
+
+        Cached full messages are reused; the rest are fetched in format='metadata'
+        with a fields mask, which is a small fraction of the full payload.
+
+        Args:
+            message_ids: List of Gmail message IDs
+            errors: Optional dict filled with message ID -> GmailAPIError for failed fetches
+
+        Returns:
+            List of raw messages in the same order, None for failed fetches
+        """
+        found = {}
+        if self.message_cache is not None and self.user:
+            for message_id in message_ids:
+                message = self.message_cache.get(self.user, message_id)
+                if message is not None:
+                    found[message_id] = message
 
-    def _parse_message(self, message):
-        """Parse Gmail message into a readable format"""
-        headers = message['payload']['headers']
+        missing = [message_id for message_id in message_ids if message_id not in found]
+        if missing:
+            fetched = self._batch_get(
+                missing,
+                errors,
+                format='metadata',
+                metadataHeaders=METADATA_HEADERS,
+                fields=METADATA_FIELDS
+            )
+            for message_id, message in zip(missing, fetched):
+                if message is not None:
+                    found[message_id] = message
 
-        # Extract common headers
-        subject = next((h['value'] for h in headers if h['name'].lower() == 'subject'), 'No Subject')
-        sender = next((h['value'] for h in headers if h['name'].lower() == 'from'), 'Unknown')
-        date = next((h['value'] for h in headers if h['name'].lower() == 'date'), 'Unknown')
-        to = next((h['value'] for h in headers if h['name'].lower() == 'to'), 'Unknown')
+        return [found.get(message_id) for message_id in message_ids]
 
-        # Extract body
-        body = self._get_message_body(message['payload'])
+    @traced()
+    def _batch_get(self, message_ids, errors=None, **params):
+        """
+        Fetch several messages using batched messages().get calls
+
+        Calls that hit rate limits or server errors are retried on their own;
+        one bad ID does not sink the rest of the batch.
 
-        # Check for attachments
-        has_attachments = False
-        attachment_count = 0
-        if 'parts' in message['payload']:
-            for part in message['payload']['parts']:
-                if part.get('filename') and part.get('body', {}).get('attachmentId'):
-                    has_attachments = True
-                    attachment_count += 1
+        Args:
+            message_ids: List of Gmail message IDs
+            errors: Optional dict filled with message ID -> GmailAPIError for failed fetches
+            **params: Extra messages().get parameters (e.g. format='full')
+
+        Returns:
+            List of raw Gmail messages in the same order as message_ids,
+            with None in place of any message that failed to load
+        """
+        fetched = {}
+
+        # Building the discovery resource is costly, so do it once per call
+        messages = self.service.users().messages()
+        unique_ids = list(dict.fromkeys(message_ids))
+        for start in range(0, len(unique_ids), BATCH_SIZE):
+            responses, failures = self.scheduler.execute_batch(
+                self.user,
+                'messages.get',
+                self.service,
+                unique_ids[start:start + BATCH_SIZE],
+                lambda message_id: messages.get(userId='me', id=message_id, **params)
+            )
+            fetched.update(responses)
+            if errors is not None:
+                errors.update(failures)
+
+        return [fetched.get(message_id) for message_id in message_ids]
+
+    @traced()
+    def _parse_message(self, message, max_body_length=MAX_BODY_LENGTH, strip_quotes=True):
+        """
+        Parse Gmail message into a readable format (one walk over headers and MIME parts)
+
+        strip_quotes=False keeps quoted replies and signatures in the body.
+        """
+        payload = message['payload']
+        headers = self._header_dict(payload)
+        text_part, html_part, attachments = self._walk_payload(payload)
+
+        # Extract compact text first so the truncation budget goes to real content
+        body = self._body_text(text_part, html_part, max_body_length, strip_quotes)
 
         # Truncate body to prevent exceeding Claude's token limit
-        max_body_length = 2000  # ~500 tokens per email
         truncated_body = body[:max_body_length] + '...' if len(body) > max_body_length else body
 
         return {
             'id': message['id'],
             'threadId': message['threadId'],
-            'subject': subject,
-            'from': sender,
-            'to': to,
-            'date': date,
+            'subject': headers.get('subject', 'No Subject'),
+            'from': headers.get('from', 'Unknown'),
+            'to': headers.get('to', 'Unknown'),
+            'date': headers.get('date', 'Unknown'),
             'body': truncated_body,
             'snippet': message.get('snippet', ''),
-            'hasAttachments': has_attachments,
-            'attachmentCount': attachment_count
+            'hasAttachments': bool(attachments),
+            'attachmentCount': len(attachments)
+        }
+
+    @traced()
+    def _parse_metadata(self, message):
+        """Parse a metadata-only (or full) Gmail message into a body-less summary"""
+        headers = self._header_dict(message['payload'])
+
+        return {
+            'id': message['id'],
+            'threadId': message['threadId'],
+            'subject': headers.get('subject', 'No Subject'),
+            'from': headers.get('from', 'Unknown'),
+            'to': headers.get('to', 'Unknown'),
+            'date': headers.get('date', 'Unknown'),
+            'snippet': message.get('snippet', '')
         }
 
-    def _get_message_body(self, payload):
-        """Extract message body from payload"""
-        body = ""
-
-        if 'body' in payload and payload['body'].get('data'):
-            body = base64.urlsafe_b64decode(payload['body']['data']).decode('utf-8')
-        elif 'parts' in payload:
-            for part in payload['parts']:
-                if part['mimeType'] == 'text/plain':
-                    if 'data' in part['body']:
-                        body = base64.urlsafe_b64decode(part['body']['data']).decode('utf-8')
-                        break
-                elif part['mimeType'] == 'text/html' and not body:
-                    if 'data' in part['body']:
-                        body = base64.urlsafe_b64decode(part['body']['data']).decode('utf-8')
-
-        return body
+    @staticmethod
+    def _summarize(parsed):
+        """Drop the body and attachment fields from a parsed message"""
+        return {key: parsed[key] for key in ('id', 'threadId', 'subject', 'from', 'to', 'date', 'snippet')}
+
+    @staticmethod
+    def _header_dict(part):
+        """Lower-cased header name -> value in one pass (the first occurrence wins)"""
+        headers = {}
+        for header in part.get('headers', []):
+            headers.setdefault(header['name'].lower(), header['value'])
+        return headers
+
+    def _walk_payload(self, payload):
+        """
+        Walk a MIME tree once, at any depth
+
+        Args:
+            payload: Message payload from a 'full' format message
+
+        Returns:
+            (text_part, html_part, attachments): the first text/plain and text/html
+            body parts that are not attachments (either may be None), and metadata
+            for every downloadable attachment
+        """
+        bodies = {'text/plain': None, 'text/html': None}
+        attachments = []
+
+        def visit(part):
+            body = part.get('body', {})
+            if part.get('filename'):
+                if body.get('attachmentId'):
+                    attachments.append({
+                        'filename': part['filename'],
+                        'mimeType': part.get('mimeType', 'application/octet-stream'),
+                        'size': body.get('size', 0),
+                        'attachmentId': body['attachmentId']
+                    })
+            elif body.get('data') and part.get('mimeType') in bodies and bodies[part['mimeType']] is None:
+                bodies[part['mimeType']] = part
+
+            for child in part.get('parts', []):
+                visit(child)
+
+        visit(payload)
+
+        # Single-part messages of another text type (e.g. text/calendar) still have a body
+        if bodies['text/plain'] is None and bodies['text/html'] is None and payload.get('body', {}).get('data'):
+            bodies['text/plain'] = payload
+
+        return bodies['text/plain'], bodies['text/html'], attachments
+
+    def _decode_part(self, part, limit=None):
+        """
+        Decode a body part's text, optionally only its first `limit` characters
+
+        The result is longer than `limit` exactly when the full text is, so callers
+        can still tell whether to mark it as truncated.
+
+        Args:
+            part: MIME part with body data (or None)
+            limit: Characters needed, None for the whole body
+
+        Returns:
+            Decoded text
+        """
+        if part is None:
+            return ''
+
+        data = part['body']['data']
+        if limit is not None:
+            # A character is at most 4 bytes and 4 base64 characters carry 3 bytes
+            encoded_length = -(-(limit + 1) * 4 // 3) * 4
+            if encoded_length < len(data):
+                data = data[:encoded_length]
+
+        charset = 'utf-8'
+        content_type = self._header_dict(part).get('content-type', '')
+        if 'charset=' in content_type:
+            charset = content_type.split('charset=', 1)[1].split(';', 1)[0].strip().strip('"\'')
+        try:
+            codecs.lookup(charset)
+        except LookupError:
+            charset = 'utf-8'
+
+        return base64.urlsafe_b64decode(data).decode(charset, errors='replace')
+
+    def _get_message_body(self, payload, limit=None):
+        """
+        Extract compact message body text from payload, preferring text/plain at any depth
+
+        Args:
+            payload: Message payload from a 'full' format message
+            limit: Characters needed, None for the whole body
+
+        Returns:
+            Body text (longer than `limit` only if the body was cut short)
+        """
+        text_part, html_part, _ = self._walk_payload(payload)
+        return self._body_text(text_part, html_part, limit)
+
+    @traced()
+    def _body_text(self, text_part, html_part, limit=None, strip_quotes=True):
+        """
+        Compact body text: text/plain if present, else text extracted from HTML,
+        with quoted replies and signatures removed unless strip_quotes is False
+
+        Only a prefix is decoded when that yields more than `limit` characters;
+        as with _decode_part, the result is longer than `limit` only if the
+        full text is.
+        """
+        part, to_text = (text_part, strip_quoted_text) if text_part else (html_part, html_to_text)
+        if part is None:
+            return ''
+        extract = partial(to_text, strip_quotes=strip_quotes)
+        if limit is None:
+            return extract(self._decode_part(part))
+
+        window = limit * (HTML_DECODE_FACTOR if part is html_part else 1)
+        while True:
+            raw = self._decode_part(part, window)
+            text = extract(raw)
+            if len(text) > limit or len(raw) <= window:
+                return text
+            # Markup or quoting used up the window: look further in
+            window *= 4
+
+
+class AttachmentStream:
+    """
+    An attachment decoded incrementally from Gmail's {"size": ..., "data": "<base64url>"}
+    response, so memory use stays around one chunk whatever the file size
+    """
+
+    # The JSON before the data string is small; give up if it isn't found by then
+    MAX_PREFIX_BYTES = 64 * 1024
+
+    _SIZE_RE = re.compile(rb'"size"\s*:\s*(\d+)')
+    _DATA_RE = re.compile(rb'"data"\s*:\s*"')
+
+    def __init__(self, response, chunk_size=ATTACHMENT_CHUNK_SIZE):
+        """
+        Read the response up to the start of the base64 data
+
+        Args:
+            response: Streaming requests.Response from attachments().get
+            chunk_size: Bytes read per step
+
+        Raises:
+            ValueError: If the response has no data string
+        """
+        self.response = response
+        self.size = None
+        self._chunks = response.iter_content(chunk_size)
+
+        prefix = b''
+        for chunk in self._chunks:
+            prefix += chunk
+            match = self._DATA_RE.search(prefix)
+            if match:
+                size = self._SIZE_RE.search(prefix, 0, match.start())
+                if size:
+                    self.size = int(size.group(1))
+                self._first = prefix[match.end():]
+                return
+            if len(prefix) > self.MAX_PREFIX_BYTES:
+                break
+        raise ValueError("Gmail response has no attachment data")
+
+    def close(self):
+        """Release the connection (safe to call more than once)"""
+        self.response.close()
+
+    def iter_bytes(self, start=0, end=None):
+        """
+        Decode bytes start..end (end exclusive) as they arrive
+
+        Gmail can't serve part of an attachment, so a range still reads the
+        base64 before it, but skips it without decoding. Can be iterated once;
+        the response is closed when iteration ends.
+
+        Args:
+            start: First byte to yield
+            end: Byte after the last one to yield (None for the rest of the file)
+
+        Yields:
+            Decoded byte chunks
+        """
+        # Every 4 base64 characters decode to 3 bytes
+        skip_chars = start // 3 * 4
+        drop_bytes = start % 3
+        remaining = None if end is None else end - start
+        carry = b''
+
+        try:
+            chunk = self._first
+            self._first = b''
+            while remaining is None or remaining > 0:
+                quote = chunk.find(b'"')
+                last = quote >= 0
+                if last:
+                    chunk = chunk[:quote]
+
+                if skip_chars:
+                    skipped = min(skip_chars, len(chunk))
+                    chunk = chunk[skipped:]
+                    skip_chars -= skipped
+
+                data = carry + chunk if carry else chunk
+                if last:
+                    data += b'=' * (-len(data) % 4)
+                    carry = b''
+                else:
+                    whole = len(data) - len(data) % 4
+                    data, carry = data[:whole], data[whole:]
+
+                decoded = base64.urlsafe_b64decode(data)
+                if drop_bytes:
+                    dropped = min(drop_bytes, len(decoded))
+                    decoded = decoded[dropped:]
+                    drop_bytes -= dropped
+                if remaining is not None:
+                    decoded = decoded[:remaining]
+                    remaining -= len(decoded)
+                if decoded:
+                    yield decoded
+
+                if last:
+                    break
+                chunk = next(self._chunks, None)
+                if chunk is None:
+                    raise ValueError("Gmail response ended inside the attachment data")
+        finally:
+            self.close()
 
 
 if __name__ == "__main__":
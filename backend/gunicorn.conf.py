@@ -0,0 +1,28 @@
+"""
+Gunicorn Configuration
+Loaded automatically when gunicorn starts in this directory. Points every
+worker at one Prometheus multiprocess directory so /metrics adds up all
+workers, and clears it on startup so samples from a previous run don't
+leak into this one
+"""
+
+import os
+import shutil
+
+# Set here, in the master, so every worker inherits it before importing prometheus_client
+PROMETHEUS_MULTIPROC_DIR = os.environ.setdefault(
+    'PROMETHEUS_MULTIPROC_DIR',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cache', 'metrics')
+)
+
+
+def on_starting(server):
+    """Start from an empty metrics directory"""
+    shutil.rmtree(PROMETHEUS_MULTIPROC_DIR, ignore_errors=True)
+    os.makedirs(PROMETHEUS_MULTIPROC_DIR, exist_ok=True)
+
+
+def child_exit(server, worker):
+    """Let a dead worker's counters keep counting, but drop its live-only samples"""
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid)
@@ -0,0 +1,176 @@
+"""
+HTML Text Module
+Turns email bodies into compact text for Claude: strips markup, styles,
+scripts, hidden preheaders, quoted reply chains and signature boilerplate
+
+Usage (prints per-message compression ratios):
+    python html_text.py message.html [more.html ...]
+"""
+
+import html
+import re
+import sys
+
+# Elements whose whole content is dropped (blockquote only when quotes are stripped)
+SKIP_TAGS = {'script', 'style', 'head', 'title', 'template', 'svg', 'noscript', 'blockquote'}
+
+# Elements that never have a closing tag
+VOID_TAGS = {'area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input', 'link', 'meta', 'source', 'track', 'wbr'}
+
+# Elements that start a new line of text
+BLOCK_TAGS = {
+    'address', 'article', 'aside', 'blockquote', 'br', 'dd', 'div', 'dl', 'dt', 'footer', 'form', 'h1', 'h2', 'h3',
+    'h4', 'h5', 'h6', 'header', 'hr', 'li', 'main', 'nav', 'ol', 'p', 'pre', 'section', 'table', 'tr', 'ul'
+}
+
+# Tags, comments and doctypes; group 1 is '/' for closing tags, group 2 the name, group 3 the attributes
+_TAG_RE = re.compile(r'<(?:!--.*?--|[!?][^>]*|(/?)([a-zA-Z][a-zA-Z0-9]*)([^>]*))>', re.DOTALL)
+
+# Quoted replies, signatures and hidden preheaders in Gmail, Apple Mail, Outlook, Thunderbird and Yahoo
+_SKIP_ATTR_RE = re.compile(
+    r'gmail_quote|gmail_signature|moz-cite-prefix|moz-signature|yahoo_quoted|AppleMailSignature'
+    r'|id=["\']?Signature|display\s*:\s*none',
+    re.IGNORECASE
+)
+_HIDDEN_ATTR_RE = re.compile(r'display\s*:\s*none', re.IGNORECASE)
+
+# "On Mon, 1 Jan 2024 at 10:00, Alice <alice@example.com> wrote:"
+_ATTRIBUTION_RE = re.compile(r'^(On|Am|Le|El) .{4,300}(wrote|schrieb|a écrit|escribió)\s*:\s*$', re.IGNORECASE)
+
+_QUOTE_CUT_RE = re.compile(r'^-{2,}\s*Original Message\s*-{2,}$', re.IGNORECASE)
+# The standard "-- " delimiter (the space is &nbsp; in HTML); a bare "--" line is often a separator inside the body
+_SIGNATURE_RE = re.compile(r'^--[ \u00a0]$')
+_BOILERPLATE_RE = re.compile(
+    r'^(Sent from my (iPhone|iPad|Android|mobile device|Galaxy).*|Get Outlook for (iOS|Android).*|Sent from Mail for Windows.*)$',
+    re.IGNORECASE
+)
+
+# Zero-width and soft-hyphen characters used as preheader filler
+INVISIBLE_CHARS = '\u00ad\u034f\u200b\u200c\u200d\u2060\ufeff'
+_DELETE_INVISIBLE = dict.fromkeys(map(ord, INVISIBLE_CHARS))
+
+
+def html_to_text(markup, strip_quotes=True):
+    """
+    Convert an HTML email body to compact text
+
+    Args:
+        markup: HTML source (may be a truncated prefix)
+        strip_quotes: Remove quoted replies and signatures (False keeps them)
+
+    Returns:
+        Visible text, with quoted replies and signatures removed if strip_quotes
+    """
+    skip_tags = SKIP_TAGS if strip_quotes else SKIP_TAGS - {'blockquote'}
+    skip_attr_re = _SKIP_ATTR_RE if strip_quotes else _HIDDEN_ATTR_RE
+
+    # Drop a tag cut off by a truncated prefix
+    last_open = markup.rfind('<')
+    if last_open > markup.rfind('>'):
+        markup = markup[:last_open]
+
+    chunks = []
+    position = 0
+    skip_tag = None
+    skip_depth = 0
+
+    for match in _TAG_RE.finditer(markup):
+        if skip_tag is None:
+            chunks.append(markup[position:match.start()])
+        position = match.end()
+
+        name = match.group(2)
+        if name is None:
+            # Comment, doctype or processing instruction
+            continue
+        name = name.lower()
+        closing = match.group(1) == '/'
+        attrs = match.group(3)
+
+        if skip_tag is not None:
+            # Count nested elements of the same name until the skipped one closes
+            if name == skip_tag:
+                if closing:
+                    skip_depth -= 1
+                    if skip_depth == 0:
+                        skip_tag = None
+                elif not attrs.endswith('/'):
+                    skip_depth += 1
+            continue
+
+        if not closing and name not in VOID_TAGS and not attrs.endswith('/') and (
+            name in skip_tags or (attrs and skip_attr_re.search(attrs))
+        ):
+            skip_tag = name
+            skip_depth = 1
+            continue
+
+        if name in BLOCK_TAGS:
+            if name == 'li':
+                if not closing:
+                    chunks.append('\n- ')
+            elif not (closing and name in ('tr', 'dt', 'dd')):
+                chunks.append('\n')
+        elif name in ('td', 'th') and closing:
+            chunks.append(' ')
+
+    if skip_tag is None:
+        chunks.append(markup[position:])
+
+    return strip_quoted_text(html.unescape(''.join(chunks)), strip_quotes)
+
+
+def strip_quoted_text(text, strip_quotes=True):
+    """
+    Remove quoted reply chains and signature boilerplate and collapse whitespace
+
+    Forwarded messages are kept; only reply quoting is removed.
+
+    Args:
+        text: Plain text body (or text extracted from HTML)
+        strip_quotes: False only collapses whitespace and drops invisible characters
+
+    Returns:
+        Compact text
+    """
+    if any(char in text for char in INVISIBLE_CHARS):
+        text = text.translate(_DELETE_INVISIBLE)
+
+    lines = []
+    blank = False
+    for line in text.splitlines():
+        if strip_quotes and (_SIGNATURE_RE.match(line) or _QUOTE_CUT_RE.match(line.strip())):
+            break
+
+        # str.split() also treats non-breaking and other Unicode spaces as whitespace
+        line = ' '.join(line.split())
+        if strip_quotes and (line.startswith('>') or _BOILERPLATE_RE.match(line)):
+            continue
+
+        if not line:
+            # Keep at most one blank line between paragraphs
+            blank = bool(lines)
+            continue
+        if blank:
+            lines.append('')
+            blank = False
+        lines.append(line)
+
+    # The attribution line of a quote we removed
+    while strip_quotes and lines and (_ATTRIBUTION_RE.match(lines[-1]) or not lines[-1]):
+        lines.pop()
+
+    return '\n'.join(lines)
+
+
+def compression_ratio(original, compact):
+    """Characters in the original per character of compact text"""
+    return len(original) / max(len(compact), 1)
+
+
+if __name__ == "__main__":
+    for path in sys.argv[1:]:
+        with open(path, encoding='utf-8', errors='replace') as f:
+            source = f.read()
+        text = html_to_text(source)
+        print(f"{path}: {len(source):,d} -> {len(text):,d} chars ({compression_ratio(source, text):.1f}x)")
@@ -0,0 +1,204 @@
+"""
+Chat Backend Load Test
+Compares how many concurrent chats the sync (gunicorn) and async (uvicorn)
+serving modes can hold while each chat is waiting on Claude.
+
+1. Start a fake Anthropic API that answers after a fixed delay:
+       python load_test.py fake-anthropic --port 9100 --latency-ms 2000
+
+2. Start the backend pointed at it, in either mode:
+       ANTHROPIC_BASE_URL=http://127.0.0.1:9100 gunicorn --workers 2 --bind 127.0.0.1:5001 app:app
+       ANTHROPIC_BASE_URL=http://127.0.0.1:9100 uvicorn asgi_app:app --host 127.0.0.1 --port 5001
+
+3. Log in once through the browser, copy the session_id cookie, and run:
+       python load_test.py run --cookie <session_id> --concurrency 200 --requests 1000
+
+With a 2s fake Claude latency, the sync mode tops out near
+workers / latency requests per second, while the async mode should scale
+with --concurrency until the host runs out of sockets or CPU.
+"""
+
+import argparse
+import json
+import statistics
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+def print_section(title):
+    """Print a formatted section header"""
+    print("\n" + "=" * 60)
+    print(f"  {title}")
+    print("=" * 60)
+
+
+class FakeAnthropicHandler(BaseHTTPRequestHandler):
+    """Answers /v1/messages with a fixed end_turn reply after a delay"""
+
+    latency = 2.0
+    reply = "This is a canned reply from the fake Anthropic API."
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        body = json.loads(self.rfile.read(length) or b'{}')
+
+        time.sleep(self.latency)
+
+        usage = {"input_tokens": 100, "output_tokens": 12}
+        message = {
+            "id": "msg_fake",
+            "type": "message",
+            "role": "assistant",
+            "model": body.get("model", "fake"),
+            "content": [{"type": "text", "text": self.reply}],
+            "stop_reason": "end_turn",
+            "stop_sequence": None,
+            "usage": usage
+        }
+
+        if not body.get("stream"):
+            data = json.dumps(message).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+            return
+
+        start = dict(message, content=[], stop_reason=None)
+        events = [
+            ("message_start", {"type": "message_start", "message": start}),
+            ("content_block_start", {"type": "content_block_start", "index": 0,
+                                     "content_block": {"type": "text", "text": ""}}),
+        ]
+        for word in self.reply.split(' '):
+            events.append(("content_block_delta", {"type": "content_block_delta", "index": 0,
+                                                   "delta": {"type": "text_delta", "text": word + ' '}}))
+        events += [
+            ("content_block_stop", {"type": "content_block_stop", "index": 0}),
+            ("message_delta", {"type": "message_delta", "delta": {"stop_reason": "end_turn", "stop_sequence": None},
+                               "usage": {"output_tokens": usage["output_tokens"]}}),
+            ("message_stop", {"type": "message_stop"}),
+        ]
+        data = ''.join(f"event: {name}\ndata: {json.dumps(payload)}\n\n" for name, payload in events).encode('utf-8')
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+def serve_fake_anthropic(port, latency):
+    """Run the fake Anthropic API until interrupted"""
+    FakeAnthropicHandler.latency = latency
+    server = ThreadingHTTPServer(('127.0.0.1', port), FakeAnthropicHandler)
+    server.daemon_threads = True
+    print(f"Fake Anthropic API on http://127.0.0.1:{port} ({latency * 1000:.0f} ms per call)")
+    print(f"Start the backend with ANTHROPIC_BASE_URL=http://127.0.0.1:{port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+def send_chat(url, cookie, message, timeout):
+    """
+    Send one chat request
+
+    Returns:
+        (latency_seconds, status) where status is the HTTP status or an error name
+    """
+    request = urllib.request.Request(
+        url,
+        data=json.dumps({"message": message}).encode('utf-8'),
+        headers={'Content-Type': 'application/json', 'Cookie': f"session_id={cookie}"},
+        method='POST'
+    )
+    started = time.perf_counter()
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            response.read()
+            status = response.status
+    except urllib.error.HTTPError as e:
+        status = e.code
+    except Exception as e:
+        status = type(e).__name__
+    return time.perf_counter() - started, status
+
+
+def run_load(url, cookie, concurrency, total, message, timeout):
+    """Fire `total` requests with `concurrency` in flight and print a summary"""
+    print_section(f"{total} requests, {concurrency} concurrent -> {url}")
+
+    in_flight = 0
+    peak_in_flight = 0
+    lock = threading.Lock()
+
+    def one_request(_):
+        nonlocal in_flight, peak_in_flight
+        with lock:
+            in_flight += 1
+            peak_in_flight = max(peak_in_flight, in_flight)
+        try:
+            return send_chat(url, cookie, message, timeout)
+        finally:
+            with lock:
+                in_flight -= 1
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(one_request, range(total)))
+    elapsed = time.perf_counter() - started
+
+    latencies = sorted(latency for latency, status in results if status == 200)
+    errors = {}
+    for _, status in results:
+        if status != 200:
+            errors[status] = errors.get(status, 0) + 1
+
+    print(f"  wall time:     {elapsed:8.2f} s")
+    print(f"  throughput:    {len(latencies) / elapsed:8.2f} req/s")
+    print(f"  peak in flight:{peak_in_flight:8d}")
+    if latencies:
+        print(f"  p50 latency:   {statistics.median(latencies):8.2f} s")
+        print(f"  p95 latency:   {latencies[int(len(latencies) * 0.95) - 1]:8.2f} s")
+        print(f"  max latency:   {latencies[-1]:8.2f} s")
+    print(f"  ok / errors:   {len(latencies)} / {sum(errors.values())} {errors or ''}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    fake = commands.add_parser('fake-anthropic', help='Run a fake Anthropic API')
+    fake.add_argument('--port', type=int, default=9100)
+    fake.add_argument('--latency-ms', type=float, default=2000)
+
+    run = commands.add_parser('run', help='Drive load against a running backend')
+    run.add_argument('--url', default='http://127.0.0.1:5001/api/chat')
+    run.add_argument('--cookie', required=True, help='session_id cookie of a logged-in user')
+    run.add_argument('--concurrency', type=int, default=50)
+    run.add_argument('--requests', type=int, default=200)
+    run.add_argument('--message', default='Hello')
+    run.add_argument('--timeout', type=float, default=300)
+
+    args = parser.parse_args()
+
+    if args.command == 'fake-anthropic':
+        serve_fake_anthropic(args.port, args.latency_ms / 1000)
+    else:
+        run_load(args.url, args.cookie, args.concurrency, args.requests, args.message, args.timeout)
+
+
+if __name__ == "__main__":
+    main()
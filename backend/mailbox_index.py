@@ -0,0 +1,562 @@
+"""
+Mailbox Index Module
+Optional per-user full-text index of the mailbox (SQLite FTS5) so common
+searches are answered locally instead of with a list call plus N fetches.
+Seeded by a background crawl, then kept current with users.history.list.
+"""
+
+import os
+import re
+import hashlib
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from gmail_scheduler import GmailAPIError
+from sqlite_db import sqlite_connection
+from tracing import traced
+from gmail_service import BATCH_SIZE, MAX_BODY_LENGTH
+
+# Off by default: the initial crawl costs a full fetch per indexed message
+MAILBOX_INDEX_ENABLED = os.environ.get('MAILBOX_INDEX_ENABLED', '').lower() in ('1', 'true', 'yes')
+
+# Directory holding one SQLite file per user (safe to delete, it is rebuilt)
+INDEX_DIR = os.environ.get(
+    'MAILBOX_INDEX_DIR',
+    os.path.join(os.path.dirname(__file__), 'cache', 'index')
+)
+
+# Newest messages indexed by the initial crawl
+INDEX_MAX_MESSAGES = int(os.environ.get('MAILBOX_INDEX_MAX_MESSAGES', '5000'))
+
+# Characters of extracted body kept per message for full-text matching
+INDEX_BODY_CHARS = int(os.environ.get('MAILBOX_INDEX_BODY_CHARS', '20000'))
+
+# Searches sync with history.list first when the last sync is older than this
+INDEX_MAX_STALENESS_SECONDS = float(os.environ.get('MAILBOX_INDEX_MAX_STALENESS_SECONDS', '60'))
+
+# Pause between crawl batches; 50 full fetches cost 250 quota units, the per-user rate per second
+CRAWL_BATCH_PAUSE_SECONDS = float(os.environ.get('MAILBOX_INDEX_CRAWL_PAUSE_SECONDS', '1'))
+
+# A crawl claimed by a worker that died is taken over after this long
+CRAWL_CLAIM_SECONDS = 3600
+
+# Open indexes kept per process (least recently used are closed first)
+INDEX_MAX_OPEN = 256
+
+# Messages in these labels are outside Gmail's default search scope
+EXCLUDED_LABELS = {'SPAM', 'TRASH'}
+
+_crawl_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='mailbox-crawl')
+
+# operator:value, "quoted phrase", or bare word
+_TOKEN_RE = re.compile(r'(-?)(?:([a-z_]+):("[^"]*"|\S+)|"([^"]*)"|(\S+))', re.IGNORECASE)
+_RELATIVE_RE = re.compile(r'^(\d+)([dmy])$', re.IGNORECASE)
+_RELATIVE_SECONDS = {'d': 86400, 'm': 30 * 86400, 'y': 365 * 86400}
+
+
+class IndexQuery:
+    def __init__(self):
+        """Translated search: FTS terms plus SQL filters on the messages table"""
+        self.terms = []
+        self.where = []
+        self.params = []
+
+    def match_expression(self):
+        """FTS5 MATCH string (implicit AND of quoted terms), or None"""
+        if not self.terms:
+            return None
+        return ' '.join('"' + term.replace('"', '""') + '"' for term in self.terms)
+
+
+def translate_query(query, now=None):
+    """
+    Translate a Gmail search query into an IndexQuery
+
+    Only from:, subject:, after:, before:, newer_than:, older_than:,
+    has:attachment and plain words/phrases are supported.
+
+    Args:
+        query: Gmail search query
+        now: Current time in seconds (for newer_than/older_than)
+
+    Returns:
+        IndexQuery, or None if the query uses anything the index can't answer
+    """
+    now = time.time() if now is None else now
+    translated = IndexQuery()
+
+    for match in _TOKEN_RE.finditer(query or ''):
+        negated, operator, value, phrase, word = match.groups()
+        if negated:
+            return None
+
+        if operator is None:
+            term = phrase if phrase is not None else word
+            if term in ('OR', 'AND') or any(char in term for char in '(){}'):
+                return None
+            if term.strip():
+                translated.terms.append(term)
+            continue
+
+        operator = operator.lower()
+        if value.startswith('"'):
+            value = value[1:-1]
+        elif any(char in value for char in '(){}'):
+            return None
+
+        if operator == 'from':
+            translated.where.append("m.sender LIKE ?")
+            translated.params.append(f"%{value}%")
+        elif operator == 'subject':
+            translated.where.append("m.subject LIKE ?")
+            translated.params.append(f"%{value}%")
+        elif operator in ('after', 'before'):
+            timestamp = _parse_date(value)
+            if timestamp is None:
+                return None
+            translated.where.append("m.internal_date >= ?" if operator == 'after' else "m.internal_date < ?")
+            translated.params.append(int(timestamp * 1000))
+        elif operator in ('newer_than', 'older_than'):
+            relative = _RELATIVE_RE.match(value)
+            if not relative:
+                return None
+            cutoff = now - int(relative.group(1)) * _RELATIVE_SECONDS[relative.group(2).lower()]
+            translated.where.append("m.internal_date >= ?" if operator == 'newer_than' else "m.internal_date < ?")
+            translated.params.append(int(cutoff * 1000))
+        elif operator == 'has' and value.lower() == 'attachment':
+            translated.where.append("m.attachment_count > 0")
+        else:
+            return None
+
+    return translated
+
+
+def _parse_date(value):
+    """Parse an after:/before: value (YYYY/MM/DD, YYYY-MM-DD or epoch seconds) to epoch seconds"""
+    if value.isdigit():
+        return int(value)
+    for fmt in ('%Y/%m/%d', '%Y-%m-%d'):
+        try:
+            # Gmail uses the account's time zone; the server's local midnight is close enough
+            return time.mktime(datetime.strptime(value, fmt).timetuple())
+        except ValueError:
+            continue
+    return None
+
+
+class MailboxIndex:
+    def __init__(self, user, db_path):
+        """
+        Open (creating if needed) the index for one user
+
+        Args:
+            user: User email the index belongs to
+            db_path: Path to this user's SQLite file
+        """
+        self.user = user
+        self.db_path = db_path
+
+        self._local = threading.local()
+        self._sync_lock = threading.Lock()
+        self._crawling = False
+
+        os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
+        db = self._db()
+        db.execute("""
+            CREATE TABLE IF NOT EXISTS messages (
+                doc INTEGER PRIMARY KEY,
+                message_id TEXT NOT NULL UNIQUE,
+                thread_id TEXT NOT NULL,
+                subject TEXT NOT NULL,
+                sender TEXT NOT NULL,
+                recipients TEXT NOT NULL,
+                date TEXT NOT NULL,
+                internal_date INTEGER NOT NULL,
+                snippet TEXT NOT NULL,
+                label_ids TEXT NOT NULL,
+                attachment_count INTEGER NOT NULL
+            )
+        """)
+        db.execute("CREATE INDEX IF NOT EXISTS messages_internal_date ON messages (internal_date)")
+        # Row ids match messages.doc; the body only lives here
+        db.execute("""
+            CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+                subject, sender, recipients, snippet, body,
+                tokenize = 'unicode61 remove_diacritics 2'
+            )
+        """)
+        db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+
+    @traced()
+    def search(self, gmail_service, query, max_results=10):
+        """
+        Answer a search from the index
+
+        Args:
+            gmail_service: GmailService for this user (used to crawl and sync)
+            query: Gmail search query
+            max_results: Maximum number of results to return
+
+        Returns:
+            List of parsed messages (same shape as GmailService.search_emails),
+            or None when the caller should ask the Gmail API instead
+        """
+        try:
+            if not self._get_meta('built_at'):
+                self.start_build(gmail_service)
+                return None
+
+            translated = translate_query(query)
+            if translated is None:
+                return None
+
+            if not self._ensure_fresh(gmail_service):
+                return None
+
+            results = self._query(translated, max_results)
+        except (sqlite3.Error, GmailAPIError) as error:
+            # The index must never break a search
+            print(f"Mailbox index error for {self.user}: {error}")
+            return None
+
+        # A capped crawl holds the newest messages only, so a short answer may be missing older matches
+        if len(results) < max_results and self._get_meta('complete') != '1':
+            return None
+        return results
+
+    def start_build(self, gmail_service):
+        """Start the initial crawl in the background unless one is already running"""
+        if self._crawling:
+            return
+        self._crawling = True
+        _crawl_executor.submit(self._build_in_background, gmail_service)
+
+    def sync(self, gmail_service):
+        """
+        Apply mailbox changes since the stored historyId
+
+        Args:
+            gmail_service: GmailService for this user
+
+        Returns:
+            True if the index is now current
+        """
+        history_id = self._get_meta('history_id')
+        if not history_id:
+            return False
+
+        added = set()
+        deleted = set()
+        labels = {}
+        page_token = None
+        try:
+            while True:
+                response = gmail_service._execute('history.list', gmail_service.service.users().history().list(
+                    userId='me',
+                    startHistoryId=history_id,
+                    pageToken=page_token,
+                    maxResults=500
+                ))
+
+                for record in response.get('history', []):
+                    for item in record.get('messagesAdded', []):
+                        message_id = item['message']['id']
+                        added.add(message_id)
+                        deleted.discard(message_id)
+                        labels[message_id] = item['message'].get('labelIds', [])
+                    for item in record.get('messagesDeleted', []):
+                        message_id = item['message']['id']
+                        deleted.add(message_id)
+                        added.discard(message_id)
+                    for item in record.get('labelsAdded', []) + record.get('labelsRemoved', []):
+                        labels[item['message']['id']] = item['message'].get('labelIds', [])
+
+                page_token = response.get('nextPageToken')
+                if not page_token:
+                    break
+        except GmailAPIError as error:
+            if error.kind == 'not_found':
+                # historyId is too old to replay: start over
+                print(f"Mailbox index for {self.user} is out of date, rebuilding")
+                self._set_meta(built_at=None)
+                self.start_build(gmail_service)
+            else:
+                print(f"Mailbox index sync error for {self.user}: {error}")
+            return False
+
+        db = self._db()
+        indexed = set()
+        if labels:
+            indexed = {message_id for message_id, in db.execute("SELECT message_id FROM messages")}
+
+        for message_id in deleted:
+            labels.pop(message_id, None)
+        for message_id, label_ids in labels.items():
+            if EXCLUDED_LABELS.intersection(label_ids):
+                # Moved to spam/trash (or arrived there)
+                deleted.add(message_id)
+                added.discard(message_id)
+            elif message_id not in indexed:
+                # Restored from spam/trash
+                added.add(message_id)
+
+        fetched = []
+        if added:
+            fetched = [message for message in gmail_service._get_full_messages(sorted(added)) if message]
+
+        if fetched and self._get_meta('complete') != '1':
+            # A capped crawl holds only the newest messages, and search() trusts a full page from it;
+            # a restored message older than that window would sit next to older matches it never saw
+            oldest, = db.execute("SELECT MIN(internal_date) FROM messages").fetchone()
+            if oldest is not None:
+                fetched = [message for message in fetched if int(message.get('internalDate', 0)) >= oldest]
+
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            for message_id in deleted:
+                self._delete(db, message_id)
+            for message_id, label_ids in labels.items():
+                if message_id in indexed and message_id not in deleted:
+                    db.execute(
+                        "UPDATE messages SET label_ids = ? WHERE message_id = ?",
+                        (','.join(label_ids), message_id)
+                    )
+            for message in fetched:
+                self._upsert(db, gmail_service, message)
+            self._set_meta(db=db, history_id=response['historyId'], synced_at=time.time())
+            db.execute("COMMIT")
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+
+        if added or deleted:
+            print(f"Mailbox index for {self.user}: +{len(fetched)} -{len(deleted)} messages")
+        return True
+
+    def build(self, gmail_service, max_messages=INDEX_MAX_MESSAGES, batch_pause=CRAWL_BATCH_PAUSE_SECONDS):
+        """
+        Crawl the newest messages into an empty index
+
+        Only one worker crawls a given user at a time; others return at once.
+
+        Args:
+            gmail_service: GmailService for this user
+            max_messages: Number of newest messages to index
+            batch_pause: Seconds to wait between batches (quota pacing)
+        """
+        db = self._db()
+        now = time.time()
+        claimed = db.execute("""
+            INSERT INTO meta (key, value) VALUES ('crawl_started', ?)
+            ON CONFLICT (key) DO UPDATE SET value = excluded.value
+            WHERE CAST(meta.value AS REAL) < ?
+        """, (str(now), now - CRAWL_CLAIM_SECONDS)).rowcount
+        if not claimed:
+            return
+
+        try:
+            started = time.perf_counter()
+            self._set_meta(built_at=None, complete=None)
+            db.execute("DELETE FROM messages")
+            db.execute("DELETE FROM messages_fts")
+
+            # Taken before listing so anything arriving mid-crawl is replayed by the first sync
+            profile = gmail_service._execute('getProfile', gmail_service.service.users().getProfile(userId='me'))
+            history_id = profile['historyId']
+
+            # One page of IDs at a time, newest first
+            crawled = 0
+            more = False
+            for page, more in gmail_service._iter_message_ids(None, max_messages):
+                for start in range(0, len(page), BATCH_SIZE):
+                    chunk = page[start:start + BATCH_SIZE]
+                    # Rate-limited calls are retried by the scheduler; the rest are gone or inaccessible
+                    messages = gmail_service._batch_get(chunk, format='full')
+
+                    db.execute("BEGIN IMMEDIATE")
+                    try:
+                        for message in messages:
+                            if message is not None:
+                                self._upsert(db, gmail_service, message)
+                        db.execute("COMMIT")
+                    except BaseException:
+                        db.execute("ROLLBACK")
+                        raise
+                    time.sleep(batch_pause)
+                crawled += len(page)
+
+            self._set_meta(
+                history_id=history_id,
+                synced_at=time.time(),
+                built_at=time.time(),
+                complete='0' if more else '1'
+            )
+            print(f"Mailbox index for {self.user}: crawled {crawled} messages "
+                  f"in {time.perf_counter() - started:.1f}s")
+        finally:
+            db.execute("DELETE FROM meta WHERE key = 'crawl_started'")
+
+    def stats(self):
+        """
+        Get index size and sync state
+
+        Returns:
+            Dict with message count, completeness and last sync time
+        """
+        db = self._db()
+        return {
+            'messages': db.execute("SELECT COUNT(*) FROM messages").fetchone()[0],
+            'complete': self._get_meta('complete') == '1',
+            'built': bool(self._get_meta('built_at')),
+            'synced_at': float(self._get_meta('synced_at') or 0),
+        }
+
+    def _build_in_background(self, gmail_service):
+        """Executor entry point for build()"""
+        try:
+            self.build(gmail_service)
+        except (GmailAPIError, sqlite3.Error) as error:
+            print(f"Mailbox index crawl failed for {self.user}: {error}")
+        finally:
+            self._crawling = False
+
+    def _ensure_fresh(self, gmail_service):
+        """Sync if the last sync is older than the staleness limit (one sync at a time)"""
+        if time.time() - float(self._get_meta('synced_at') or 0) <= INDEX_MAX_STALENESS_SECONDS:
+            return True
+        with self._sync_lock:
+            # Another thread may have synced while we waited
+            if time.time() - float(self._get_meta('synced_at') or 0) <= INDEX_MAX_STALENESS_SECONDS:
+                return True
+            return self.sync(gmail_service)
+
+    def _query(self, translated, max_results):
+        """Run a translated query, newest first"""
+        where = list(translated.where)
+        params = list(translated.params)
+        match = translated.match_expression()
+        if match:
+            where.insert(0, "messages_fts MATCH ?")
+            params.insert(0, match)
+
+        sql = """
+            SELECT m.message_id, m.thread_id, m.subject, m.sender, m.recipients, m.date,
+                   m.snippet, m.attachment_count, messages_fts.body
+            FROM messages m JOIN messages_fts ON messages_fts.rowid = m.doc
+        """
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += " ORDER BY m.internal_date DESC LIMIT ?"
+        params.append(max_results)
+
+        results = []
+        for row in self._db().execute(sql, params):
+            message_id, thread_id, subject, sender, to, date, snippet, attachment_count, body = row
+            results.append({
+                'id': message_id,
+                'threadId': thread_id,
+                'subject': subject,
+                'from': sender,
+                'to': to,
+                'date': date,
+                'body': body[:MAX_BODY_LENGTH] + '...' if len(body) > MAX_BODY_LENGTH else body,
+                'snippet': snippet,
+                'hasAttachments': attachment_count > 0,
+                'attachmentCount': attachment_count
+            })
+        return results
+
+    def _upsert(self, db, gmail_service, message):
+        """Insert or replace one raw Gmail message (caller holds a transaction)"""
+        label_ids = message.get('labelIds', [])
+        if EXCLUDED_LABELS.intersection(label_ids):
+            return
+
+        try:
+            parsed = gmail_service._parse_message(message)
+            body = gmail_service._get_message_body(message['payload'], INDEX_BODY_CHARS)[:INDEX_BODY_CHARS]
+        except (KeyError, ValueError) as error:
+            print(f"Mailbox index skipped message {message.get('id')}: {error}")
+            return
+
+        self._delete(db, message['id'])
+        doc = db.execute("""
+            INSERT INTO messages (message_id, thread_id, subject, sender, recipients, date,
+                                  internal_date, snippet, label_ids, attachment_count)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """, (
+            parsed['id'], parsed['threadId'], parsed['subject'], parsed['from'], parsed['to'], parsed['date'],
+            int(message.get('internalDate', 0)), parsed['snippet'], ','.join(label_ids), parsed['attachmentCount']
+        )).lastrowid
+        db.execute(
+            "INSERT INTO messages_fts (rowid, subject, sender, recipients, snippet, body) VALUES (?, ?, ?, ?, ?, ?)",
+            (doc, parsed['subject'], parsed['from'], parsed['to'], parsed['snippet'], body)
+        )
+
+    def _delete(self, db, message_id):
+        """Remove one message from both tables if present"""
+        row = db.execute("SELECT doc FROM messages WHERE message_id = ?", (message_id,)).fetchone()
+        if row is not None:
+            db.execute("DELETE FROM messages_fts WHERE rowid = ?", row)
+            db.execute("DELETE FROM messages WHERE doc = ?", row)
+
+    def _get_meta(self, key):
+        row = self._db().execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def _set_meta(self, db=None, **values):
+        """Set meta keys; a value of None removes the key"""
+        db = db or self._db()
+        for key, value in values.items():
+            if value is None:
+                db.execute("DELETE FROM meta WHERE key = ?", (key,))
+            else:
+                db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, str(value)))
+
+    def _db(self):
+        """Per-thread SQLite connection"""
+        return sqlite_connection(self.db_path, self._local)
+
+
+class MailboxIndexes:
+    def __init__(self, index_dir=INDEX_DIR, max_open=INDEX_MAX_OPEN):
+        """
+        Registry of open per-user indexes
+
+        Args:
+            index_dir: Directory holding one SQLite file per user
+            max_open: Maximum number of indexes kept open in this process
+        """
+        self.index_dir = index_dir
+        self.max_open = max_open
+
+        # Key: user -> Value: MailboxIndex, least recently used first
+        self._indexes = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, user):
+        """
+        Get the index for a user, opening it on first use
+
+        Args:
+            user: User email
+
+        Returns:
+            MailboxIndex instance
+        """
+        with self._lock:
+            index = self._indexes.get(user)
+            if index is not None:
+                self._indexes.move_to_end(user)
+                return index
+
+            # Hash the address so it is safe as a file name
+            file_name = hashlib.sha256(user.lower().encode('utf-8')).hexdigest()[:32] + '.db'
+            index = MailboxIndex(user, os.path.join(self.index_dir, file_name))
+            self._indexes[user] = index
+            while len(self._indexes) > self.max_open:
+                self._indexes.popitem(last=False)
+            return index
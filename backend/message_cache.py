@@ -0,0 +1,246 @@
+"""
+Message Cache Module
+Two-tier cache of raw Gmail messages: a per-process LRU in front of a
+SQLite file shared by all gunicorn workers on the box
+"""
+
+import os
+import json
+import sqlite3
+import threading
+import time
+import zlib
+from collections import OrderedDict
+
+from metrics import observe_cache
+from sqlite_db import bytes_over_cap, sqlite_connection
+
+# SQLite file for the shared tier
+CACHE_DB_PATH = os.environ.get(
+    'MESSAGE_CACHE_DB',
+    os.path.join(os.path.dirname(__file__), 'cache', 'messages.db')
+)
+
+# Size caps for each tier (0 disables the disk tier)
+MEMORY_MAX_BYTES = int(os.environ.get('MESSAGE_CACHE_MEMORY_MB', '32')) * 1024 * 1024
+DISK_MAX_BYTES = int(os.environ.get('MESSAGE_CACHE_DISK_MB', '256')) * 1024 * 1024
+
+
+class MessageCache:
+    def __init__(self, db_path=CACHE_DB_PATH, memory_max_bytes=MEMORY_MAX_BYTES, disk_max_bytes=DISK_MAX_BYTES):
+        """
+        Initialize the message cache
+
+        Args:
+            db_path: Path to the SQLite file for the shared tier
+            memory_max_bytes: Size cap for the in-process tier
+            disk_max_bytes: Size cap for the SQLite tier (0 disables it)
+        """
+        self.db_path = db_path
+        self.memory_max_bytes = memory_max_bytes
+        self.disk_max_bytes = disk_max_bytes
+
+        # Key: (user, message_id) -> Value: (message, size), least recently used first
+        self._memory = OrderedDict()
+        self._memory_bytes = 0
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+        self._counters = {
+            'memory_hits': 0,
+            'disk_hits': 0,
+            'misses': 0,
+            'memory_evictions': 0,
+            'disk_evictions': 0,
+        }
+
+        if self.disk_max_bytes:
+            os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
+            self._db().execute("""
+                CREATE TABLE IF NOT EXISTS messages (
+                    user TEXT NOT NULL,
+                    message_id TEXT NOT NULL,
+                    data BLOB NOT NULL,
+                    size INTEGER NOT NULL,
+                    accessed REAL NOT NULL,
+                    PRIMARY KEY (user, message_id)
+                )
+            """)
+            self._db().execute("CREATE INDEX IF NOT EXISTS messages_accessed ON messages (accessed)")
+            # Running total of messages.size, kept in step by every write so puts never scan the table
+            self._db().execute(
+                "CREATE TABLE IF NOT EXISTS stats (id INTEGER PRIMARY KEY CHECK (id = 0), total_bytes INTEGER NOT NULL)"
+            )
+            self._db().execute("INSERT OR IGNORE INTO stats SELECT 0, COALESCE(SUM(size), 0) FROM messages")
+
+    def get(self, user, message_id):
+        """
+        Look up a cached message
+
+        Args:
+            user: User the message belongs to (e.g. email address)
+            message_id: Gmail message ID
+
+        Returns:
+            Raw Gmail message dict, or None on a miss
+        """
+        key = (user, message_id)
+
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                self._memory.move_to_end(key)
+                self._counters['memory_hits'] += 1
+                observe_cache('message', 'memory_hit')
+                return entry[0]
+
+        message = self._disk_get(user, message_id)
+
+        with self._lock:
+            if message is None:
+                self._counters['misses'] += 1
+                observe_cache('message', 'miss')
+                return None
+            self._counters['disk_hits'] += 1
+            observe_cache('message', 'disk_hit')
+            self._memory_put(key, message)
+        return message
+
+    def put(self, user, message_id, message):
+        """
+        Store a raw Gmail message in both tiers
+
+        Args:
+            user: User the message belongs to
+            message_id: Gmail message ID
+            message: Raw message dict as returned by messages().get(format='full')
+        """
+        data = json.dumps(message, separators=(',', ':')).encode('utf-8')
+
+        with self._lock:
+            self._memory_put((user, message_id), message, len(data))
+
+        self._disk_put(user, message_id, data)
+
+    def stats(self):
+        """
+        Get hit/miss counters and current tier sizes
+
+        Returns:
+            Dict of counters
+        """
+        with self._lock:
+            stats = dict(self._counters)
+            stats['memory_entries'] = len(self._memory)
+            stats['memory_bytes'] = self._memory_bytes
+
+        lookups = stats['memory_hits'] + stats['disk_hits'] + stats['misses']
+        stats['hit_rate'] = round((stats['memory_hits'] + stats['disk_hits']) / lookups, 3) if lookups else 0.0
+        return stats
+
+    def _memory_put(self, key, message, size=None):
+        """Insert into the LRU tier and evict down to the size cap (caller holds the lock)"""
+        if size is None:
+            size = len(json.dumps(message, separators=(',', ':')))
+
+        old = self._memory.pop(key, None)
+        if old is not None:
+            self._memory_bytes -= old[1]
+
+        self._memory[key] = (message, size)
+        self._memory_bytes += size
+
+        while self._memory_bytes > self.memory_max_bytes and self._memory:
+            _, (_, evicted_size) = self._memory.popitem(last=False)
+            self._memory_bytes -= evicted_size
+            self._counters['memory_evictions'] += 1
+
+    def _db(self):
+        """Per-thread SQLite connection"""
+        return sqlite_connection(self.db_path, self._local)
+
+    def _disk_get(self, user, message_id):
+        """Read a message from the SQLite tier, refreshing its LRU timestamp"""
+        if not self.disk_max_bytes:
+            return None
+
+        try:
+            db = self._db()
+            row = db.execute(
+                "SELECT data FROM messages WHERE user = ? AND message_id = ?",
+                (user, message_id)
+            ).fetchone()
+            if row is None:
+                return None
+            db.execute(
+                "UPDATE messages SET accessed = ? WHERE user = ? AND message_id = ?",
+                (time.time(), user, message_id)
+            )
+            return json.loads(zlib.decompress(row[0]))
+        except (sqlite3.Error, zlib.error, ValueError) as error:
+            # The cache must never break a request
+            print(f"Message cache read error: {error}")
+            return None
+
+    def _disk_put(self, user, message_id, data):
+        """Write a message to the SQLite tier and evict down to the size cap"""
+        if not self.disk_max_bytes:
+            return
+
+        blob = zlib.compress(data, 1)
+        try:
+            db = self._db()
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                old = db.execute(
+                    "SELECT size FROM messages WHERE user = ? AND message_id = ?",
+                    (user, message_id)
+                ).fetchone()
+                db.execute(
+                    "INSERT OR REPLACE INTO messages (user, message_id, data, size, accessed) VALUES (?, ?, ?, ?, ?)",
+                    (user, message_id, blob, len(blob), time.time())
+                )
+                db.execute(
+                    "UPDATE stats SET total_bytes = total_bytes + ? WHERE id = 0",
+                    (len(blob) - (old[0] if old else 0),)
+                )
+                evicted = self._disk_evict(db)
+                db.execute("COMMIT")
+            except BaseException:
+                db.execute("ROLLBACK")
+                raise
+        except sqlite3.Error as error:
+            print(f"Message cache write error: {error}")
+            return
+
+        if evicted:
+            with self._lock:
+                self._counters['disk_evictions'] += evicted
+
+    def _disk_evict(self, db):
+        """
+        Drop least recently used rows until the SQLite tier is under its cap
+        (caller holds a write transaction)
+
+        Returns:
+            Number of rows evicted
+        """
+        total = db.execute("SELECT total_bytes FROM stats WHERE id = 0").fetchone()[0]
+        excess = bytes_over_cap(total, self.disk_max_bytes)
+        if not excess:
+            return 0
+
+        victims = []
+        freed = 0
+        for user, message_id, size in db.execute(
+            "SELECT user, message_id, size FROM messages ORDER BY accessed"
+        ):
+            victims.append((user, message_id))
+            freed += size
+            excess -= size
+            if excess <= 0:
+                break
+
+        db.executemany("DELETE FROM messages WHERE user = ? AND message_id = ?", victims)
+        db.execute("UPDATE stats SET total_bytes = total_bytes - ? WHERE id = 0", (freed,))
+        return len(victims)
@@ -0,0 +1,154 @@
+"""
+Metrics Module
+Prometheus metrics for the chat pipeline: request, Claude, tool and Gmail
+latencies, token and cache counters, and errors. Under gunicorn each worker
+writes its samples to PROMETHEUS_MULTIPROC_DIR (prepared by gunicorn.conf.py)
+and /metrics adds them up, so a scrape covers every worker, not just the one
+that answered it
+"""
+
+import os
+import time
+from functools import wraps
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Histogram,
+    generate_latest,
+    multiprocess
+)
+
+# Shared sample directory; must be set before prometheus_client is imported
+PROMETHEUS_MULTIPROC_DIR = os.environ.get('PROMETHEUS_MULTIPROC_DIR')
+
+# Whole chats take seconds to minutes; single calls take milliseconds to seconds
+CHAT_BUCKETS = (0.5, 1, 2, 5, 10, 15, 20, 30, 45, 60, 90, 120, 180, 300)
+CALL_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+ITERATION_BUCKETS = (1, 2, 3, 4, 5, 6, 8, 10, 15, 20)
+
+CHAT_SECONDS = Histogram(
+    'gmail_chat_request_seconds',
+    'End-to-end chat request latency',
+    ['endpoint', 'outcome'],
+    buckets=CHAT_BUCKETS
+)
+CHAT_ITERATIONS = Histogram(
+    'gmail_chat_loop_iterations',
+    'Claude calls (agentic-loop iterations) per chat request',
+    ['endpoint'],
+    buckets=ITERATION_BUCKETS
+)
+CLAUDE_CALL_SECONDS = Histogram(
+    'gmail_chat_claude_call_seconds',
+    'Latency of one Claude call (one loop iteration)',
+    ['endpoint'],
+    buckets=CALL_BUCKETS
+)
+CLAUDE_TOKENS = Counter(
+    'gmail_chat_claude_tokens_total',
+    'Tokens reported in Claude response.usage',
+    ['type']
+)
+TOOL_SECONDS = Histogram(
+    'gmail_chat_tool_seconds',
+    'execute_tool latency',
+    ['tool', 'outcome'],
+    buckets=CALL_BUCKETS
+)
+GMAIL_CALL_SECONDS = Histogram(
+    'gmail_chat_gmail_call_seconds',
+    'Gmail API HTTP request latency (a batch request counts once)',
+    ['method', 'batched'],
+    buckets=CALL_BUCKETS
+)
+GMAIL_RETRIES = Counter(
+    'gmail_chat_gmail_retries_total',
+    'Gmail calls retried after a rate limit, server or network error',
+    ['method', 'kind']
+)
+CACHE_LOOKUPS = Counter(
+    'gmail_chat_cache_lookups_total',
+    'Cache lookups by cache and result (hit rate = hit / all)',
+    ['cache', 'result']
+)
+ERRORS = Counter(
+    'gmail_chat_errors_total',
+    'Errors by the component that raised them and their kind',
+    ['component', 'kind']
+)
+
+# usage field -> CLAUDE_TOKENS type label
+TOKEN_TYPES = {
+    'input_tokens': 'input',
+    'output_tokens': 'output',
+    'cache_read_input_tokens': 'cache_read',
+    'cache_creation_input_tokens': 'cache_write',
+}
+
+
+def observe_chat(endpoint, outcome, seconds, iterations):
+    """Record a finished chat request"""
+    CHAT_SECONDS.labels(endpoint, outcome).observe(seconds)
+    if iterations:
+        CHAT_ITERATIONS.labels(endpoint).observe(iterations)
+
+
+def observe_claude_call(endpoint, seconds, usage):
+    """Record one Claude call and the tokens in its response.usage"""
+    CLAUDE_CALL_SECONDS.labels(endpoint).observe(seconds)
+    for field, token_type in TOKEN_TYPES.items():
+        count = getattr(usage, field, None)
+        if count:
+            CLAUDE_TOKENS.labels(token_type).inc(count)
+
+
+def observe_cache(cache, result):
+    """Count a cache lookup; result is 'hit', 'miss' or a tier such as 'memory_hit'"""
+    CACHE_LOOKUPS.labels(cache, result).inc()
+
+
+def count_error(component, error):
+    """Count an error; GmailAPIError kinds are kept, other exceptions use their class name"""
+    kind = error if isinstance(error, str) else getattr(error, 'kind', None) or type(error).__name__
+    ERRORS.labels(component, kind).inc()
+
+
+def timed_tool(execute_tool):
+    """Decorator for execute_tool(gmail_service, tool_name, tool_input) recording latency by tool"""
+    @wraps(execute_tool)
+    def timed(gmail_service, tool_name, tool_input):
+        started = time.monotonic()
+        outcome = 'error'
+        try:
+            result = execute_tool(gmail_service, tool_name, tool_input)
+            outcome = 'ok'
+            return result
+        except Exception as error:
+            # Imported here: gmail_scheduler imports this module
+            from gmail_scheduler import GmailAPIError
+            # Gmail failures were already counted once, as 'gmail', by the scheduler
+            if not isinstance(error, GmailAPIError):
+                count_error('tool', error)
+            raise
+        finally:
+            TOOL_SECONDS.labels(tool_name, outcome).observe(time.monotonic() - started)
+    return timed
+
+
+def render():
+    """
+    Render all metrics in the Prometheus text format
+
+    Returns:
+        (body, content_type) tuple
+    """
+    if PROMETHEUS_MULTIPROC_DIR:
+        # Merge every worker's sample files, including workers that have exited
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
@@ -0,0 +1,200 @@
+"""
+Result Governor Module
+Keeps tool results inside a per-turn token budget so long agentic loops
+don't grow without bound or run into the context window
+"""
+
+import os
+import json
+
+# Context window of the Claude model in use
+CONTEXT_TOKENS = int(os.environ.get('CLAUDE_CONTEXT_TOKENS', '200000'))
+
+# Tokens all tool results of one turn may add to the conversation
+TURN_RESULT_TOKENS = int(os.environ.get('TOOL_RESULT_TURN_TOKENS', '20000'))
+
+# A turn always gets at least this much, even when the context is nearly full
+MIN_TURN_TOKENS = 500
+
+# Below this many characters per email, bodies are dropped in favour of summaries
+MIN_BODY_CHARS = int(os.environ.get('TOOL_RESULT_MIN_BODY_CHARS', '200'))
+
+# Rough size of a token in JSON-encoded English text (errs on the side of more tokens)
+CHARS_PER_TOKEN = 3.5
+
+# Fields kept when bodies no longer fit, then when even snippets don't
+SUMMARY_FIELDS = ('id', 'subject', 'from', 'date', 'snippet', 'attachmentCount', 'error')
+MINIMAL_FIELDS = ('id', 'subject', 'from', 'date', 'error')
+
+# Room reserved for the note telling Claude what was cut
+NOTE_CHARS = 200
+
+
+def estimate_tokens(value):
+    """Estimate the tokens a string or JSON-serializable value takes up"""
+    text = value if isinstance(value, str) else json.dumps(value)
+    return int(len(text) / CHARS_PER_TOKEN) + 1
+
+
+class ResultGovernor:
+    def __init__(self, context_tokens=CONTEXT_TOKENS, turn_tokens=TURN_RESULT_TOKENS, reserve_tokens=0):
+        """
+        Track one chat's context use and fit each turn's tool results to a budget
+
+        Args:
+            context_tokens: Model context window
+            turn_tokens: Maximum tokens of tool results per turn
+            reserve_tokens: Tokens kept free for Claude's reply (max_tokens)
+        """
+        self.context_tokens = context_tokens
+        self.turn_tokens = turn_tokens
+        self.reserve_tokens = reserve_tokens
+        self.used_tokens = 0
+
+    def observe(self, usage):
+        """
+        Reset the running estimate from a Claude response's exact usage
+
+        Args:
+            usage: response.usage (prompt plus output is what the next call resends)
+        """
+        self.used_tokens = sum(
+            getattr(usage, field, 0) or 0
+            for field in ('input_tokens', 'cache_creation_input_tokens', 'cache_read_input_tokens', 'output_tokens')
+        )
+
+    def turn_budget(self):
+        """Tokens available for this turn's tool results"""
+        available = self.context_tokens - self.reserve_tokens - self.used_tokens
+        return max(MIN_TURN_TOKENS, min(self.turn_tokens, available))
+
+    def fit(self, outcomes):
+        """
+        Shrink one turn's tool results to the turn budget
+
+        Results smaller than their fair share are left alone; the rest split
+        what remains.
+
+        Args:
+            outcomes: (block, result, error) tuples in block order
+
+        Returns:
+            The same tuples with oversized results shrunk
+        """
+        sizes = [0 if error else len(json.dumps(result)) for _, result, error in outcomes]
+        allowances = fair_shares(sizes, int(self.turn_budget() * CHARS_PER_TOKEN))
+
+        fitted = []
+        for (block, result, error), size, allowed in zip(outcomes, sizes, allowances):
+            if not error and size > allowed:
+                result = shrink_result(result, allowed)
+                print(f"Result governor: {block.name} result {size:,d} -> {len(json.dumps(result)):,d} chars")
+            if not error:
+                self.used_tokens += estimate_tokens(result)
+            fitted.append((block, result, error))
+        return fitted
+
+
+def fair_shares(sizes, budget):
+    """Max-min fair split of budget across sizes (small ones get all they need)"""
+    allowances = list(sizes)
+    pending = sorted(range(len(sizes)), key=lambda i: sizes[i])
+    remaining = budget
+    while pending:
+        share = remaining // len(pending)
+        if sizes[pending[0]] <= share:
+            remaining -= sizes[pending.pop(0)]
+            continue
+        for i in pending:
+            allowances[i] = share
+        break
+    return allowances
+
+
+def shrink_result(result, max_chars):
+    """
+    Shrink a tool result to roughly max_chars of JSON
+
+    Emails get their bodies cut proportionally, then are reduced to summaries,
+    then to as many minimal summaries as fit. A note tells Claude what was cut.
+
+    Args:
+        result: Tool result (parsed email, list of emails, thread, or anything JSON)
+        max_chars: Target JSON size
+
+    Returns:
+        The shrunk result
+    """
+    if _is_email(result):
+        emails, note = _shrink_emails([result], max_chars)
+        return dict(emails[0], note=note)
+
+    if isinstance(result, list) and result and all(_is_email(item) for item in result):
+        emails, note = _shrink_emails(result, max_chars)
+        return {"results": emails, "note": note}
+
+    messages = result.get('messages') if isinstance(result, dict) else None
+    if isinstance(messages, list) and messages and all(_is_email(item) for item in messages):
+        # A thread: shrink its messages, keep the thread fields
+        others = len(json.dumps(dict(result, messages=[])))
+        emails, note = _shrink_emails(messages, max_chars - others)
+        return dict(result, messages=emails, note=note)
+
+    return _shrink_other(result, max_chars)
+
+
+def _shrink_emails(emails, max_chars):
+    """Shrink a list of parsed emails, returns (emails, note)"""
+    # Proportional body cuts while every email can keep a useful amount
+    bodies = sum(len(email.get('body', '')) for email in emails)
+    overhead = len(json.dumps([dict(email, body='') for email in emails])) + NOTE_CHARS
+    room = max_chars - overhead
+    if bodies and room >= MIN_BODY_CHARS * len(emails):
+        scale = room / bodies
+        shortened = [
+            dict(email, body=_cut(email['body'], int(len(email['body']) * scale))) if 'body' in email else email
+            for email in emails
+        ]
+        return shortened, ("Email bodies were shortened to fit the context budget; "
+                           "call get_email_content for the full text of a message.")
+
+    for fields in (SUMMARY_FIELDS, MINIMAL_FIELDS):
+        summaries = [{key: email[key] for key in fields if key in email} for email in emails]
+        if len(json.dumps(summaries)) + NOTE_CHARS <= max_chars:
+            return summaries, ("Email bodies were left out to fit the context budget; "
+                               "call get_email_content for the messages you need.")
+
+    kept = []
+    size = 2
+    for summary in summaries:
+        size += len(json.dumps(summary)) + 2
+        if size + NOTE_CHARS > max_chars and kept:
+            break
+        kept.append(summary)
+    return kept, (f"Only the first {len(kept)} of {len(emails)} emails fit the context budget; "
+                  "narrow the search to see the rest.")
+
+
+def _is_email(value):
+    # Thread messages carry no subject of their own; get_emails reports failed IDs inline
+    return isinstance(value, dict) and 'id' in value and ('subject' in value or 'body' in value or 'error' in value)
+
+
+def _cut(text, length):
+    return text if len(text) <= length else text[:length] + '...'
+
+
+def _shrink_other(result, max_chars):
+    """Fallback for non-email results: keep leading list items, or cut the JSON text"""
+    if isinstance(result, list):
+        kept = []
+        size = 2
+        for item in result:
+            size += len(json.dumps(item)) + 2
+            if size + NOTE_CHARS > max_chars:
+                break
+            kept.append(item)
+        return {"results": kept, "note": f"Only the first {len(kept)} of {len(result)} items fit the context budget."}
+
+    text = json.dumps(result)
+    return {"truncated": text[:max(max_chars - NOTE_CHARS, 0)], "note": "Result cut to fit the context budget."}
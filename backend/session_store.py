@@ -0,0 +1,409 @@
+"""
+Session Store Module
+Pluggable storage for login sessions and pending OAuth states, so sessions
+survive restarts and are visible to every gunicorn worker
+"""
+
+import os
+import json
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from cryptography.fernet import Fernet, InvalidToken
+from google.oauth2.credentials import Credentials
+from sqlite_db import sqlite_connection
+
+# Which backend to use: 'sqlite' (default, shared by workers) or 'memory'
+SESSION_BACKEND = os.environ.get('SESSION_BACKEND', 'sqlite')
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), 'data')
+SESSION_DB_PATH = os.environ.get('SESSION_DB_PATH', os.path.join(DATA_DIR, 'sessions.db'))
+SESSION_KEY_FILE = os.path.join(DATA_DIR, 'session.key')
+
+# Sessions match the 7-day cookie; abandoned OAuth states go after 10 minutes
+SESSION_TTL_SECONDS = int(os.environ.get('SESSION_TTL_SECONDS', str(86400 * 7)))
+STATE_TTL_SECONDS = int(os.environ.get('OAUTH_STATE_TTL_SECONDS', '600'))
+
+# How long a worker trusts its in-process copy of a session before re-reading it
+SESSION_CACHE_SECONDS = float(os.environ.get('SESSION_CACHE_SECONDS', '30'))
+
+# Hard caps; beyond these the least recently used entries are evicted
+MAX_SESSIONS = int(os.environ.get('MAX_SESSIONS', '10000'))
+MAX_PENDING_STATES = int(os.environ.get('MAX_PENDING_STATES', '5000'))
+SESSION_CACHE_MAX = int(os.environ.get('SESSION_CACHE_MAX', '1000'))
+
+
+class SessionStore(ABC):
+    """
+    Interface for session backends
+
+    Sessions are dicts with 'email' and 'credentials' (a google Credentials object).
+    """
+
+    @abstractmethod
+    def get_session(self, session_id):
+        """Return the session dict, or None if missing or expired"""
+
+    def reload_session(self, session_id):
+        """Like get_session, but read from storage even if this process has a cached copy"""
+        return self.get_session(session_id)
+
+    @abstractmethod
+    def save_session(self, session_id, email, credentials):
+        """Create or update a session"""
+
+    @abstractmethod
+    def delete_session(self, session_id):
+        """Remove a session, returns the email it belonged to (or None)"""
+
+    @abstractmethod
+    def add_state(self, state):
+        """Remember a pending OAuth state"""
+
+    @abstractmethod
+    def pop_state(self, state):
+        """Consume a pending OAuth state, returns True if it was valid"""
+
+    @abstractmethod
+    def sweep(self):
+        """Remove expired sessions and states"""
+
+    @abstractmethod
+    def stats(self):
+        """Current table sizes and eviction/expiry counts"""
+
+    @staticmethod
+    def _new_counters():
+        return {
+            'sessions_evicted': 0,
+            'sessions_expired': 0,
+            'states_evicted': 0,
+            'states_expired': 0,
+        }
+
+
+class MemorySessionStore(SessionStore):
+    """Per-process dicts (sessions are lost on restart and not shared by workers)"""
+
+    def __init__(self, session_ttl=SESSION_TTL_SECONDS, state_ttl=STATE_TTL_SECONDS,
+                 max_sessions=MAX_SESSIONS, max_states=MAX_PENDING_STATES):
+        self.session_ttl = session_ttl
+        self.state_ttl = state_ttl
+        self.max_sessions = max_sessions
+        self.max_states = max_states
+
+        # Key: session_id -> Value: (session dict, expires_at), least recently used first
+        self._sessions = OrderedDict()
+        # Key: state -> Value: expires_at, oldest first
+        self._states = OrderedDict()
+        self._lock = threading.Lock()
+        self._counters = self._new_counters()
+
+    def get_session(self, session_id):
+        with self._lock:
+            entry = self._sessions.get(session_id)
+            if entry is None:
+                return None
+            if entry[1] <= time.time():
+                del self._sessions[session_id]
+                self._counters['sessions_expired'] += 1
+                return None
+            self._sessions.move_to_end(session_id)
+            return entry[0]
+
+    def save_session(self, session_id, email, credentials):
+        with self._lock:
+            entry = self._sessions.pop(session_id, None)
+            expires_at = entry[1] if entry else time.time() + self.session_ttl
+            self._sessions[session_id] = ({'email': email, 'credentials': credentials}, expires_at)
+            while len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+                self._counters['sessions_evicted'] += 1
+
+    def delete_session(self, session_id):
+        with self._lock:
+            entry = self._sessions.pop(session_id, None)
+        return entry[0]['email'] if entry else None
+
+    def add_state(self, state):
+        with self._lock:
+            self._states[state] = time.time() + self.state_ttl
+            while len(self._states) > self.max_states:
+                self._states.popitem(last=False)
+                self._counters['states_evicted'] += 1
+
+    def pop_state(self, state):
+        with self._lock:
+            expires_at = self._states.pop(state, None)
+        return expires_at is not None and expires_at > time.time()
+
+    def sweep(self):
+        now = time.time()
+        with self._lock:
+            for session_id in [k for k, (_, expires_at) in self._sessions.items() if expires_at <= now]:
+                del self._sessions[session_id]
+                self._counters['sessions_expired'] += 1
+            # States are kept in creation order, so expired ones are at the front
+            while self._states and next(iter(self._states.values())) <= now:
+                self._states.popitem(last=False)
+                self._counters['states_expired'] += 1
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counters)
+            stats['sessions'] = len(self._sessions)
+            stats['pending_states'] = len(self._states)
+        return stats
+
+
+class SQLiteSessionStore(SessionStore):
+    """
+    SQLite file on local disk with encrypted credentials
+
+    A small in-process read-through cache keeps auth checks off the disk;
+    a session deleted by another worker may be honoured here for up to
+    SESSION_CACHE_SECONDS.
+    """
+
+    def __init__(self, db_path=SESSION_DB_PATH, session_ttl=SESSION_TTL_SECONDS,
+                 state_ttl=STATE_TTL_SECONDS, cache_seconds=SESSION_CACHE_SECONDS,
+                 max_sessions=MAX_SESSIONS, max_states=MAX_PENDING_STATES, cache_max=SESSION_CACHE_MAX):
+        self.db_path = db_path
+        self.session_ttl = session_ttl
+        self.state_ttl = state_ttl
+        self.cache_seconds = cache_seconds
+        self.max_sessions = max_sessions
+        self.max_states = max_states
+        self.cache_max = cache_max
+
+        self._fernet = Fernet(_load_encryption_key())
+        self._local = threading.local()
+
+        # Key: session_id -> Value: (session dict, expires_at, cached_at), least recently used first
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self._counters = self._new_counters()
+
+        os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
+        db = self._db()
+        db.execute("""
+            CREATE TABLE IF NOT EXISTS sessions (
+                session_id TEXT PRIMARY KEY,
+                email TEXT NOT NULL,
+                credentials BLOB NOT NULL,
+                expires_at REAL NOT NULL,
+                last_access REAL NOT NULL
+            )
+        """)
+        db.execute("""
+            CREATE TABLE IF NOT EXISTS oauth_states (
+                state TEXT PRIMARY KEY,
+                expires_at REAL NOT NULL
+            )
+        """)
+        db.execute("CREATE INDEX IF NOT EXISTS sessions_last_access ON sessions (last_access)")
+        db.execute("CREATE INDEX IF NOT EXISTS sessions_expires_at ON sessions (expires_at)")
+        db.execute("CREATE INDEX IF NOT EXISTS oauth_states_expires_at ON oauth_states (expires_at)")
+
+    def get_session(self, session_id):
+        now = time.time()
+
+        with self._lock:
+            entry = self._cache.get(session_id)
+            if entry is not None:
+                session, expires_at, cached_at = entry
+                if expires_at > now and now - cached_at < self.cache_seconds:
+                    self._cache.move_to_end(session_id)
+                    return session
+                del self._cache[session_id]
+
+        db = self._db()
+        row = db.execute(
+            "SELECT email, credentials, expires_at FROM sessions WHERE session_id = ?",
+            (session_id,)
+        ).fetchone()
+
+        if row is None:
+            return None
+
+        email, encrypted, expires_at = row
+        if expires_at <= now:
+            self.delete_session(session_id)
+            with self._lock:
+                self._counters['sessions_expired'] += 1
+            return None
+
+        # LRU order on disk is only updated on cache misses, which is close enough
+        db.execute("UPDATE sessions SET last_access = ? WHERE session_id = ?", (now, session_id))
+
+        try:
+            info = json.loads(self._fernet.decrypt(encrypted))
+            credentials = Credentials.from_authorized_user_info(info)
+        except (InvalidToken, ValueError) as e:
+            # Wrong key or corrupt row - treat as logged out
+            print(f"Could not load session credentials: {e}")
+            self.delete_session(session_id)
+            return None
+
+        session = {'email': email, 'credentials': credentials}
+        self._cache_put(session_id, session, expires_at, now)
+        return session
+
+    def reload_session(self, session_id):
+        with self._lock:
+            self._cache.pop(session_id, None)
+        return self.get_session(session_id)
+
+    def save_session(self, session_id, email, credentials):
+        now = time.time()
+        encrypted = self._fernet.encrypt(credentials.to_json().encode('utf-8'))
+
+        db = self._db()
+        # Keep the original expiry when updating (e.g. after a token refresh)
+        db.execute(
+            """
+            INSERT INTO sessions (session_id, email, credentials, expires_at, last_access)
+            VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT(session_id) DO UPDATE SET
+                email = excluded.email,
+                credentials = excluded.credentials,
+                last_access = excluded.last_access
+            """,
+            (session_id, email, encrypted, now + self.session_ttl, now)
+        )
+        expires_at = db.execute(
+            "SELECT expires_at FROM sessions WHERE session_id = ?", (session_id,)
+        ).fetchone()[0]
+
+        evicted = self._evict_lru(
+            db, "sessions", "session_id", "last_access", self.max_sessions
+        )
+        with self._lock:
+            self._counters['sessions_evicted'] += evicted
+
+        self._cache_put(session_id, {'email': email, 'credentials': credentials}, expires_at, now)
+
+    def delete_session(self, session_id):
+        with self._lock:
+            self._cache.pop(session_id, None)
+
+        db = self._db()
+        row = db.execute("SELECT email FROM sessions WHERE session_id = ?", (session_id,)).fetchone()
+        db.execute("DELETE FROM sessions WHERE session_id = ?", (session_id,))
+        return row[0] if row else None
+
+    def add_state(self, state):
+        db = self._db()
+        db.execute(
+            "INSERT OR REPLACE INTO oauth_states (state, expires_at) VALUES (?, ?)",
+            (state, time.time() + self.state_ttl)
+        )
+
+        # Every state has the same TTL, so the earliest expiry is the oldest
+        evicted = self._evict_lru(db, "oauth_states", "state", "expires_at", self.max_states)
+        with self._lock:
+            self._counters['states_evicted'] += evicted
+
+    def pop_state(self, state):
+        # DELETE ... RETURNING makes the check-and-consume atomic across workers
+        row = self._db().execute(
+            "DELETE FROM oauth_states WHERE state = ? RETURNING expires_at",
+            (state,)
+        ).fetchone()
+        return row is not None and row[0] > time.time()
+
+    def sweep(self):
+        now = time.time()
+        db = self._db()
+        sessions_expired = db.execute("DELETE FROM sessions WHERE expires_at <= ?", (now,)).rowcount
+        states_expired = db.execute("DELETE FROM oauth_states WHERE expires_at <= ?", (now,)).rowcount
+
+        with self._lock:
+            self._counters['sessions_expired'] += sessions_expired
+            self._counters['states_expired'] += states_expired
+            for session_id in [k for k, (_, expires_at, cached_at) in self._cache.items()
+                               if expires_at <= now or now - cached_at >= self.cache_seconds]:
+                del self._cache[session_id]
+
+    def stats(self):
+        db = self._db()
+        sessions = db.execute("SELECT COUNT(*) FROM sessions").fetchone()[0]
+        states = db.execute("SELECT COUNT(*) FROM oauth_states").fetchone()[0]
+
+        with self._lock:
+            stats = dict(self._counters)
+            stats['cached_sessions'] = len(self._cache)
+        stats['sessions'] = sessions
+        stats['pending_states'] = states
+        return stats
+
+    def _cache_put(self, session_id, session, expires_at, now):
+        """Insert into the read-through cache, evicting the least recently used entries"""
+        with self._lock:
+            self._cache.pop(session_id, None)
+            self._cache[session_id] = (session, expires_at, now)
+            while len(self._cache) > self.cache_max:
+                self._cache.popitem(last=False)
+
+    @staticmethod
+    def _evict_lru(db, table, key_column, order_column, max_rows):
+        """Delete the oldest rows of a table beyond max_rows, returns how many were deleted"""
+        count = db.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+        if count <= max_rows:
+            return 0
+        return db.execute(
+            f"DELETE FROM {table} WHERE {key_column} IN "
+            f"(SELECT {key_column} FROM {table} ORDER BY {order_column} LIMIT ?)",
+            (count - max_rows,)
+        ).rowcount
+
+    def _db(self):
+        """Per-thread SQLite connection"""
+        return sqlite_connection(self.db_path, self._local, synchronous='FULL')
+
+
+def _load_encryption_key():
+    """
+    Get the Fernet key used to encrypt stored credentials
+
+    Uses SESSION_ENCRYPTION_KEY when set. Otherwise a key is generated once
+    and kept next to the database, readable only by the app user.
+    """
+    key = os.environ.get('SESSION_ENCRYPTION_KEY')
+    if key:
+        return key.encode('utf-8')
+
+    os.makedirs(DATA_DIR, exist_ok=True)
+    try:
+        # O_EXCL so concurrent workers starting up agree on one key
+        fd = os.open(SESSION_KEY_FILE, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    except FileExistsError:
+        with open(SESSION_KEY_FILE, 'rb') as f:
+            key = f.read().strip()
+        if key:
+            return key
+        # Another worker created the file but has not written it yet
+        time.sleep(0.1)
+        with open(SESSION_KEY_FILE, 'rb') as f:
+            return f.read().strip()
+
+    key = Fernet.generate_key()
+    with os.fdopen(fd, 'wb') as f:
+        f.write(key)
+    print(f"Generated session encryption key at {SESSION_KEY_FILE} (set SESSION_ENCRYPTION_KEY to manage it yourself)")
+    return key
+
+
+def create_session_store():
+    """
+    Create the session store selected by SESSION_BACKEND
+
+    Returns:
+        SessionStore instance
+    """
+    if SESSION_BACKEND == 'memory':
+        return MemorySessionStore()
+    if SESSION_BACKEND == 'sqlite':
+        return SQLiteSessionStore()
+    raise ValueError(f"Unknown SESSION_BACKEND: {SESSION_BACKEND}")
@@ -0,0 +1,50 @@
+"""
+SQLite Helpers
+Per-thread WAL connections and the shared eviction target for the SQLite-backed
+stores (message cache, attachment cache, session store, mailbox index)
+"""
+
+import sqlite3
+
+# Size-capped stores evict down to this share of their cap, so one eviction
+# makes room for many writes instead of running on every one
+EVICTION_TARGET = 0.9
+
+
+def sqlite_connection(path, local, synchronous='NORMAL'):
+    """
+    Get the calling thread's connection to a SQLite file, opening it on first use
+
+    Connections cannot be shared across threads, so each thread gets its own,
+    kept on the owner's threading.local and closed when the owner goes away.
+    Autocommit mode: callers open their own BEGIN IMMEDIATE transactions.
+
+    Args:
+        path: SQLite file path
+        local: The owning store's threading.local
+        synchronous: PRAGMA synchronous level (NORMAL is safe under WAL; FULL
+            also survives power loss)
+
+    Returns:
+        sqlite3.Connection
+    """
+    conn = getattr(local, 'conn', None)
+    if conn is None:
+        conn = sqlite3.connect(path, timeout=10, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(f"PRAGMA synchronous={synchronous}")
+        local.conn = conn
+    return conn
+
+
+def bytes_over_cap(total, max_bytes):
+    """
+    Bytes to evict from a store holding `total` bytes under a `max_bytes` cap
+
+    Returns:
+        0 while the store is within its cap, else enough to get down to
+        EVICTION_TARGET of the cap
+    """
+    if total <= max_bytes:
+        return 0
+    return total - int(max_bytes * EVICTION_TARGET)
@@ -0,0 +1,19 @@
+"""
+Shared pytest setup: the backend modules are imported by name, as the app does,
+and every on-disk store points at a scratch directory so importing app stays
+out of the real data and cache directories
+"""
+
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+_scratch = tempfile.mkdtemp(prefix='gmail-backend-tests-')
+os.environ.setdefault('SESSION_BACKEND', 'memory')
+os.environ.setdefault('MESSAGE_CACHE_DB', os.path.join(_scratch, 'messages.db'))
+os.environ.setdefault('ATTACHMENT_CACHE_DIR', os.path.join(_scratch, 'attachments'))
+os.environ.setdefault('TRACE_DIR', os.path.join(_scratch, 'traces'))
+os.environ.setdefault('MAILBOX_INDEX_DIR', os.path.join(_scratch, 'index'))
+os.environ.setdefault('ANTHROPIC_API_KEY', 'test-key')
@@ -0,0 +1,53 @@
+"""
+parse_byte_range tests: the single-range subset of RFC 9110 the attachment download serves
+"""
+
+import pytest
+
+from app import parse_byte_range
+
+SIZE = 1000
+
+
+@pytest.mark.parametrize('header, expected', [
+    ('bytes=0-99', (0, 100)),
+    ('bytes=100-', (100, SIZE)),
+    ('bytes=-200', (SIZE - 200, SIZE)),
+    ('bytes=999-999', (999, SIZE)),
+    # The last byte is clamped to the file
+    ('bytes=900-5000', (900, SIZE)),
+    # A suffix longer than the file is the whole file
+    ('bytes=-5000', (0, SIZE)),
+    (' bytes = 10 - 19 ', (10, 20)),
+])
+def test_satisfiable_ranges(header, expected):
+    assert parse_byte_range(header, SIZE) == expected
+
+
+@pytest.mark.parametrize('header', [
+    None,
+    '',
+    'bytes=-',
+    'bytes=abc-def',
+    'bytes=0-99,200-299',
+    'items=0-99',
+    # Last byte before the first is invalid and the header is ignored
+    'bytes=500-100',
+])
+def test_ignored_headers_send_the_whole_file(header):
+    assert parse_byte_range(header, SIZE) is None
+
+
+def test_unknown_size_sends_the_whole_file():
+    assert parse_byte_range('bytes=0-99', None) is None
+
+
+@pytest.mark.parametrize('header, size', [
+    ('bytes=1000-', SIZE),
+    ('bytes=2000-2100', SIZE),
+    ('bytes=-0', SIZE),
+    ('bytes=0-', 0),
+])
+def test_unsatisfiable_ranges_raise(header, size):
+    with pytest.raises(ValueError):
+        parse_byte_range(header, size)
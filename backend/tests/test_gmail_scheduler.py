@@ -0,0 +1,163 @@
+"""
+GmailScheduler tests: error classification, retries and bucket eviction
+"""
+
+import json
+import socket
+
+import httplib2
+import pytest
+from googleapiclient.errors import HttpError
+
+from gmail_scheduler import (
+    GmailAPIError,
+    GmailScheduler,
+    backoff_delay,
+    classify_exception,
+    classify_status,
+    parse_retry_after
+)
+
+
+@pytest.fixture
+def no_sleep(monkeypatch):
+    """Record the scheduler's sleeps instead of sleeping"""
+    sleeps = []
+    monkeypatch.setattr('gmail_scheduler.time.sleep', sleeps.append)
+    return sleeps
+
+
+def http_error(status, reason=None, retry_after=None):
+    """HttpError shaped like a Gmail JSON error response"""
+    headers = {'status': str(status)}
+    if retry_after is not None:
+        headers['retry-after'] = str(retry_after)
+    errors = [{'reason': reason, 'message': 'boom'}] if reason else []
+    content = json.dumps({'error': {'code': status, 'message': 'boom', 'errors': errors}}).encode()
+    return HttpError(httplib2.Response(headers), content)
+
+
+@pytest.mark.parametrize('status, reasons, kind, retryable', [
+    (429, [], 'rate_limited', True),
+    (403, ['userRateLimitExceeded'], 'rate_limited', True),
+    (403, ['dailyLimitExceeded'], 'quota_exceeded', False),
+    (403, [], 'permission_denied', False),
+    (401, [], 'unauthenticated', False),
+    (404, [], 'not_found', False),
+    (400, [], 'invalid_request', False),
+    (503, [], 'server_error', True),
+])
+def test_classify_status(status, reasons, kind, retryable):
+    error = classify_status(status, reasons)
+    assert (error.kind, error.retryable, error.status) == (kind, retryable, status)
+
+
+def test_classify_http_error_reads_reason_and_retry_after():
+    error = classify_exception(http_error(403, 'rateLimitExceeded', retry_after=7))
+    assert error.kind == 'rate_limited'
+    assert error.retry_after == 7
+
+
+def test_classify_network_and_unrelated_errors():
+    assert classify_exception(socket.timeout('timed out')).kind == 'network_error'
+    assert classify_exception(KeyError('id')) is None
+
+
+def test_parse_retry_after():
+    assert parse_retry_after('12') == 12
+    assert parse_retry_after('') is None
+    assert parse_retry_after('soon') is None
+
+
+def test_backoff_never_shorter_than_retry_after():
+    assert all(backoff_delay(attempt) <= 16 for attempt in range(10))
+    assert backoff_delay(0, retry_after=5) >= 5
+
+
+def test_transient_failures_are_retried(no_sleep):
+    failures = [http_error(429), http_error(503)]
+
+    def call():
+        if failures:
+            raise failures.pop(0)
+        return 'ok'
+
+    scheduler = GmailScheduler(rate=0, max_retries=4)
+    assert scheduler.call('alice@example.com', 'messages.get', call) == 'ok'
+    stats = scheduler.stats()
+    assert (stats['retries'], stats['throttled'], stats['failures']) == (2, 1, 0)
+    # Backoff sleeps, plus the rate-limit pause every caller for the user now waits out
+    assert no_sleep
+
+
+def test_permanent_failure_is_not_retried(no_sleep):
+    calls = []
+
+    def call():
+        calls.append(1)
+        raise http_error(404)
+
+    scheduler = GmailScheduler(rate=0)
+    with pytest.raises(GmailAPIError) as raised:
+        scheduler.call('alice@example.com', 'messages.get', call)
+    assert raised.value.kind == 'not_found'
+    assert len(calls) == 1
+    assert no_sleep == []
+
+
+def test_gives_up_after_max_retries(no_sleep):
+    calls = []
+
+    def call():
+        calls.append(1)
+        raise http_error(500)
+
+    scheduler = GmailScheduler(rate=0, max_retries=2)
+    with pytest.raises(GmailAPIError) as raised:
+        scheduler.call('alice@example.com', 'messages.get', call)
+    assert raised.value.kind == 'server_error'
+    assert len(calls) == 3
+
+
+def test_long_retry_after_fails_at_once(no_sleep):
+    def call():
+        raise http_error(429, retry_after=3600)
+
+    with pytest.raises(GmailAPIError) as raised:
+        GmailScheduler(rate=0).call('alice@example.com', 'messages.get', call)
+    assert raised.value.retry_after == 3600
+    assert no_sleep == []
+
+
+def test_other_exceptions_pass_through(no_sleep):
+    def call():
+        raise KeyError('id')
+
+    with pytest.raises(KeyError):
+        GmailScheduler(rate=0).call('alice@example.com', 'messages.get', call)
+
+
+def test_bucket_makes_callers_wait_once_burst_is_spent(no_sleep):
+    scheduler = GmailScheduler(rate=100, burst=10)
+    for _ in range(3):
+        scheduler.call('alice@example.com', 'messages.get', lambda: None)
+    # 15 units against a burst of 10 at 100 units/s: the third call waits ~0.05s
+    assert len(no_sleep) == 1
+    assert 0.04 < no_sleep[0] <= 0.05
+
+
+def test_idle_buckets_are_dropped(monkeypatch):
+    clock = [1000.0]
+    monkeypatch.setattr('gmail_scheduler.time.monotonic', lambda: clock[0])
+    scheduler = GmailScheduler(rate=0, idle_seconds=60)
+
+    first = scheduler._bucket('alice@example.com')
+    scheduler._bucket('bob@example.com')
+    clock[0] += 30
+    assert scheduler._bucket('alice@example.com') is first
+
+    # bob was last used 61s ago, alice 31s ago
+    clock[0] += 31
+    assert scheduler.stats()['users'] == 1
+    assert scheduler._bucket('alice@example.com') is first
+    assert list(scheduler._buckets) == ['alice@example.com']
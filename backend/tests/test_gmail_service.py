@@ -0,0 +1,153 @@
+"""
+GmailService tests against a stubbed scheduler (no network)
+"""
+
+import base64
+from unittest.mock import MagicMock
+
+import pytest
+
+from gmail_scheduler import GmailAPIError
+from gmail_service import GmailService
+
+
+def raw_message(message_id, body='Hello'):
+    """Minimal 'full' format message with a text/plain body"""
+    return {
+        'id': message_id,
+        'threadId': f"t-{message_id}",
+        'snippet': body,
+        'payload': {
+            'mimeType': 'text/plain',
+            'headers': [{'name': 'Subject', 'value': f"Subject {message_id}"}],
+            'body': {'data': base64.urlsafe_b64encode(body.encode()).decode()},
+        },
+    }
+
+
+class BatchScheduler:
+    """Answers execute_batch from a fixed set of failures; everything else succeeds"""
+
+    def __init__(self, failures):
+        self.failures = failures
+
+    def execute_batch(self, user, method, service, keys, build_request):
+        responses = {key: raw_message(key) for key in keys if key not in self.failures}
+        failed = {key: self.failures[key] for key in keys if key in self.failures}
+        return responses, failed
+
+
+def search_service(message_ids, failures):
+    """GmailService whose search lists message_ids and fails the given fetches"""
+    gmail = GmailService(service=MagicMock(), scheduler=BatchScheduler(failures))
+    gmail._iter_message_ids = lambda query, max_results: iter([(message_ids, False)])
+    return gmail
+
+
+@pytest.mark.parametrize('include_body', [True, False])
+def test_search_raises_when_every_fetch_failed(include_body):
+    ids = ['m1', 'm2', 'm3']
+    failures = {
+        'm1': GmailAPIError('rate_limited', 'Too many requests', 429, True),
+        'm2': GmailAPIError('rate_limited', 'Too many requests', 429, True),
+        'm3': GmailAPIError('server_error', 'Backend error', 500, True),
+    }
+    gmail = search_service(ids, failures)
+
+    with pytest.raises(GmailAPIError) as raised:
+        gmail.search_emails('from:alice', max_results=3, include_body=include_body)
+    assert raised.value.kind == 'rate_limited'
+
+
+@pytest.mark.parametrize('include_body', [True, False])
+def test_search_reports_partly_failed_batch(include_body):
+    ids = ['m1', 'm2', 'm3']
+    failures = {'m2': GmailAPIError('rate_limited', 'Too many requests', 429, True)}
+    gmail = search_service(ids, failures)
+
+    errors = {}
+    results = gmail.search_emails('from:alice', max_results=3, include_body=include_body, errors=errors)
+
+    assert [message['id'] for message in results] == ['m1', 'm3']
+    assert list(errors) == ['m2']
+    assert errors['m2'].kind == 'rate_limited'
+
+
+def test_search_with_no_matches_is_empty():
+    gmail = search_service([], {})
+    assert gmail.search_emails('from:nobody') == []
+
+
+def part(mime_type, text=None, filename='', attachment_id=None, charset=None, parts=None):
+    """One node of a 'full' format MIME tree"""
+    node = {'mimeType': mime_type, 'filename': filename, 'headers': [], 'body': {'size': 0}}
+    if charset:
+        node['headers'].append({'name': 'Content-Type', 'value': f'{mime_type}; charset="{charset}"'})
+    if text is not None:
+        data = text.encode(charset or 'utf-8')
+        node['body'] = {'size': len(data), 'data': base64.urlsafe_b64encode(data).decode()}
+    if attachment_id:
+        node['body'] = {'size': 1234, 'attachmentId': attachment_id}
+    if parts is not None:
+        node['parts'] = parts
+    return node
+
+
+def nested_payload():
+    """mixed -> (alternative -> (related -> (html, inline image), text), report.pdf, notes.txt)"""
+    return part('multipart/mixed', parts=[
+        part('multipart/alternative', parts=[
+            part('multipart/related', parts=[
+                part('text/html', '<p>Hello <b>HTML</b></p>'),
+                part('image/png', filename='logo.png', attachment_id='att-logo'),
+            ]),
+            part('text/plain', 'Caf\u00e9 plain body', charset='iso-8859-1'),
+        ]),
+        part('application/pdf', filename='report.pdf', attachment_id='att-pdf'),
+        # A text attachment carries inline data but must not become the body
+        part('text/plain', 'attached notes', filename='notes.txt', attachment_id='att-notes'),
+    ])
+
+
+def test_walk_payload_finds_bodies_and_attachments_at_any_depth():
+    gmail = GmailService(service=MagicMock(), scheduler=MagicMock())
+    text_part, html_part, attachments = gmail._walk_payload(nested_payload())
+
+    assert gmail._decode_part(text_part) == 'Caf\u00e9 plain body'
+    assert gmail._decode_part(html_part) == '<p>Hello <b>HTML</b></p>'
+    assert [a['attachmentId'] for a in attachments] == ['att-logo', 'att-pdf', 'att-notes']
+    assert attachments[1] == {
+        'filename': 'report.pdf',
+        'mimeType': 'application/pdf',
+        'size': 1234,
+        'attachmentId': 'att-pdf',
+    }
+
+
+def test_parse_message_prefers_nested_text_plain():
+    gmail = GmailService(service=MagicMock(), scheduler=MagicMock())
+    message = {'id': 'm1', 'threadId': 't1', 'payload': nested_payload()}
+
+    parsed = gmail._parse_message(message)
+    assert parsed['body'] == 'Caf\u00e9 plain body'
+    assert parsed['hasAttachments'] is True
+    assert parsed['attachmentCount'] == 3
+
+
+def test_html_only_message_falls_back_to_extracted_text():
+    gmail = GmailService(service=MagicMock(), scheduler=MagicMock())
+    payload = part('multipart/mixed', parts=[
+        part('multipart/alternative', parts=[part('text/html', '<p>Only <i>HTML</i> here</p>')]),
+    ])
+
+    assert gmail._get_message_body(payload) == 'Only HTML here'
+
+
+def test_single_part_message_of_other_text_type_has_a_body():
+    gmail = GmailService(service=MagicMock(), scheduler=MagicMock())
+    payload = part('text/calendar', 'BEGIN:VCALENDAR')
+
+    text_part, html_part, attachments = gmail._walk_payload(payload)
+    assert text_part is payload
+    assert html_part is None
+    assert attachments == []
@@ -0,0 +1,63 @@
+"""
+html_text tests: quote and signature stripping, HTML extraction
+"""
+
+from html_text import html_to_text, strip_quoted_text
+
+
+def test_reply_quote_and_attribution_removed():
+    text = (
+        "Sounds good, see you then.\n"
+        "\n"
+        "On Mon, 1 Jan 2024 at 10:00, Alice <alice@example.com> wrote:\n"
+        "> Can we meet at 3?\n"
+        "> Alice\n"
+    )
+    assert strip_quoted_text(text) == "Sounds good, see you then."
+
+
+def test_signature_delimiter_cuts_the_rest():
+    assert strip_quoted_text("Thanks!\n-- \nBob Smith\nACME Corp") == "Thanks!"
+    # HTML bodies carry the delimiter's space as &nbsp;
+    assert strip_quoted_text("Thanks!\n--\u00a0\nBob Smith") == "Thanks!"
+
+
+def test_bare_double_dash_is_not_a_signature():
+    text = "Agenda\n--\n1. Budget\n2. Hiring"
+    assert strip_quoted_text(text) == text
+
+
+def test_original_message_marker_cuts_the_rest():
+    text = "See below.\n\n-----Original Message-----\nFrom: Carol\nOld text"
+    assert strip_quoted_text(text) == "See below."
+
+
+def test_whitespace_boilerplate_and_invisible_chars():
+    text = "Hi\u200b  there\n\n\n\nSecond\u00a0paragraph\nSent from my iPhone"
+    assert strip_quoted_text(text) == "Hi there\n\nSecond paragraph"
+
+
+def test_forwarded_message_is_kept():
+    text = "FYI\n\n---------- Forwarded message ---------\nFrom: Dave\nBody"
+    assert strip_quoted_text(text) == text
+
+
+def test_strip_quotes_false_keeps_history():
+    text = "Yes.\n\nOn Mon, Alice wrote:\n> Question?\n-- \nBob"
+    assert strip_quoted_text(text, strip_quotes=False) == "Yes.\n\nOn Mon, Alice wrote:\n> Question?\n--\nBob"
+
+
+def test_html_drops_markup_hidden_text_and_quotes():
+    markup = (
+        '<html><head><style>p {color: red}</style></head><body>'
+        '<div style="display:none">preheader</div>'
+        '<p>Hello &amp; welcome</p><ul><li>One</li><li>Two</li></ul>'
+        '<div class="gmail_quote">On Mon, Alice wrote:<blockquote>old</blockquote></div>'
+        '</body></html>'
+    )
+    assert html_to_text(markup) == "Hello & welcome\n\n- One\n- Two"
+    assert html_to_text(markup, strip_quotes=False).endswith("On Mon, Alice wrote:\nold")
+
+
+def test_html_truncated_tag_is_dropped():
+    assert html_to_text('<p>Hello</p><a href="http://exa') == "Hello"
@@ -0,0 +1,103 @@
+"""
+translate_query tests: Gmail search syntax the local index answers, and what it leaves to the API
+"""
+
+import time
+from datetime import datetime
+
+import pytest
+
+from mailbox_index import translate_query
+
+NOW = 1_700_000_000
+
+
+def test_words_and_phrases_become_fts_terms():
+    translated = translate_query('invoice "due date" march')
+
+    assert translated.terms == ['invoice', 'due date', 'march']
+    assert translated.where == []
+    assert translated.match_expression() == '"invoice" "due date" "march"'
+
+
+def test_match_expression_escapes_quotes_and_operators():
+    translated = translate_query('AT&T NEAR')
+    assert translated.match_expression() == '"AT&T" "NEAR"'
+
+    translated.terms = ['say "hi"']
+    assert translated.match_expression() == '"say ""hi"""'
+
+
+def test_empty_query_matches_everything():
+    for query in ('', None, '   '):
+        translated = translate_query(query)
+        assert translated.terms == []
+        assert translated.where == []
+        assert translated.match_expression() is None
+
+
+def test_from_and_subject_filter_columns():
+    translated = translate_query('from:alice@example.com subject:"weekly report" budget')
+
+    assert translated.terms == ['budget']
+    assert translated.where == ["m.sender LIKE ?", "m.subject LIKE ?"]
+    assert translated.params == ['%alice@example.com%', '%weekly report%']
+
+
+def test_operators_are_case_insensitive():
+    translated = translate_query('FROM:bob Has:Attachment')
+
+    assert translated.where == ["m.sender LIKE ?", "m.attachment_count > 0"]
+    assert translated.params == ['%bob%']
+
+
+@pytest.mark.parametrize('value', ['2024/03/01', '2024-03-01'])
+def test_absolute_dates_are_milliseconds(value):
+    midnight = time.mktime(datetime(2024, 3, 1).timetuple())
+    translated = translate_query(f'after:{value} before:{value}')
+
+    assert translated.where == ["m.internal_date >= ?", "m.internal_date < ?"]
+    assert translated.params == [int(midnight * 1000)] * 2
+
+
+def test_epoch_seconds_date():
+    assert translate_query('after:1700000000').params == [1_700_000_000_000]
+
+
+@pytest.mark.parametrize('query, seconds', [
+    ('newer_than:2d', 2 * 86400),
+    ('newer_than:3m', 3 * 30 * 86400),
+    ('newer_than:1Y', 365 * 86400),
+])
+def test_relative_dates_count_back_from_now(query, seconds):
+    translated = translate_query(query, now=NOW)
+
+    assert translated.where == ["m.internal_date >= ?"]
+    assert translated.params == [(NOW - seconds) * 1000]
+
+
+def test_older_than_is_an_upper_bound():
+    translated = translate_query('older_than:7d', now=NOW)
+
+    assert translated.where == ["m.internal_date < ?"]
+    assert translated.params == [(NOW - 7 * 86400) * 1000]
+
+
+@pytest.mark.parametrize('query', [
+    '-from:alice',
+    '-spam',
+    'invoice OR receipt',
+    'invoice AND receipt',
+    '(invoice receipt)',
+    '{invoice receipt}',
+    'from:(alice bob)',
+    'label:work',
+    'is:unread',
+    'has:drive',
+    'in:anywhere',
+    'after:yesterday',
+    'newer_than:2w',
+    'older_than:d',
+])
+def test_unsupported_syntax_falls_back_to_the_api(query):
+    assert translate_query(query, now=NOW) is None
@@ -0,0 +1,153 @@
+"""
+Result governor tests: turn budgets, fair shares and shrinking tool results to fit
+"""
+
+import json
+from types import SimpleNamespace
+
+import pytest
+
+from result_governor import (
+    CHARS_PER_TOKEN,
+    MIN_TURN_TOKENS,
+    NOTE_CHARS,
+    ResultGovernor,
+    estimate_tokens,
+    fair_shares,
+    shrink_result
+)
+
+
+def email(message_id, body_chars):
+    return {
+        'id': message_id,
+        'threadId': f"t-{message_id}",
+        'subject': f"Subject {message_id}",
+        'from': 'alice@example.com',
+        'to': 'me@example.com',
+        'date': 'Mon, 1 Jan 2024 09:00:00 +0000',
+        'body': 'x' * body_chars,
+        'snippet': 'y' * 100,
+        'attachmentCount': 0,
+    }
+
+
+def size(value):
+    return len(json.dumps(value))
+
+
+def test_estimate_tokens_rounds_up():
+    assert estimate_tokens('') == 1
+    assert estimate_tokens('a' * 7) == 3
+    # Values are measured as JSON: '"ab"' is four characters
+    assert estimate_tokens(['ab']) == estimate_tokens('["ab"]')
+
+
+@pytest.mark.parametrize('sizes, budget, expected', [
+    # Everything fits
+    ([10, 20, 30], 100, [10, 20, 30]),
+    # Small results keep their size, the large ones split the rest evenly
+    ([10, 500, 900], 310, [10, 150, 150]),
+    ([100, 100, 100], 150, [50, 50, 50]),
+    # Order of the input is preserved
+    ([900, 10], 110, [100, 10]),
+    # Errors count as size 0 and keep nothing from the budget
+    ([0, 400], 100, [0, 100]),
+    ([], 100, []),
+])
+def test_fair_shares(sizes, budget, expected):
+    allowances = fair_shares(sizes, budget)
+    assert allowances == expected
+    assert sum(allowances) <= max(budget, sum(sizes))
+
+
+@pytest.mark.parametrize('used, reserve, expected', [
+    # Plenty of context: the per-turn cap applies
+    (0, 0, 20_000),
+    # Context nearly full: what is left
+    (185_000, 4_000, 11_000),
+    # Context exhausted: still the floor
+    (199_000, 4_000, MIN_TURN_TOKENS),
+])
+def test_turn_budget(used, reserve, expected):
+    governor = ResultGovernor(context_tokens=200_000, turn_tokens=20_000, reserve_tokens=reserve)
+    governor.used_tokens = used
+    assert governor.turn_budget() == expected
+
+
+def test_observe_resets_from_exact_usage():
+    governor = ResultGovernor()
+    governor.used_tokens = 123_456
+    governor.observe(SimpleNamespace(
+        input_tokens=1_000, cache_creation_input_tokens=None, cache_read_input_tokens=500, output_tokens=250
+    ))
+    assert governor.used_tokens == 1_750
+
+
+def test_fit_shrinks_only_oversized_results_and_counts_usage():
+    governor = ResultGovernor(context_tokens=200_000, turn_tokens=2_000)
+    budget_chars = int(2_000 * CHARS_PER_TOKEN)
+    small = [email('s1', 100)]
+    large = [email(f"l{i}", 2_000) for i in range(10)]
+    outcomes = [
+        (SimpleNamespace(name='search_emails'), small, None),
+        (SimpleNamespace(name='search_emails'), large, None),
+        (SimpleNamespace(name='get_email_content'), None, 'boom'),
+    ]
+
+    fitted = governor.fit(outcomes)
+
+    assert fitted[0][1] is small
+    assert size(fitted[1][1]) <= budget_chars - size(small)
+    assert 'note' in fitted[1][1]
+    assert fitted[2] == outcomes[2]
+    assert governor.used_tokens == estimate_tokens(small) + estimate_tokens(fitted[1][1])
+
+
+def test_shrink_cuts_bodies_proportionally():
+    emails = [email('a', 1_000), email('b', 3_000)]
+    shrunk = shrink_result(emails, 3_000)
+
+    bodies = [len(item['body']) for item in shrunk['results']]
+    assert size(shrunk) <= 3_000 + NOTE_CHARS
+    assert bodies[1] == pytest.approx(3 * bodies[0], rel=0.05, abs=4)
+    assert 'shortened' in shrunk['note']
+
+
+def test_shrink_falls_back_to_summaries_then_drops_emails():
+    emails = [email(f"m{i}", 2_000) for i in range(20)]
+
+    # Too little room for MIN_BODY_CHARS each: summaries without bodies
+    summaries = shrink_result(emails, 7_000)
+    assert len(summaries['results']) == 20
+    assert all('body' not in item and 'snippet' in item for item in summaries['results'])
+    assert size(summaries) <= 7_000
+
+    # Too little room even for minimal summaries: keep the leading ones
+    kept = shrink_result(emails, 1_000)
+    assert 0 < len(kept['results']) < 20
+    assert [item['id'] for item in kept['results']] == [f"m{i}" for i in range(len(kept['results']))]
+    assert kept['note'].startswith(f"Only the first {len(kept['results'])} of 20")
+
+
+def test_shrink_single_email_and_thread_keep_their_shape():
+    single = shrink_result(email('a', 10_000), 2_000)
+    assert single['id'] == 'a' and len(single['body']) < 2_000 and 'note' in single
+
+    thread = {'threadId': 't1', 'messageCount': 2, 'messages': [email('a', 5_000), email('b', 5_000)]}
+    shrunk = shrink_result(thread, 3_000)
+    assert shrunk['threadId'] == 't1' and shrunk['messageCount'] == 2
+    assert [item['id'] for item in shrunk['messages']] == ['a', 'b']
+    assert size(shrunk) <= 3_000 + NOTE_CHARS
+
+
+def test_shrink_other_results():
+    rows = [{'sender': f"user{i}@example.com", 'count': i} for i in range(100)]
+    shrunk = shrink_result(rows, 1_000)
+    assert shrunk['results'] == rows[:len(shrunk['results'])]
+    assert size(shrunk['results']) + NOTE_CHARS <= 1_000
+
+    blob = {'text': 'z' * 5_000}
+    cut = shrink_result(blob, 1_000)
+    assert len(cut['truncated']) == 1_000 - NOTE_CHARS
+    assert json.dumps(blob).startswith(cut['truncated'])
@@ -0,0 +1,183 @@
+"""
+Session store tests: credential encryption at rest, TTLs and size caps
+"""
+
+import sqlite3
+
+import pytest
+from cryptography.fernet import Fernet
+from google.oauth2.credentials import Credentials
+
+from session_store import MemorySessionStore, SQLiteSessionStore
+
+
+class Clock:
+    """Stand-in for time.time that only moves when told to"""
+
+    def __init__(self, now=1_000_000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr('session_store.time.time', clock)
+    return clock
+
+
+@pytest.fixture
+def key(monkeypatch):
+    key = Fernet.generate_key().decode()
+    monkeypatch.setenv('SESSION_ENCRYPTION_KEY', key)
+    return key
+
+
+def make_store(tmp_path, **kwargs):
+    kwargs.setdefault('session_ttl', 100)
+    kwargs.setdefault('state_ttl', 10)
+    kwargs.setdefault('cache_seconds', 0)
+    return SQLiteSessionStore(db_path=str(tmp_path / 'sessions.db'), **kwargs)
+
+
+def credentials(token='access-token-secret'):
+    return Credentials(
+        token=token,
+        refresh_token='refresh-token-secret',
+        token_uri='https://oauth2.googleapis.com/token',
+        client_id='client-id',
+        client_secret='client-secret'
+    )
+
+
+def raw_credentials(tmp_path, session_id):
+    with sqlite3.connect(str(tmp_path / 'sessions.db')) as conn:
+        return conn.execute(
+            "SELECT credentials FROM sessions WHERE session_id = ?", (session_id,)
+        ).fetchone()[0]
+
+
+def test_credentials_round_trip_and_are_encrypted_at_rest(tmp_path, key, clock):
+    make_store(tmp_path).save_session('s1', 'me@example.com', credentials())
+
+    blob = raw_credentials(tmp_path, 's1')
+    assert b'access-token-secret' not in blob
+    assert b'refresh-token-secret' not in blob
+    assert b'access-token-secret' in Fernet(key.encode()).decrypt(blob)
+
+    # A second store (another worker) has no cached copy and must decrypt
+    session = make_store(tmp_path).get_session('s1')
+    assert session['email'] == 'me@example.com'
+    assert session['credentials'].token == 'access-token-secret'
+    assert session['credentials'].refresh_token == 'refresh-token-secret'
+
+
+def test_wrong_key_logs_the_session_out(tmp_path, monkeypatch, key, clock):
+    make_store(tmp_path).save_session('s1', 'me@example.com', credentials())
+
+    monkeypatch.setenv('SESSION_ENCRYPTION_KEY', Fernet.generate_key().decode())
+    store = make_store(tmp_path)
+    assert store.get_session('s1') is None
+    assert store.stats()['sessions'] == 0
+
+
+def test_session_expires_after_ttl(tmp_path, key, clock):
+    store = make_store(tmp_path)
+    store.save_session('s1', 'me@example.com', credentials())
+
+    clock.advance(99)
+    assert store.get_session('s1') is not None
+    clock.advance(1)
+    assert store.get_session('s1') is None
+    assert store.stats()['sessions_expired'] == 1
+    assert store.stats()['sessions'] == 0
+
+
+def test_saving_again_keeps_the_original_expiry(tmp_path, key, clock):
+    store = make_store(tmp_path)
+    store.save_session('s1', 'me@example.com', credentials())
+
+    # A token refresh re-saves the session; it must not extend its life
+    clock.advance(60)
+    store.save_session('s1', 'me@example.com', credentials(token='refreshed'))
+    assert store.get_session('s1')['credentials'].token == 'refreshed'
+
+    clock.advance(40)
+    assert store.get_session('s1') is None
+
+
+def test_cached_session_is_still_dropped_at_expiry(tmp_path, key, clock):
+    store = make_store(tmp_path, cache_seconds=1000)
+    store.save_session('s1', 'me@example.com', credentials())
+
+    clock.advance(100)
+    assert store.get_session('s1') is None
+
+
+def test_state_is_single_use_and_expires(tmp_path, key, clock):
+    store = make_store(tmp_path)
+    store.add_state('fresh')
+    store.add_state('stale')
+
+    assert store.pop_state('fresh') is True
+    assert store.pop_state('fresh') is False
+    assert store.pop_state('unknown') is False
+
+    clock.advance(10)
+    assert store.pop_state('stale') is False
+
+
+def test_sweep_removes_expired_sessions_and_states(tmp_path, key, clock):
+    store = make_store(tmp_path)
+    store.save_session('old', 'old@example.com', credentials())
+    store.add_state('old-state')
+
+    clock.advance(50)
+    store.save_session('new', 'new@example.com', credentials())
+
+    clock.advance(50)
+    store.add_state('new-state')
+    store.sweep()
+    stats = store.stats()
+    assert stats['sessions'] == 1
+    assert stats['pending_states'] == 1
+    assert stats['sessions_expired'] == 1
+    assert stats['states_expired'] == 1
+    assert store.get_session('new')['email'] == 'new@example.com'
+
+
+def test_least_recently_used_session_is_evicted(tmp_path, key, clock):
+    store = make_store(tmp_path, max_sessions=2)
+    store.save_session('a', 'a@example.com', credentials())
+    clock.advance(1)
+    store.save_session('b', 'b@example.com', credentials())
+    clock.advance(1)
+    store.get_session('a')
+    clock.advance(1)
+    store.save_session('c', 'c@example.com', credentials())
+
+    assert store.get_session('b') is None
+    assert store.get_session('a') is not None
+    assert store.get_session('c') is not None
+    assert store.stats()['sessions_evicted'] == 1
+
+
+def test_memory_store_ttls_and_caps(clock):
+    store = MemorySessionStore(session_ttl=100, state_ttl=10, max_sessions=1)
+    store.save_session('a', 'a@example.com', credentials())
+    store.save_session('b', 'b@example.com', credentials())
+    assert store.get_session('a') is None
+    assert store.stats()['sessions_evicted'] == 1
+
+    store.add_state('state')
+    clock.advance(10)
+    assert store.pop_state('state') is False
+
+    clock.advance(90)
+    assert store.get_session('b') is None
+    assert store.stats()['sessions_expired'] == 1
@@ -0,0 +1,361 @@
+"""
+Tracing Module
+Lightweight per-request span timelines. A trace is started for a chat
+request; spans opened while it is active (Claude calls, tools, GmailService
+methods, Gmail HTTP requests, parsing) nest under whatever span was current,
+including across tool threads. Finished traces export as a nested span tree
+or in Chrome trace-event format (chrome://tracing, Perfetto, speedscope).
+With no active trace every span is a no-op costing one context lookup
+"""
+
+import contextvars
+import functools
+import inspect
+import json
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+# Request header that asks for the trace: "1"/"tree" for the span tree, "chrome" for trace events
+TRACE_HEADER = 'X-Debug-Trace'
+
+# Traces expose internal span names, timings and tool arguments, so the header is ignored unless this is set
+DEBUG_TRACE_ENABLED = os.environ.get('DEBUG_TRACE_ENABLED', '').lower() in ('1', 'true', 'yes')
+
+# Chats slower than this are traced and written to TRACE_DIR in Chrome format (0 disables)
+TRACE_SLOW_SECONDS = float(os.environ.get('TRACE_SLOW_SECONDS', '0'))
+TRACE_DIR = os.environ.get('TRACE_DIR', os.path.join(os.path.dirname(__file__), 'cache', 'traces'))
+
+# Slow traces kept in TRACE_DIR; the oldest are deleted beyond this
+TRACE_MAX_FILES = int(os.environ.get('TRACE_MAX_FILES', '200'))
+
+# Spans kept per trace; later spans are counted but dropped so a runaway loop can't grow memory
+MAX_SPANS = 5000
+
+# Attribute values longer than this are cut in exports
+MAX_ATTR_CHARS = 200
+
+_current_trace = contextvars.ContextVar('trace', default=None)
+_current_span = contextvars.ContextVar('span', default=None)
+
+
+class Span:
+    __slots__ = ('id', 'parent_id', 'name', 'start', 'end', 'attrs', 'thread_id', 'thread_name')
+
+    def __init__(self, name, parent_id, attrs):
+        thread = threading.current_thread()
+        self.id = None
+        self.parent_id = parent_id
+        self.name = name
+        self.start = time.perf_counter()
+        self.end = None
+        self.attrs = attrs
+        self.thread_id = thread.ident
+        self.thread_name = thread.name
+
+    def set(self, **attrs):
+        """Add attributes (e.g. token counts known only after the call)"""
+        self.attrs.update(attrs)
+
+
+class _NoopSpan:
+    """Stand-in yielded by span() when nothing is being traced"""
+
+    def set(self, **attrs):
+        pass
+
+
+_NOOP_SPAN = _NoopSpan()
+
+
+class Trace:
+    def __init__(self, name, export_format=None, **attrs):
+        """
+        Spans recorded for one request
+
+        Args:
+            name: Name of the root span
+            export_format: 'tree' or 'chrome' if the client asked for the trace, else None
+            **attrs: Attributes of the root span
+        """
+        self.id = uuid.uuid4().hex[:16]
+        self.format = export_format
+        self.started_at = time.time()
+        self.spans = []
+        self.dropped = 0
+        self._lock = threading.Lock()
+        self._tokens = ()
+        self.root = self.add(Span(name, None, attrs))
+
+    def add(self, span):
+        """Record a span (called from any thread)"""
+        with self._lock:
+            if len(self.spans) >= MAX_SPANS:
+                self.dropped += 1
+                return span
+            span.id = len(self.spans)
+            self.spans.append(span)
+        return span
+
+    @property
+    def duration(self):
+        return (self.root.end or time.perf_counter()) - self.root.start
+
+    def export(self, export_format=None):
+        """Export in the requested format ('tree' unless 'chrome')"""
+        if (export_format or self.format) == 'chrome':
+            return self.to_chrome()
+        return self.to_tree()
+
+    def to_tree(self):
+        """
+        Nested span tree with times in ms relative to the start of the request
+
+        Returns:
+            Dict with the trace ID, total duration and the root span, whose
+            children are ordered by start time
+        """
+        now = time.perf_counter()
+        with self._lock:
+            spans = list(self.spans)
+
+        nodes = {}
+        for span in spans:
+            end = span.end if span.end is not None else now
+            node = {
+                'name': span.name,
+                'start_ms': round((span.start - self.root.start) * 1000, 2),
+                'duration_ms': round((end - span.start) * 1000, 2),
+            }
+            if span.attrs:
+                node['attrs'] = _clean_attrs(span.attrs)
+            if span.end is None:
+                node['unfinished'] = True
+            node['children'] = []
+            nodes[span.id] = node
+
+        for span in spans:
+            if span.parent_id is not None and span.parent_id in nodes:
+                nodes[span.parent_id]['children'].append(nodes[span.id])
+
+        for node in nodes.values():
+            node['children'].sort(key=lambda child: child['start_ms'])
+            if not node['children']:
+                del node['children']
+
+        return {
+            'id': self.id,
+            'duration_ms': round(self.duration * 1000, 2),
+            'dropped_spans': self.dropped,
+            'root': nodes[self.root.id],
+        }
+
+    def to_chrome(self):
+        """
+        Chrome trace-event format: one complete ("X") event per span plus
+        thread-name metadata, loadable in chrome://tracing or Perfetto
+
+        Returns:
+            Dict with traceEvents
+        """
+        now = time.perf_counter()
+        with self._lock:
+            spans = list(self.spans)
+
+        pid = os.getpid()
+        origin = self.root.start
+        events = []
+        thread_names = {}
+        for span in spans:
+            end = span.end if span.end is not None else now
+            event = {
+                'name': span.name,
+                'cat': span.name.split(':', 1)[0].split(' ', 1)[0],
+                'ph': 'X',
+                'ts': round((span.start - origin) * 1e6, 1),
+                'dur': round((end - span.start) * 1e6, 1),
+                'pid': pid,
+                'tid': span.thread_id,
+            }
+            if span.attrs:
+                event['args'] = _clean_attrs(span.attrs)
+            events.append(event)
+            thread_names[span.thread_id] = span.thread_name
+
+        for tid, thread_name in thread_names.items():
+            events.append({'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': tid, 'args': {'name': thread_name}})
+
+        return {
+            'traceEvents': events,
+            'displayTimeUnit': 'ms',
+            'otherData': {'trace_id': self.id, 'started_at': self.started_at},
+        }
+
+
+def requested_format(value):
+    """
+    Parse the X-Debug-Trace header
+
+    Returns:
+        'tree', 'chrome' or None if no trace was asked for (or DEBUG_TRACE_ENABLED is off)
+    """
+    value = (value or '').strip().lower()
+    if not DEBUG_TRACE_ENABLED or value in ('', '0', 'false', 'off', 'no'):
+        return None
+    return 'chrome' if value == 'chrome' else 'tree'
+
+
+def start_trace(name, export_format=None, **attrs):
+    """
+    Start tracing the current request
+
+    Args:
+        name: Root span name (e.g. 'chat')
+        export_format: From requested_format(); None unless the client asked
+        **attrs: Root span attributes
+
+    Returns:
+        The Trace, or None if the request isn't being traced (no debug flag
+        and slow-trace export off); pass the result to finish_trace either way
+    """
+    if export_format is None and not TRACE_SLOW_SECONDS:
+        return None
+    trace = Trace(name, export_format, **attrs)
+    trace._tokens = (_current_trace.set(trace), _current_span.set(trace.root))
+    return trace
+
+
+def finish_trace(trace):
+    """End the trace started by start_trace and write it to TRACE_DIR if it was slow"""
+    if trace is None:
+        return
+    trace.root.end = time.perf_counter()
+    for var, token in zip((_current_trace, _current_span), trace._tokens):
+        try:
+            var.reset(token)
+        except ValueError:
+            # Finished from another context (e.g. a generator closed elsewhere)
+            var.set(None)
+
+    if TRACE_SLOW_SECONDS and trace.duration >= TRACE_SLOW_SECONDS:
+        _write_slow_trace(trace)
+
+
+def trace_fields(trace):
+    """Extra response JSON fields: {'trace': ...} if the client asked for it, else {}"""
+    if trace is None or trace.format is None:
+        return {}
+    return {'trace': trace.export()}
+
+
+@contextmanager
+def span(name, **attrs):
+    """
+    Time one span under the current one
+
+    Usable as `with span('claude', iteration=2) as s: ...; s.set(tokens=...)`.
+    Yields a no-op span when nothing is being traced.
+    """
+    trace = _current_trace.get()
+    if trace is None:
+        yield _NOOP_SPAN
+        return
+
+    parent = _current_span.get()
+    current = trace.add(Span(name, parent.id if parent is not None else None, attrs))
+    token = _current_span.set(current)
+    try:
+        yield current
+    except BaseException as error:
+        current.attrs['error'] = f"{type(error).__name__}: {error}"
+        raise
+    finally:
+        current.end = time.perf_counter()
+        try:
+            _current_span.reset(token)
+        except ValueError:
+            _current_span.set(parent)
+
+
+def traced(name=None):
+    """
+    Decorator running a function inside a span
+
+    The name may use the function's arguments, e.g. 'tool:{tool_name}';
+    they are only looked up when a trace is active. Don't use it on
+    generator functions (the span would end before the first item).
+
+    Args:
+        name: Span name or template (default: the function's qualified name)
+    """
+    def decorator(fn):
+        span_name = name or fn.__qualname__
+        signature = inspect.signature(fn) if '{' in span_name else None
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if _current_trace.get() is None:
+                return fn(*args, **kwargs)
+            label = span_name
+            if signature is not None:
+                bound = signature.bind(*args, **kwargs)
+                label = span_name.format(**bound.arguments)
+            with span(label):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def bind(fn):
+    """
+    Wrap fn to run in a copy of the current context, so spans it opens on
+    an executor thread nest under the caller's current span
+
+    Returns:
+        Callable taking the same arguments as fn
+    """
+    return functools.partial(contextvars.copy_context().run, fn)
+
+
+def _clean_attrs(attrs):
+    """JSON-safe, length-capped attribute values"""
+    cleaned = {}
+    for key, value in attrs.items():
+        if not isinstance(value, (int, float, bool)) and value is not None:
+            value = value if isinstance(value, str) else json.dumps(value, default=str)
+            if len(value) > MAX_ATTR_CHARS:
+                value = value[:MAX_ATTR_CHARS] + '...'
+        cleaned[key] = value
+    return cleaned
+
+
+def _write_slow_trace(trace):
+    """Save a slow trace in Chrome format for later inspection"""
+    stamp = time.strftime('%Y%m%d-%H%M%S', time.localtime(trace.started_at))
+    path = os.path.join(TRACE_DIR, f"{stamp}-{trace.id}.json")
+    try:
+        os.makedirs(TRACE_DIR, exist_ok=True)
+        with open(path, 'w') as f:
+            json.dump(trace.to_chrome(), f)
+    except OSError as error:
+        print(f"Could not write trace {trace.id}: {error}")
+        return
+    print(f"Slow request ({trace.duration:.1f}s), trace written to {path}")
+    _prune_traces()
+
+
+def _prune_traces():
+    """Delete the oldest trace files beyond TRACE_MAX_FILES"""
+    try:
+        # Names start with a timestamp, so name order is age order
+        names = sorted(name for name in os.listdir(TRACE_DIR) if name.endswith('.json'))
+    except OSError:
+        return
+    for name in names[:max(0, len(names) - TRACE_MAX_FILES)]:
+        try:
+            os.remove(os.path.join(TRACE_DIR, name))
+        except OSError:
+            # Already removed by another worker
+            pass
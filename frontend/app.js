@@ -91,8 +91,8 @@ async function sendMessage() {
     const typingId = showTypingIndicator();
 
     try {
-        // Send request to backend
-        const response = await fetch(`${API_BASE_URL}/api/chat`, {
+        // Send request to the streaming backend endpoint
+        const response = await fetch(`${API_BASE_URL}/api/chat/stream`, {
             method: 'POST',
             headers: {
                 'Content-Type': 'application/json'
@@ -110,17 +110,22 @@ async function sendMessage() {
             throw new Error(`HTTP error! status: ${response.status}`);
         }
 
-        const data = await response.json();
-
-        // Remove typing indicator
-        removeTypingIndicator(typingId);
-
-        // Display response
-        if (data.error) {
-            addMessage(`Error: ${data.error}`, 'bot', true);
-        } else {
-            addMessage(data.response, 'bot', false, data.attachments);
-        }
+        // Render events as they arrive
+        const botMessage = createStreamingMessage(typingId);
+        await readEventStream(response, (event, data) => {
+            if (event === 'text') {
+                botMessage.appendText(data.text);
+            } else if (event === 'tool_started') {
+                botMessage.toolStarted(data);
+            } else if (event === 'tool_finished') {
+                botMessage.toolFinished(data);
+            } else if (event === 'attachments') {
+                botMessage.addAttachments(data.attachments);
+            } else if (event === 'error') {
+                botMessage.showError(data.error);
+            }
+        });
+        botMessage.finish();
 
     } catch (error) {
         console.error('Error:', error);
@@ -164,6 +169,136 @@ function addMessage(text, sender, isError = false, attachments = []) {
     messagesContainer.scrollTop = messagesContainer.scrollHeight;
 }
 
+// Read a server-sent event stream from a fetch response
+async function readEventStream(response, onEvent) {
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = '';
+
+    while (true) {
+        const { value, done } = await reader.read();
+        if (done) break;
+
+        buffer += decoder.decode(value, { stream: true });
+
+        // Events are separated by a blank line
+        let boundary;
+        while ((boundary = buffer.indexOf('\n\n')) !== -1) {
+            const rawEvent = buffer.slice(0, boundary);
+            buffer = buffer.slice(boundary + 2);
+
+            let event = 'message';
+            let data = '';
+            rawEvent.split('\n').forEach(line => {
+                if (line.startsWith('event: ')) {
+                    event = line.slice(7);
+                } else if (line.startsWith('data: ')) {
+                    data += line.slice(6);
+                }
+            });
+
+            if (data) {
+                onEvent(event, JSON.parse(data));
+            }
+        }
+    }
+}
+
+// Create a bot message that fills in as stream events arrive
+function createStreamingMessage(typingId) {
+    const messagesContainer = document.getElementById('chatMessages');
+    let messageDiv = null;
+    let contentDiv = null;
+    let textDiv = null;
+    let statusDiv = null;
+    let text = '';
+    const attachments = [];
+    const toolStatus = {};
+
+    // The message replaces the typing indicator on the first event
+    function ensureMessage() {
+        if (messageDiv) return;
+
+        removeTypingIndicator(typingId);
+
+        messageDiv = document.createElement('div');
+        messageDiv.className = 'message bot-message';
+        contentDiv = document.createElement('div');
+        contentDiv.className = 'message-content';
+        textDiv = document.createElement('div');
+        statusDiv = document.createElement('div');
+        statusDiv.className = 'tool-status';
+
+        contentDiv.appendChild(textDiv);
+        contentDiv.appendChild(statusDiv);
+        messageDiv.appendChild(contentDiv);
+        messagesContainer.appendChild(messageDiv);
+    }
+
+    function scroll() {
+        messagesContainer.scrollTop = messagesContainer.scrollHeight;
+    }
+
+    function renderStatus() {
+        statusDiv.innerHTML = Object.values(toolStatus)
+            .map(status => `<div>${escapeHtml(status)}</div>`)
+            .join('');
+    }
+
+    return {
+        appendText(delta) {
+            ensureMessage();
+            text += delta;
+            textDiv.innerHTML = formatText(text);
+            scroll();
+        },
+        toolStarted(data) {
+            ensureMessage();
+            // Keep text from separate rounds in separate paragraphs
+            if (text && !text.endsWith('\n')) {
+                text += '\n\n';
+            }
+            toolStatus[data.id] = `Running ${data.name}...`;
+            renderStatus();
+            scroll();
+        },
+        toolFinished(data) {
+            ensureMessage();
+            const seconds = (data.duration_ms / 1000).toFixed(1);
+            toolStatus[data.id] = data.error
+                ? `${data.name} failed after ${seconds}s`
+                : `${data.name} finished in ${seconds}s`;
+            renderStatus();
+        },
+        addAttachments(found) {
+            ensureMessage();
+            attachments.push(...found);
+            const existing = contentDiv.querySelector('.attachment-list');
+            if (existing) {
+                existing.remove();
+            }
+            contentDiv.appendChild(createAttachmentList(attachments));
+            scroll();
+        },
+        showError(error) {
+            ensureMessage();
+            const errorDiv = document.createElement('div');
+            errorDiv.className = 'error-message';
+            errorDiv.textContent = `Error: ${error}`;
+            contentDiv.appendChild(errorDiv);
+            scroll();
+        },
+        finish() {
+            ensureMessage();
+            // Tool progress is only interesting while the answer is being produced
+            statusDiv.remove();
+            if (!text && !attachments.length && !contentDiv.querySelector('.error-message')) {
+                textDiv.innerHTML = formatText('(No response)');
+            }
+        }
+    };
+}
+
 // Show typing indicator
 function showTypingIndicator() {
     const messagesContainer = document.getElementById('chatMessages');
@@ -226,9 +361,19 @@ function createAttachmentList(attachments) {
     container.className = 'attachment-list';
 
     const title = document.createElement('div');
+    title.className = 'attachment-list-header';
     title.innerHTML = '<strong>Attachments:</strong>';
     container.appendChild(title);
 
+    // One ZIP instead of a round trip per file
+    if (attachments.length > 1) {
+        const downloadAllBtn = document.createElement('button');
+        downloadAllBtn.className = 'download-btn';
+        downloadAllBtn.textContent = 'Download all';
+        downloadAllBtn.onclick = () => downloadAllAttachments(attachments);
+        title.appendChild(downloadAllBtn);
+    }
+
     attachments.forEach(attachment => {
         const item = document.createElement('div');
         item.className = 'attachment-item';
@@ -297,6 +442,53 @@ async function downloadAttachment(messageId, attachmentId, filename) {
     }
 }
 
+// Download several attachments as one ZIP archive
+async function downloadAllAttachments(attachments) {
+    const filename = 'attachments.zip';
+    try {
+        const response = await fetch(`${API_BASE_URL}/api/download-attachments`, {
+            method: 'POST',
+            headers: {
+                'Content-Type': 'application/json'
+            },
+            credentials: 'include',
+            body: JSON.stringify({
+                filename: filename,
+                attachments: attachments.map(attachment => ({
+                    message_id: attachment.message_id,
+                    attachment_id: attachment.attachment_id,
+                    filename: attachment.filename
+                }))
+            })
+        });
+
+        // Handle authentication errors
+        if (handleAuthError(response)) {
+            return;
+        }
+
+        if (!response.ok) {
+            throw new Error('Failed to download attachments');
+        }
+
+        const blob = await response.blob();
+        const url = window.URL.createObjectURL(blob);
+        const a = document.createElement('a');
+        a.href = url;
+        a.download = filename;
+        document.body.appendChild(a);
+        a.click();
+        window.URL.revokeObjectURL(url);
+        document.body.removeChild(a);
+
+        addMessage(`Downloaded ${attachments.length} attachments as ${filename}`, 'bot');
+
+    } catch (error) {
+        console.error('Download error:', error);
+        addMessage(`Failed to download ${filename}: ${error.message}`, 'bot', true);
+    }
+}
+
 // Check backend health on load
 async function checkBackendHealth() {
     try {